@@ -23,8 +23,8 @@ start_server() {
     fi
 
     # Start the server in the background, redirecting output to a log file
-    # Requires sudo to bind to port 67
-    sudo python3 "$DHCP_SERVER_SCRIPT" > "$LOG_FILE" 2>&1 &
+    # Requires sudo to bind to port 67. The server re-reads the configuration file on reload.
+    sudo DHCP_CONFIG_FILE="$(realpath "$CONFIG_FILE")" python3 "$DHCP_SERVER_SCRIPT" > "$LOG_FILE" 2>&1 &
     sleep 1 # Give the process a moment to start
     
     # Find the actual PID of the python script
@@ -65,6 +65,17 @@ stop_server() {
     fi
 }
 
+reload_server() {
+    # SIGHUP makes the server re-read its configuration without dropping leases
+    if [ -f "$PID_FILE" ] && ps -p $(cat "$PID_FILE") > /dev/null; then
+        sudo kill -HUP "$(cat "$PID_FILE")"
+        echo "Asked DHCP server (PID: $(cat "$PID_FILE")) to reload $CONFIG_FILE. Check $LOG_FILE for the result."
+    else
+        echo "DHCP server is not running."
+        exit 1
+    fi
+}
+
 case "$1" in
     start)
         start_server
@@ -76,6 +87,9 @@ case "$1" in
         stop_server
         start_server
         ;;
+    reload)
+        reload_server
+        ;;
     status)
         if [ -f "$PID_FILE" ] && ps -p $(cat "$PID_FILE") > /dev/null; then
             echo "DHCP server is running (PID: $(cat "$PID_FILE"))."
@@ -88,7 +102,7 @@ case "$1" in
         tail -f "$LOG_FILE"
         ;;
     *)
-        echo "Usage: $0 {start|stop|restart|status|logs}"
+        echo "Usage: $0 {start|stop|restart|reload|status|logs}"
         exit 1
         ;;
 esac
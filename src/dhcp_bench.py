@@ -0,0 +1,1187 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from ipaddress import IPv4Address, IPv4Network
+
+import dhcp_server
+from dhcp_server import DESTINATIONS, DHCPACK, DHCPDISCOVER, DHCPOFFER, DHCPRELEASE, DHCPREQUEST, DHCPPacket, DHCPServer, IPPool, Lease, LeaseExpiryQueue, LeaseJournal, LeaseStore, ReservationTable, SqliteExpiryIndex, SqliteLeaseStore, format_mac, parse_mac
+
+# Micro-benchmarks for the DHCP server internals.
+# Usage: python3 src/dhcp_bench.py <benchmark> [--json]
+
+def _per_op_ns(elapsed, ops):
+    return round(elapsed * 1e9 / ops, 1) if ops else 0.0
+
+def bench_pool(args):
+    # Allocation cost for pools from a /24 up to a /16. The per-operation cost
+    # should stay flat as the pool grows.
+    start_ip = int(IPv4Address('10.0.0.1'))
+    results = []
+    for prefix in (24, 22, 20, 18, 16):
+        size = 2 ** (32 - prefix) - 2
+        pool = IPPool(start_ip, start_ip + size - 1)
+
+        # Drain the pool from empty to full
+        t0 = time.perf_counter()
+        allocated = [pool.allocate() for _ in range(size)]
+        fill_time = time.perf_counter() - t0
+
+        # Steady state at full utilisation: release a random address and take
+        # the lowest free one back, which is what a busy scope looks like.
+        rng = random.Random(prefix)
+        churn = min(args.iterations, size)
+        victims = rng.sample(allocated, churn)
+        t0 = time.perf_counter()
+        for ip in victims:
+            pool.release(ip)
+            pool.allocate()
+        churn_time = time.perf_counter() - t0
+
+        # Reserve/release of specific addresses (static leases, REQUEST for a known IP)
+        t0 = time.perf_counter()
+        for ip in victims:
+            pool.release(ip)
+            pool.reserve(ip)
+        reserve_time = time.perf_counter() - t0
+
+        results.append({
+            'prefix': f'/{prefix}',
+            'pool_size': size,
+            'allocate_ns': _per_op_ns(fill_time, size),
+            'release_allocate_ns': _per_op_ns(churn_time, churn),
+            'release_reserve_ns': _per_op_ns(reserve_time, churn),
+        })
+    return results
+
+def _synthetic_leases(count, start_ip, pool_size, now, rng):
+    # MAC -> lease entries in the leases.json format; roughly one in ten is
+    # already expired and one in fifty is static.
+    leases = {}
+    for ip_offset in rng.sample(range(pool_size), count):
+        mac = ':'.join(f'{b:02x}' for b in rng.randbytes(6))
+        roll = rng.random()
+        leases[mac] = {
+            'ip_address': str(IPv4Address(start_ip + ip_offset)),
+            'lease_time_end': now - 60 if roll < 0.1 else now + 3600,
+            'is_static': roll > 0.98
+        }
+    return leases
+
+def bench_startup(args):
+    # DHCPServer construction time (lease load + index + free pool) for a /16
+    # scope with increasingly large leases.json files.
+    start_ip = int(IPv4Address('10.0.0.1'))
+    pool_size = 2 ** 16 - 2
+    os.environ['DHCP_LEASE_START_IP'] = str(IPv4Address(start_ip))
+    os.environ['DHCP_LEASE_END_IP'] = str(IPv4Address(start_ip + pool_size - 1))
+    os.environ['DHCP_SUBNET_MASK'] = '255.255.0.0'
+    dhcp_server.logger.setLevel(logging.WARNING)
+
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        DHCPServer.LEASES_FILE = os.path.join(tmp, 'leases.json')
+        for count in (0, 1000, 10000, 60000):
+            with open(DHCPServer.LEASES_FILE, 'w') as f:
+                json.dump(_synthetic_leases(count, start_ip, pool_size, time.time(), rng), f)
+            t0 = time.perf_counter()
+            server = DHCPServer()
+            elapsed = time.perf_counter() - t0
+            server.journal.close()
+            results.append({
+                'leases_in_file': count,
+                'pool_size': pool_size,
+                'startup_ms': round(elapsed * 1000, 1),
+                'active_leases': len(server.leases),
+                'free_addresses': server.default_scope.ip_pool.free_count,
+            })
+    return results
+
+def bench_journal(args):
+    # Cost of persisting one lease change: the old full leases.json rewrite
+    # against a journal append for each fsync policy, at growing lease counts.
+    # Then a compaction: what it costs the calling (reply) thread and the
+    # background thread that merges the snapshot. Last, the replay of a journal
+    # ending in a torn record and of one ending in a corrupt record
+    # (tests/test_journal.py checks the recovery itself).
+    dhcp_server.logger.setLevel(logging.WARNING)
+    rng = random.Random(0)
+    start_ip = int(IPv4Address('10.0.0.1'))
+    changes = min(args.iterations, 2000)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_path = os.path.join(tmp, 'leases.json')
+        for count in (1000, 10000, 100000):
+            leases = _synthetic_leases(count, start_ip, 2 ** 20, time.time(), rng)
+            records = [(parse_mac(mac), Lease(parse_mac(mac), int(IPv4Address(lease['ip_address'])), lease['lease_time_end'], lease['is_static']))
+                       for mac, lease in leases.items()]
+            row = {'leases': count}
+
+            # Full rewrite, as _save_leases did on every ACK (few iterations, it is slow)
+            rewrites = max(1, min(20, 200000 // count))
+            t0 = time.perf_counter()
+            for _ in range(rewrites):
+                with open(snapshot_path, 'w') as f:
+                    json.dump(leases, f, indent=4)
+            row['full_rewrite_us'] = round((time.perf_counter() - t0) * 1e6 / rewrites, 1)
+
+            for policy in LeaseJournal.FSYNC_POLICIES:
+                journal_path = os.path.join(tmp, f'leases.{policy}.journal')
+                journal = LeaseJournal(snapshot_path, journal_path, fsync_policy=policy)
+                journal.replay({})
+                t0 = time.perf_counter()
+                for i in range(changes):
+                    journal.record(*records[i % count])
+                journal.commit()
+                row[f'journal_{policy}_us'] = round((time.perf_counter() - t0) * 1e6 / changes, 1)
+                journal.close()
+                os.remove(journal_path)
+
+            journal_path = os.path.join(tmp, 'leases.journal')
+            journal = LeaseJournal(snapshot_path, journal_path, fsync_policy='never')
+            journal.replay({})
+            renewed = time.time() + 7200
+            for mac, lease in records[:changes]:
+                journal.record(mac, Lease(mac, lease.ip, renewed, lease.is_static))
+            for mac, lease in records[changes:2 * changes]:
+                journal.record(mac, None)
+            t0 = time.perf_counter()
+            journal.compact()
+            row['compact_call_us'] = round((time.perf_counter() - t0) * 1e6, 1)
+            t0 = time.perf_counter()
+            journal.close() # Waits for the compactor
+            row['compact_background_ms'] = round((time.perf_counter() - t0) * 1e3, 1)
+            os.remove(journal_path)
+            results.append(row)
+
+        journal_path = os.path.join(tmp, 'torn.journal')
+        good = records[:100]
+        for case, tail in (('torn record', LeaseJournal._encode(*records[100])[:-7]),
+                           ('corrupt record', b'00000000' + LeaseJournal._encode(*records[100])[8:])):
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            journal = LeaseJournal(os.path.join(tmp, 'missing.json'), journal_path, fsync_policy='never')
+            journal.replay({})
+            for record in good:
+                journal.record(*record)
+            journal.close()
+            with open(journal_path, 'ab') as f:
+                f.write(tail)
+
+            journal = LeaseJournal(os.path.join(tmp, 'missing.json'), journal_path, fsync_policy='never')
+            t0 = time.perf_counter()
+            applied = journal.replay({})
+            replay_time = time.perf_counter() - t0
+            journal.close()
+            results.append({'leases': len(good), 'journal_tail': case, 'replayed': applied, 'replay_us': round(replay_time * 1e6, 1)})
+    return results
+
+def bench_expiry(args):
+    # Cost of one expiry tick with a fixed number of due leases among a growing
+    # number of live ones, for both lease stores: the in-memory one with its
+    # expiry heap and the SQLite one with its lease_time_end index. It should
+    # track the due count, not the pool size.
+    dhcp_server.logger.setLevel(logging.WARNING)
+    due = 100
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        os.environ['DHCP_JOURNAL_FSYNC'] = 'never' # Measure the tick, not the disk
+        for store, count in itertools.product(DHCPServer.LEASE_STORES, (1000, 10000, 100000)):
+            os.environ['DHCP_LEASE_STORE'] = store
+            os.environ['DHCP_LEASE_START_IP'] = '10.0.0.1'
+            os.environ['DHCP_LEASE_END_IP'] = str(IPv4Address('10.0.0.1') + count - 1)
+            os.environ['DHCP_SUBNET_MASK'] = '255.254.0.0'
+            server = DHCPServer()
+            now = time.time()
+            for i in range(count):
+                # The first `due` leases are already expired, the rest far in the future
+                server._bind_lease(0x020000000000 + i, server.default_scope.ip_pool.allocate(), now - 1 if i < due else now + 3600)
+
+            t0 = time.perf_counter()
+            reclaimed = server._reclaim_expired_leases(now)
+            tick_time = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            server._reclaim_expired_leases(now) # Nothing due: the common idle tick
+            idle_time = time.perf_counter() - t0
+            server.journal.close()
+            server.leases.close()
+            os.remove(server.journal_file)
+            results.append({
+                'store': store,
+                'live_leases': count,
+                'reclaimed': reclaimed,
+                'tick_us': round(tick_time * 1e6, 1),
+                'idle_tick_us': round(idle_time * 1e6, 1),
+            })
+        del os.environ['DHCP_LEASE_STORE']
+    return results
+
+def bench_replies(args):
+    # Replies per second from the reply templates against building every reply
+    # from scratch with build_dhcp_packet (tests/test_replies.py checks that
+    # they are byte-identical).
+    dhcp_server.logger.setLevel(logging.WARNING)
+    os.environ.setdefault('PXE_SERVER_IP', '192.168.1.1')
+    os.environ.setdefault('BOOT_FILE_BIOS', 'pxelinux.0')
+    os.environ.setdefault('BOOT_FILE_EFI', 'bootx64.efi')
+    os.environ.setdefault('DHCP_NIS_DOMAIN', 'example.com')
+    os.environ.setdefault('DHCP_NIS_SERVERS', '192.168.1.10,192.168.1.11')
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        server = DHCPServer()
+        scope = server.default_scope
+        siaddr = int(server.pxe_server_ip)
+        clients = [(rng.getrandbits(32), rng.getrandbits(32), rng.getrandbits(32), rng.randbytes(6)) for _ in range(1000)]
+        for message_type, name in ((DHCPOFFER, 'offer'), (DHCPACK, 'ack')):
+            for arch, arch_name in (([], 'none'), ([0], 'bios'), ([7], 'efi')):
+                boot_file = server._select_boot_file(arch)
+                t0 = time.perf_counter()
+                for i in range(args.iterations):
+                    xid, yiaddr, giaddr, chaddr = clients[i % 1000]
+                    server.build_dhcp_packet(2, xid, 0, yiaddr, siaddr, giaddr, chaddr, message_type, file=boot_file, options=server._reply_options(scope))
+                builder_time = time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                for i in range(args.iterations):
+                    xid, yiaddr, giaddr, chaddr = clients[i % 1000]
+                    server._reply_template(scope, message_type, server._select_boot_file(arch)).render(xid, 0x8000, 0, yiaddr, giaddr, chaddr, scope.lease_time)
+                template_time = time.perf_counter() - t0
+
+                results.append({
+                    'reply': name,
+                    'pxe_arch': arch_name,
+                    'builder_per_sec': int(args.iterations / builder_time),
+                    'template_per_sec': int(args.iterations / template_time),
+                })
+        server.journal.close()
+    return results
+
+def _client_packet(message_type, xid, chaddr, options=b'', sname=b'', file=b'', giaddr=0, ciaddr=0, flags=0x8000):
+    # BOOTREQUEST as a client would send it; options are pre-encoded TLVs
+    header = struct.pack('!BBBBIHHIIII', 1, 1, 6, 0, xid, 0, flags, ciaddr, 0, 0, giaddr)
+    return (header + chaddr.ljust(16, b'\x00') + sname.ljust(64, b'\x00') + file.ljust(128, b'\x00')
+            + DHCPPacket.MAGIC_COOKIE + bytes([53, 1, message_type]) + options + b'\xff')
+
+def _legacy_parse_option_value(code, value):
+    if code == 53:
+        return int.from_bytes(value, 'big')
+    elif code == 50 or code == 54:
+        return IPv4Address(value)
+    elif code == 61:
+        return value
+    elif code == 93:
+        architectures = []
+        for i in range(0, len(value), 2):
+            architectures.append(struct.unpack('!H', value[i:i+2])[0])
+        return architectures
+    return value
+
+def _legacy_parse(data):
+    # The header and option parsing the server did before DHCPPacket (with the
+    # header offsets corrected), kept for comparison
+    struct.unpack('!BBBBIHH', data[0:12])
+    struct.unpack('!IIII', data[12:28])
+    data[28:34]
+    if data[236:240] != DHCPPacket.MAGIC_COOKIE:
+        return None
+    options_data = data[240:]
+    options = {}
+    idx = 0
+    while idx < len(options_data):
+        option_code = options_data[idx]
+        if option_code == 255:
+            break
+        elif option_code == 0:
+            idx += 1
+            continue
+        length = options_data[idx + 1]
+        value = options_data[idx + 2 : idx + 2 + length]
+        options[option_code] = _legacy_parse_option_value(option_code, value)
+        idx += 2 + length
+    return options
+
+def _parse_corpus():
+    # Representative client messages: a PXE DISCOVER with the usual option
+    # set, a REQUEST and a DISCOVER that uses option overload.
+    mac = bytes.fromhex('525400123456')
+    discover = _client_packet(DHCPDISCOVER, 0x1234abcd, mac,
+                              bytes([61, 7, 1]) + mac
+                              + bytes([55, 13, 1, 3, 6, 12, 15, 28, 42, 43, 60, 66, 67, 128, 129])
+                              + bytes([57, 2, 5, 192])
+                              + bytes([93, 2, 0, 7]) + bytes([94, 3, 1, 3, 16])
+                              + bytes([60, 32]) + b'PXEClient:Arch:00007:UNDI:003016')
+    request = _client_packet(DHCPREQUEST, 0x1234abcd, mac,
+                             bytes([50, 4, 192, 168, 1, 100]) + bytes([54, 4, 192, 168, 1, 1])
+                             + bytes([12, 8]) + b'host-001' + bytes([55, 4, 1, 3, 6, 15]))
+    overloaded = _client_packet(DHCPDISCOVER, 0x1234abcd, mac, bytes([52, 1, 3]),
+                                sname=bytes([12, 4]) + b'name\xff', file=bytes([93, 2, 0, 9, 255]))
+    return [discover, request, overloaded]
+
+def bench_parse(args):
+    # Parse throughput of the lazy DHCPPacket view against the old eager parser,
+    # followed by a fuzz run: every truncation and a few thousand random
+    # mutations of the corpus must never make DHCPPacket raise anything but
+    # the ValueError for packets shorter than the fixed header. The two parsers
+    # run in alternating rounds and the fastest round of each counts, as a
+    # single round is at the mercy of whatever else the machine is doing.
+    corpus = _parse_corpus()
+    rounds = 7
+    per_round = max(1, args.iterations // rounds)
+    results = []
+    for name, data in zip(('discover', 'request', 'overloaded'), corpus):
+        legacy_time = view_time = float('inf')
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            for _ in range(per_round):
+                options = _legacy_parse(data)
+                options.get(53), options.get(50), options.get(93)
+            legacy_time = min(legacy_time, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for _ in range(per_round):
+                packet = DHCPPacket(data)
+                packet.message_type, packet.requested_ip, packet.client_arch
+            view_time = min(view_time, time.perf_counter() - t0)
+        results.append({
+            'case': name,
+            'legacy_per_sec': int(per_round / legacy_time),
+            'view_per_sec': int(per_round / view_time),
+            'speedup': round(legacy_time / view_time, 2),
+        })
+
+    rng = random.Random(0)
+    fuzz_cases = []
+    for data in corpus:
+        fuzz_cases.extend(data[:cut] for cut in range(len(data)))
+        for _ in range(2000):
+            mutated = bytearray(data)
+            for _ in range(rng.randint(1, 8)):
+                mutated[rng.randrange(236 if rng.random() < 0.2 else 240, len(mutated))] = rng.randrange(256)
+            fuzz_cases.append(bytes(mutated))
+    view_errors = legacy_errors = rejected = 0
+    for data in fuzz_cases:
+        try:
+            packet = DHCPPacket(data)
+            packet.message_type, packet.requested_ip, packet.server_identifier, packet.client_arch, packet.get(61), 12 in packet
+        except ValueError:
+            rejected += 1
+        except Exception:
+            view_errors += 1
+        try:
+            _legacy_parse(data)
+        except Exception:
+            legacy_errors += 1
+    results.append({
+        'case': f'fuzz ({len(fuzz_cases)} packets)',
+        'view_unexpected_errors': view_errors,
+        'view_rejected_short': rejected,
+        'legacy_errors': legacy_errors,
+    })
+    if view_errors:
+        raise AssertionError(f"DHCPPacket raised on {view_errors} fuzzed packets")
+    return results
+
+def _blast_discovers(sock, server_addr, count, window, timeout=0.2):
+    # Keep `window` DISCOVERs from distinct MACs in flight and count the replies
+    sock.settimeout(timeout)
+    sent = received = outstanding = 0
+    t0 = time.perf_counter()
+    while received < count:
+        while outstanding < window and sent < count:
+            sock.sendto(_client_packet(DHCPDISCOVER, sent, b'\x02' + sent.to_bytes(5, 'big')), server_addr)
+            sent += 1
+            outstanding += 1
+        try:
+            sock.recv(2048)
+            received += 1
+            outstanding -= 1
+        except socket.timeout:
+            if sent >= count:
+                break # The rest were dropped
+            outstanding = 0
+    return sent, received, time.perf_counter() - t0
+
+def bench_serving(args):
+    # Loopback throughput of each serving mode: a real server process on
+    # unprivileged ports, driven by a windowed stream of DISCOVERs.
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dhcp_server.py')
+    server_port, client_port = args.port, args.port + 1
+    results = []
+    for mode in ('single', 'batch', 'multiprocess'):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ,
+                       DHCP_SERVER_IP='127.0.0.1', DHCP_SERVER_PORT=str(server_port), DHCP_CLIENT_PORT=str(client_port),
+                       DHCP_LEASE_START_IP='10.0.0.1', DHCP_LEASE_END_IP='10.0.255.254', DHCP_SUBNET_MASK='255.255.0.0',
+                       DHCP_LEASES_FILE=os.path.join(tmp, 'leases.json'),
+                       DHCP_SERVE_MODE=mode, DHCP_WORKERS=str(args.workers))
+            server = subprocess.Popen([sys.executable, server_script], env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            client.bind(('', client_port))
+            try:
+                # Wait until the server answers
+                for _ in range(100):
+                    if _blast_discovers(client, ('127.0.0.1', server_port), 1, 1, timeout=0.1)[1]:
+                        break
+                else:
+                    raise RuntimeError(f"Server in {mode} mode did not come up")
+                sent, received, elapsed = _blast_discovers(client, ('127.0.0.1', server_port), args.iterations, 128)
+            finally:
+                client.close()
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=10)
+            results.append({
+                'mode': mode if mode != 'multiprocess' else f'multiprocess x{args.workers}',
+                'sent': sent,
+                'replies': received,
+                'replies_per_sec': int(received / elapsed),
+            })
+    return results
+
+class _CaptureSocket:
+    # Stands in for the server socket: keeps the last reply and its destination instead of sending it
+    def __init__(self):
+        self.last_reply = None
+        self.last_addr = None
+
+    def sendto(self, data, addr):
+        self.last_reply = data
+        self.last_addr = addr
+
+    def setsockopt(self, level, option, value):
+        pass
+
+def bench_scopes(args):
+    # Scope selection with growing numbers of relayed /24 subnets: the bisect
+    # index against a linear scan over the scopes, and relayed DISCOVERs
+    # through handle_dhcp_packet, each checked to be offered an address from
+    # its relay's subnet. Clients bound through a relay then RENEW directly
+    # (giaddr 0, ciaddr set) and must still get their own subnet's router and
+    # lease time rather than the local scope's.
+    dhcp_server.logger.setLevel(logging.WARNING)
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        os.environ['DHCP_JOURNAL_FSYNC'] = 'never'
+        os.environ['DHCP_SCOPES_FILE'] = os.path.join(tmp, 'scopes.json')
+        for count in (16, 256, 4096):
+            base = int(IPv4Address('10.0.0.0'))
+            with open(os.environ['DHCP_SCOPES_FILE'], 'w') as f:
+                json.dump([{
+                    'name': f'vlan{i}',
+                    'subnet': f'{IPv4Address(base + i * 256)}/24',
+                    'start_ip': str(IPv4Address(base + i * 256 + 10)),
+                    'end_ip': str(IPv4Address(base + i * 256 + 250)),
+                    'router': str(IPv4Address(base + i * 256 + 1)),
+                    'lease_time': 600,
+                } for i in range(count)], f)
+            t0 = time.perf_counter()
+            server = DHCPServer()
+            startup_time = time.perf_counter() - t0
+            server.sock = _CaptureSocket()
+            scopes = list(server.scope_index)
+            relays = [base + rng.randrange(count) * 256 + 1 for _ in range(1000)]
+
+            t0 = time.perf_counter()
+            for i in range(args.iterations):
+                server.scope_index.lookup(relays[i % 1000])
+            index_time = time.perf_counter() - t0
+
+            linear_ops = min(args.iterations, 2000)
+            t0 = time.perf_counter()
+            for i in range(linear_ops):
+                ip = relays[i % 1000]
+                next(scope for scope in scopes if ip in scope)
+            linear_time = time.perf_counter() - t0
+
+            # Round robin over the relays, at most 50 offers per scope: within each
+            # scope's offer hold limit (a quarter of its 241 addresses)
+            packets = [(base + i % count * 256 + 1, _client_packet(DHCPDISCOVER, i, i.to_bytes(6, 'big'), giaddr=base + i % count * 256 + 1))
+                       for i in range(min(args.iterations, count * 50))]
+            t0 = time.perf_counter()
+            for giaddr, packet in packets:
+                server.handle_dhcp_packet(packet, ('0.0.0.0', 68))
+                yiaddr = int.from_bytes(server.sock.last_reply[16:20], 'big')
+                if yiaddr >> 8 != giaddr >> 8:
+                    raise AssertionError(f"Relay {IPv4Address(giaddr)} was offered {IPv4Address(yiaddr)}")
+            discover_time = time.perf_counter() - t0
+
+            bound = []
+            for i in range(1000):
+                chaddr, giaddr = (1 << 40 | i).to_bytes(6, 'big'), relays[i]
+                server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, i, chaddr, giaddr=giaddr), ('0.0.0.0', 68))
+                yiaddr = int.from_bytes(server.sock.last_reply[16:20], 'big')
+                server.handle_dhcp_packet(_client_packet(DHCPREQUEST, i, chaddr, bytes([50, 4]) + yiaddr.to_bytes(4, 'big'), giaddr=giaddr), ('0.0.0.0', 68))
+                if DHCPPacket(server.sock.last_reply).message_type != DHCPACK:
+                    raise AssertionError(f"Relayed REQUEST for {IPv4Address(yiaddr)} was not acknowledged")
+                bound.append((chaddr, giaddr, yiaddr))
+            t0 = time.perf_counter()
+            for i, (chaddr, giaddr, yiaddr) in enumerate(bound):
+                server.handle_dhcp_packet(_client_packet(DHCPREQUEST, i + 1000, chaddr, ciaddr=yiaddr, flags=0), (str(IPv4Address(yiaddr)), 68))
+                reply = DHCPPacket(server.sock.last_reply)
+                router = int.from_bytes(reply.get(3) or b'', 'big')
+                lease_time = int.from_bytes(reply.get(51) or b'', 'big')
+                if reply.message_type != DHCPACK or router != giaddr or lease_time != 600:
+                    raise AssertionError(f"Direct RENEW of {IPv4Address(yiaddr)} answered with type {reply.message_type}, "
+                                         f"router {IPv4Address(router)} and lease time {lease_time}")
+                if server.leases.get(int.from_bytes(chaddr, 'big')).lease_time_end > time.time() + 600:
+                    raise AssertionError(f"Direct RENEW of {IPv4Address(yiaddr)} was extended past its scope's lease time")
+            renew_time = time.perf_counter() - t0
+            server.journal.close()
+            os.remove(server.journal_file)
+            results.append({
+                'scopes': count,
+                'startup_ms': round(startup_time * 1000, 1),
+                'index_lookup_ns': _per_op_ns(index_time, args.iterations),
+                'linear_lookup_ns': _per_op_ns(linear_time, linear_ops),
+                'relayed_discovers_per_sec': int(len(packets) / discover_time),
+                'direct_renewals_per_sec': int(len(bound) / renew_time),
+            })
+        del os.environ['DHCP_SCOPES_FILE']
+    return results
+
+def bench_metrics(args):
+    # Cost of the metrics instrumentation on the packet path: DISCOVER,
+    # REQUEST and RELEASE cycles through handle_dhcp_packet with metrics off,
+    # on with the default stage sampling and on with every packet timed, plus
+    # the time to render one scrape.
+    dhcp_server.logger.setLevel(logging.WARNING)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_JOURNAL_FSYNC'] = 'never'
+        os.environ['DHCP_LEASE_START_IP'] = '10.0.0.1'
+        os.environ['DHCP_LEASE_END_IP'] = '10.0.255.254'
+        os.environ['DHCP_SUBNET_MASK'] = '255.255.0.0'
+        cycles = max(1, args.iterations // 3)
+        packets = []
+        for i in range(cycles):
+            chaddr = b'\x02' + i.to_bytes(5, 'big')
+            requested = struct.pack('!BBI', 50, 4, int(IPv4Address('10.0.0.1')) + i)
+            packets += [_client_packet(DHCPDISCOVER, i, chaddr), _client_packet(DHCPREQUEST, i, chaddr, requested),
+                        _client_packet(dhcp_server.DHCPRELEASE, i, chaddr)]
+        servers = {}
+        for config in ('off', 'sample=16', 'sample=1'):
+            os.environ['DHCP_METRICS_PORT'] = '0' if config == 'off' else '9067' # Instrumentation only; the listener starts with start()
+            os.environ['DHCP_METRICS_SAMPLE'] = config.partition('=')[2] or '1'
+            os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, f'leases-{len(servers)}.json')
+            servers[config] = DHCPServer()
+            servers[config].sock = _CaptureSocket()
+        # Alternate the servers every cycle so that machine noise hits them alike
+        timings = dict.fromkeys(servers, 0.0)
+        perf_counter = time.perf_counter
+        for start in range(0, len(packets), 3):
+            cycle = packets[start:start + 3]
+            for config, server in servers.items():
+                t0 = perf_counter()
+                for packet in cycle:
+                    server.handle_dhcp_packet(packet, ('0.0.0.0', 68))
+                timings[config] += perf_counter() - t0
+        for config, server in servers.items():
+            row = {'metrics': config, 'packet_ns': _per_op_ns(timings[config], len(packets))}
+            if server.metrics is not None:
+                t0 = time.perf_counter()
+                server.render_metrics()
+                row['render_us'] = round((time.perf_counter() - t0) * 1e6, 1)
+                row['overhead_ns'] = round(row['packet_ns'] - results[0]['packet_ns'], 1)
+                row['overhead_pct'] = round((timings[config] / timings['off'] - 1) * 100, 1)
+            server.journal.close()
+            results.append(row)
+        del os.environ['DHCP_METRICS_PORT']
+        del os.environ['DHCP_METRICS_SAMPLE']
+    return results
+
+def bench_storm(args):
+    # Retransmit storms through handle_dhcp_packet. Every client sends each
+    # DISCOVER and REQUEST `copies` times with the same xid, with and without
+    # the reply cache. Then one looping NIC floods DISCOVERs between
+    # well-behaved clients, with and without the rate limiter
+    # (tests/test_storm.py checks the replies, cache hits and drops).
+    dhcp_server.logger.setLevel(logging.ERROR)
+    copies = 5
+    clients = max(1, args.iterations // (2 * copies))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_JOURNAL_FSYNC'] = 'never'
+        os.environ['DHCP_LEASE_START_IP'] = '10.0.0.1'
+        os.environ['DHCP_LEASE_END_IP'] = '10.0.255.254'
+        os.environ['DHCP_SUBNET_MASK'] = '255.255.0.0'
+        for cache_size in ('0', '4096'):
+            os.environ['DHCP_REPLY_CACHE_SIZE'] = cache_size
+            os.environ['DHCP_MAC_RATE_LIMIT'] = '0'
+            os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, f'retransmit-{cache_size}.json')
+            server = DHCPServer()
+            server.sock = _CaptureSocket()
+            records = 0
+            record = server.journal.record
+            def counting_record(mac, lease_info):
+                nonlocal records
+                records += 1
+                record(mac, lease_info)
+            server.journal.record = counting_record
+            t0 = time.perf_counter()
+            for i in range(clients):
+                chaddr = b'\x02' + i.to_bytes(5, 'big')
+                requested = struct.pack('!BBI', 50, 4, int(IPv4Address('10.0.0.1')) + i)
+                for message_type, options in ((DHCPDISCOVER, b''), (DHCPREQUEST, requested)):
+                    packet = _client_packet(message_type, i, chaddr, options)
+                    for _ in range(copies):
+                        server.handle_dhcp_packet(packet, ('0.0.0.0', 68))
+            elapsed = time.perf_counter() - t0
+            server.journal.close()
+            results.append({
+                'case': f'retransmit x{copies}, cache {"on" if cache_size != "0" else "off"}',
+                'packets': 2 * clients * copies,
+                'packet_ns': _per_op_ns(elapsed, 2 * clients * copies),
+                'journal_records': records,
+                'cache_hits': server.reply_cache.hits if server.reply_cache else 0,
+            })
+
+        for rate_limit in ('0', '10'):
+            os.environ['DHCP_REPLY_CACHE_SIZE'] = '4096'
+            os.environ['DHCP_MAC_RATE_LIMIT'] = rate_limit
+            os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, f'flood-{rate_limit}.json')
+            server = DHCPServer()
+            server.sock = _CaptureSocket()
+            looping_mac = b'\x02\xee\xee\xee\xee\xee'
+            answered = 0
+            flood = 0
+            t0 = time.perf_counter()
+            for i in range(clients):
+                for j in range(20): # The looping NIC sends a new DISCOVER (new xid) 20 times per real client
+                    server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, 1000000 + i * 20 + j, looping_mac), ('0.0.0.0', 68))
+                    flood += 1
+                server.sock.last_reply = None
+                server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, i, b'\x02' + i.to_bytes(5, 'big')), ('0.0.0.0', 68))
+                answered += server.sock.last_reply is not None
+            elapsed = time.perf_counter() - t0
+            server.journal.close()
+            dropped = server.mac_limiter.dropped if server.mac_limiter else 0
+            results.append({
+                'case': f'looping NIC, rate limit {rate_limit}/s' if rate_limit != '0' else 'looping NIC, no rate limit',
+                'packets': flood + clients,
+                'packet_ns': _per_op_ns(elapsed, flood + clients),
+                'flood_dropped': dropped,
+                'clients_answered': answered,
+            })
+        for name in ('DHCP_REPLY_CACHE_SIZE', 'DHCP_MAC_RATE_LIMIT'):
+            del os.environ[name]
+    return results
+
+def _legacy_lease_table(leases):
+    # The lease table as it was before LeaseStore: MAC string -> dict with the
+    # IP as a string, plus an integer IP -> MAC string reverse index
+    lease_pool = {}
+    ip_to_mac = {}
+    for mac, ip, lease_time_end in leases:
+        mac_str = ':'.join(f'{b:02x}' for b in mac.to_bytes(6, 'big'))
+        lease_pool[mac_str] = {'ip_address': str(IPv4Address(ip)), 'lease_time_end': lease_time_end, 'is_static': False}
+        ip_to_mac[ip] = mac_str
+    return lease_pool, ip_to_mac
+
+def bench_leases(args):
+    # Memory per lease and lookup cost at --leases leases for the old dict
+    # layout, LeaseStore and SqliteLeaseStore. A MAC lookup starts from the
+    # packet's chaddr bytes, as in the reply path, so the old layout pays for
+    # formatting its string key. Python-side memory is traced; the SQLite store
+    # keeps its rows in the database file and page cache instead. The expiry
+    # bookkeeping each store needs is traced separately: the heap that
+    # LeaseStore is paired with, and nothing for SQLite, whose index lives in
+    # the database.
+    count = args.leases
+    rng = random.Random(0)
+    start_ip = int(IPv4Address('10.0.0.0'))
+    now = time.time()
+    leases = [(0x020000000000 + mac, start_ip + i, now + 3600) for i, mac in enumerate(rng.sample(range(2 ** 40), count))]
+    probes = rng.sample(leases, min(args.iterations, count))
+    probe_chaddrs = [mac.to_bytes(6, 'big') for mac, _, _ in probes]
+    probe_ips = [ip for _, ip, _ in probes]
+
+    def measure(name, build, get_by_chaddr, get_by_ip, build_expiry=None):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        table = build()
+        build_time = time.perf_counter() - t0
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        t0 = time.perf_counter()
+        found_by_mac = sum(get_by_chaddr(table, chaddr) is not None for chaddr in probe_chaddrs)
+        mac_time = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        found_by_ip = sum(get_by_ip(table, ip) is not None for ip in probe_ips)
+        ip_time = time.perf_counter() - t0
+        assert found_by_mac == found_by_ip == len(probes), f"{name}: lookups missed leases"
+        expiry_bytes = None
+        if build_expiry is not None:
+            tracemalloc.start()
+            expiry = build_expiry(table)
+            expiry_bytes, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del expiry
+        return table, {
+            'store': name,
+            'leases': count,
+            'build_s': round(build_time, 2),
+            'python_bytes_per_lease': round(traced / count),
+            'expiry_bytes_per_lease': round(expiry_bytes / count) if expiry_bytes is not None else None,
+            'mac_lookup_ns': _per_op_ns(mac_time, len(probes)),
+            'ip_lookup_ns': _per_op_ns(ip_time, len(probes)),
+        }
+
+    def fill(store):
+        for mac, ip, lease_time_end in leases:
+            store.put(Lease(mac, ip, lease_time_end))
+        store.sync()
+        return store
+
+    results = []
+    table, row = measure('dict (before)', lambda: _legacy_lease_table(leases),
+                         lambda table, chaddr: table[0].get(':'.join(f'{b:02x}' for b in chaddr)),
+                         lambda table, ip: table[0].get(table[1].get(ip)))
+    results.append(row)
+    del table
+    table, row = measure('LeaseStore', lambda: fill(LeaseStore()),
+                         lambda store, chaddr: store.get(int.from_bytes(chaddr, 'big')),
+                         lambda store, ip: store.holder(ip),
+                         lambda store: LeaseExpiryQueue([(lease.lease_time_end, lease.mac) for lease in store]))
+    results.append(row)
+    del table
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'leases.db')
+        store, row = measure('SqliteLeaseStore', lambda: fill(SqliteLeaseStore(path)),
+                             lambda store, chaddr: store.get(int.from_bytes(chaddr, 'big')),
+                             lambda store, ip: store.holder(ip),
+                             SqliteExpiryIndex)
+        row['db_bytes_per_lease'] = round(os.path.getsize(path) / count)
+        store.close()
+        results.append(row)
+    return results
+
+def bench_routing(args):
+    # Cost of choosing the reply destination (RFC 2131, Section 4.1) for
+    # direct, renewing, relayed and NAKed clients. Each case first goes through
+    # handle_dhcp_packet with a capturing socket, for the request and outcome
+    # to route (tests/test_routing.py checks where each reply goes).
+    dhcp_server.logger.setLevel(logging.ERROR)
+    relay = int(IPv4Address('10.0.0.254'))
+    client_a, client_b = b'\x02\x00\x00\x00\x00\x0a', b'\x02\x00\x00\x00\x00\x0b'
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        os.environ['DHCP_LEASE_START_IP'] = '10.0.0.10'
+        os.environ['DHCP_LEASE_END_IP'] = '10.0.0.200'
+        os.environ['DHCP_SUBNET_MASK'] = '255.255.255.0'
+        os.environ['DHCP_MAC_RATE_LIMIT'] = '0'
+        server = DHCPServer()
+        server.sock = sock = _CaptureSocket()
+        first_ip = int(IPv4Address('10.0.0.10'))
+        renew = _client_packet(DHCPREQUEST, 5, client_a, ciaddr=first_ip, flags=0)
+        cases = [
+            ('DISCOVER, broadcast flag', _client_packet(DHCPDISCOVER, 1, client_a)),
+            ('DISCOVER, no flag', _client_packet(DHCPDISCOVER, 2, client_a, flags=0)),
+            ('DISCOVER via relay', _client_packet(DHCPDISCOVER, 3, client_b, giaddr=relay, flags=0)),
+            ('REQUEST, selecting', _client_packet(DHCPREQUEST, 4, client_a, bytes([50, 4]) + first_ip.to_bytes(4, 'big'))),
+            ('RENEW from ciaddr', renew),
+            ('RENEW retransmitted', renew),
+            ('NAK, direct, ciaddr set', _client_packet(DHCPREQUEST, 6, client_b, ciaddr=first_ip + 50, flags=0)),
+            ('NAK via relay', _client_packet(DHCPREQUEST, 7, client_b, bytes([50, 4, 10, 0, 1, 5]), giaddr=relay, flags=0)),
+        ]
+        for case, data in cases:
+            sent_before = list(server.replies_sent)
+            hits_before = server.reply_cache.hits
+            server.handle_dhcp_packet(data, ('0.0.0.0', 68))
+            reply = DHCPPacket(sock.last_reply)
+            counted = [DESTINATIONS[i] for i, (after, before) in enumerate(zip(server.replies_sent, sent_before)) if after != before]
+
+            request = DHCPPacket(data)
+            outcome = dhcp_server.OUTCOME_NAK if reply.message_type == dhcp_server.DHCPNAK else dhcp_server.OUTCOME_ACK
+            t0 = time.perf_counter()
+            for _ in range(args.iterations):
+                server._reply_destination(request, outcome)
+            results.append({
+                'case': case,
+                'destination': ','.join(counted),
+                'address': f'{sock.last_addr[0]}:{sock.last_addr[1]}',
+                'reply_flags': f'{reply.flags:#06x}',
+                'from_cache': server.reply_cache.hits > hits_before,
+                'route_ns': _per_op_ns(time.perf_counter() - t0, args.iterations),
+            })
+        server.journal.close()
+        del os.environ['DHCP_MAC_RATE_LIMIT']
+    return results
+
+def bench_logging(args):
+    # Packet-path latency of handle_dhcp_packet with logging off, written
+    # synchronously by the handler, with repeat suppression (the default),
+    # handed to the queue listener, and queued with repeat suppression. The workload is a few thousand clients running
+    # DISCOVER/REQUEST/RELEASE interleaved with one looping client, and the
+    # log goes to a real file so the synchronous case pays for the write.
+    configs = [
+        # (name, log level, environment)
+        ('off', logging.WARNING, {}),
+        ('sync', logging.INFO, {'DHCP_LOG_SUMMARY_INTERVAL': '0'}),
+        ('sync+suppress', logging.INFO, {}),
+        ('queue', logging.INFO, {'DHCP_LOG_QUEUE': '1', 'DHCP_LOG_SUMMARY_INTERVAL': '0'}),
+        ('queue+suppress', logging.INFO, {'DHCP_LOG_QUEUE': '1'}),
+    ]
+    clients = max(1, min(args.iterations // 5, 2000))
+    packets = []
+    for i in range(clients):
+        mac = b'\x02\x00' + i.to_bytes(4, 'big')
+        ip = int(IPv4Address('10.0.0.10')) + i
+        packets.append(_client_packet(DHCPDISCOVER, 3 * i, mac))
+        packets.append(_client_packet(DHCPREQUEST, 3 * i + 1, mac, bytes([50, 4]) + ip.to_bytes(4, 'big')))
+        packets.append(_client_packet(DHCPRELEASE, 3 * i + 2, mac, ciaddr=ip, flags=0))
+        packets.append(_client_packet(DHCPDISCOVER, 1000000 + i, b'\x02\xff\xff\xff\xff\xff'))
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], dhcp_server.logger.level
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, log_level, env in configs:
+            saved = {key: os.environ.get(key) for key in list(env) + ['DHCP_MAC_RATE_LIMIT', 'DHCP_REPLY_CACHE_SIZE']}
+            os.environ.update(env, DHCP_MAC_RATE_LIMIT='0', DHCP_REPLY_CACHE_SIZE='0')
+            os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, f'{name}.json')
+            os.environ['DHCP_LEASE_START_IP'] = '10.0.0.10'
+            os.environ['DHCP_LEASE_END_IP'] = str(IPv4Address('10.0.0.10') + clients + 10)
+            os.environ['DHCP_SUBNET_MASK'] = '255.0.0.0'
+            log_file = os.path.join(tmp, f'{name}.log')
+            handler = logging.FileHandler(log_file)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+            root.handlers = [handler]
+            try:
+                dhcp_server.logger.setLevel(logging.WARNING)
+                server = DHCPServer()
+                dhcp_server.logger.setLevel(log_level)
+                server.sock = _CaptureSocket()
+                server.start_logging()
+                timings = []
+                for data in packets:
+                    t0 = time.perf_counter_ns()
+                    server.handle_dhcp_packet(data, ('0.0.0.0', 68))
+                    timings.append(time.perf_counter_ns() - t0)
+                t0 = time.perf_counter()
+                server.stop_logging()
+                drain = time.perf_counter() - t0
+                server.journal.close()
+            finally:
+                handler.close()
+                root.handlers = handlers
+                dhcp_server.logger.setLevel(level)
+                for key, value in saved.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+            with open(log_file) as f:
+                lines = sum(1 for _ in f)
+            timings.sort()
+            results.append({
+                'config': name,
+                'packets': len(packets),
+                'mean_ns': round(sum(timings) / len(timings), 1),
+                'p99_ns': timings[int(len(timings) * 0.99)],
+                'drain_ms': round(drain * 1e3, 2),
+                'log_lines': lines,
+                'suppressed': server.log_suppressor.suppressed if server.log_suppressor else 0,
+            })
+    return results
+
+def bench_reload(args):
+    # Live reloads against a cold start with the same leases: a /16 scope with
+    # tens of thousands of leases is reloaded with changed options, a grown and
+    # a shrunk range, an added relayed scope, an added and a removed reservation
+    # and a broken config (tests/test_reload.py checks that each reload keeps
+    # the leases and applies the change).
+    dhcp_server.logger.setLevel(logging.WARNING)
+    count = 40000
+    start_ip, end_ip = int(IPv4Address('10.1.0.10')), int(IPv4Address('10.1.199.255'))
+    base_config = {
+        'DHCP_LEASE_START_IP': '10.1.0.10',
+        'DHCP_LEASE_END_IP': '10.1.199.255',
+        'DHCP_SUBNET_MASK': '255.255.0.0',
+        'DHCP_ROUTER_IP': '10.1.0.1',
+        'DHCP_DNS_SERVERS': '10.1.0.2',
+        'DHCP_MAC_RATE_LIMIT': '0',
+    }
+    static_mac, static_ip = 0x02ffffffff01, int(IPv4Address('10.1.220.5')) # Outside the range until it grows
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        os.environ['DHCP_JOURNAL_FSYNC'] = 'never'
+        os.environ['DHCP_CONFIG_FILE'] = config_path = os.path.join(tmp, 'config')
+        scopes_path = os.path.join(tmp, 'scopes.json')
+        reserved_mac, reserved_ip = 0x02bb00000001, start_ip + count + 100
+        reservations_path, no_reservations_path = os.path.join(tmp, 'reservations.csv'), os.path.join(tmp, 'none.csv')
+        with open(reservations_path, 'w') as f:
+            f.write(f'mac,ip\n{format_mac(reserved_mac)},{IPv4Address(reserved_ip)}\n')
+        with open(no_reservations_path, 'w') as f:
+            f.write('mac,ip\n')
+
+        def write_config(**changes):
+            settings = dict(base_config, **changes)
+            with open(config_path, 'w') as f:
+                f.write('# Written by dhcp_bench.py reload\n')
+                f.writelines(f'{key}="{value}"\n' for key, value in settings.items() if value is not None)
+
+        write_config()
+        server = DHCPServer()
+        now = time.time()
+        for i in range(count):
+            server._bind_lease(0x020000000000 + i, start_ip + i, now + 3600)
+        server._bind_lease(static_mac, static_ip, now + 365 * 24 * 3600, is_static=True)
+        with open(os.environ['DHCP_LEASES_FILE'], 'w') as f:
+            json.dump({format_mac(lease.mac): {'ip_address': str(IPv4Address(lease.ip)), 'lease_time_end': lease.lease_time_end, 'is_static': lease.is_static}
+                       for lease in server.leases}, f)
+
+        t0 = time.perf_counter()
+        cold = DHCPServer()
+        cold_start = time.perf_counter() - t0
+        cold.journal.close()
+
+        relayed_scopes = [{'subnet': '10.1.0.0/16', 'start_ip': '10.1.0.10', 'end_ip': '10.1.199.255'},
+                          {'subnet': '10.2.0.0/24', 'start_ip': '10.2.0.10', 'end_ip': '10.2.0.250', 'router': '10.2.0.1'}]
+        steps = [
+            # (step, config changes, scopes file entries or None)
+            ('options', {'DHCP_DNS_SERVERS': '10.1.0.3,10.1.0.4', 'DHCP_LEASE_TIME': '7200'}, None),
+            ('grow range', {'DHCP_LEASE_END_IP': '10.1.239.255'}, None),
+            ('shrink range', {'DHCP_LEASE_END_IP': '10.1.99.255'}, None),
+            ('add relayed scope', {}, relayed_scopes),
+            ('reserve', {'DHCP_RESERVATIONS_FILE': reservations_path}, None),
+            ('un-reserve', {'DHCP_RESERVATIONS_FILE': no_reservations_path}, None),
+            ('broken config', {'DHCP_ROUTER_IP': 'not-an-address'}, None),
+        ]
+        for step, changes, scopes in steps:
+            write_config(**changes)
+            if scopes is not None:
+                with open(scopes_path, 'w') as f:
+                    json.dump(scopes, f)
+                write_config(DHCP_SCOPES_FILE=scopes_path, **changes)
+            server._reload_requested = True # As the SIGHUP handler does
+            t0 = time.perf_counter()
+            server._run_periodic_tasks()
+            elapsed = time.perf_counter() - t0
+            results.append({
+                'step': step,
+                'leases': len(server.leases),
+                'scopes': len(server.scope_index),
+                'pool_free': sum(scope.ip_pool.free_count for scope in server.scope_index),
+                'reload_ms': round(server.last_reload_seconds * 1e3, 2) if step != 'broken config' else None,
+                'tick_ms': round(elapsed * 1e3, 2),
+                'cold_start_ms': round(cold_start * 1e3, 1),
+            })
+        server.journal.close()
+        del os.environ['DHCP_CONFIG_FILE']
+    for key in base_config:
+        os.environ.pop(key, None)
+    return results
+
+def bench_reservations(args):
+    # Bulk import of 100k reservations from CSV and JSON, then serving them:
+    # every reserved client must be offered and acknowledged its own address
+    # without a single lease or journal record being written, while dynamic
+    # clients are never offered a reserved address. Static leases in
+    # leases.json, which are served the same way, and dynamic clients, which
+    # do write a lease, are measured alongside, as are direct renewals from
+    # reserved clients behind a relay.
+    dhcp_server.logger.setLevel(logging.WARNING)
+    rng = random.Random(0)
+    count = 100000
+    network = IPv4Network('10.64.0.0/14')
+    start_ip, end_ip = int(network.network_address) + 10, int(network.broadcast_address) - 5
+    reserved = dict(zip((0x020000000000 + mac for mac in rng.sample(range(2 ** 40), count)),
+                        rng.sample(range(int(network.network_address) + 1, int(network.broadcast_address)), count)))
+    served = min(args.iterations, count)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'reservations.csv')
+        json_path = os.path.join(tmp, 'reservations.json')
+        with open(csv_path, 'w') as f:
+            f.write('mac,ip,hostname\n')
+            f.writelines(f'{format_mac(mac)},{IPv4Address(ip)},host{i}\n' for i, (mac, ip) in enumerate(reserved.items()))
+        with open(json_path, 'w') as f:
+            json.dump([{'mac': format_mac(mac), 'ip': str(IPv4Address(ip))} for mac, ip in reserved.items()], f)
+        static_leases = {format_mac(mac): {'ip_address': str(IPv4Address(ip)), 'lease_time_end': time.time() + 3600, 'is_static': True}
+                         for mac, ip in reserved.items()}
+        os.environ.update(DHCP_LEASE_START_IP=str(IPv4Address(start_ip)), DHCP_LEASE_END_IP=str(IPv4Address(end_ip)),
+                          DHCP_SUBNET_MASK=str(network.netmask), DHCP_JOURNAL_FSYNC='never', DHCP_MAC_RATE_LIMIT='0', DHCP_REPLY_CACHE_SIZE='0')
+        configs = [
+            # (source, reservations file, leases.json contents)
+            ('csv', csv_path, {}),
+            ('json', json_path, {}),
+            ('static leases', '', static_leases),
+            ('dynamic', '', {}),
+        ]
+        for source, path, leases in configs:
+            os.environ['DHCP_LEASES_FILE'] = leases_path = os.path.join(tmp, f'{source}.json')
+            with open(leases_path, 'w') as f:
+                json.dump(leases, f)
+            import_ms = memory = None
+            if path:
+                t0 = time.perf_counter()
+                table = ReservationTable.load(path)
+                import_ms = round((time.perf_counter() - t0) * 1e3, 1)
+                if table.by_mac != reserved:
+                    raise AssertionError(f"{source}: imported {len(table)} reservations, expected {count}")
+                del table
+                tracemalloc.start() # Separately: tracing slows the import down several times
+                table = ReservationTable.load(path)
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                del table
+                os.environ['DHCP_RESERVATIONS_FILE'] = path
+            else:
+                os.environ.pop('DHCP_RESERVATIONS_FILE', None)
+            t0 = time.perf_counter()
+            server = DHCPServer()
+            startup = time.perf_counter() - t0
+            server.sock = _CaptureSocket()
+            pool = server.default_scope.ip_pool
+            in_range = sum(1 for ip in reserved.values() if start_ip <= ip <= end_ip) if source != 'dynamic' else 0
+            if pool.free_count != pool.size - in_range:
+                raise AssertionError(f"{source}: {pool.free_count} free addresses, expected {pool.size - in_range}")
+
+            clients = list(reserved.items())[:served]
+            leases_before, records_before = len(server.leases), server.journal.records_since_snapshot
+            discover_time = request_time = 0.0
+            for i, (mac, ip) in enumerate(clients):
+                chaddr = mac.to_bytes(6, 'big')
+                t0 = time.perf_counter()
+                server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, 2 * i, chaddr), ('0.0.0.0', 68))
+                t1 = time.perf_counter()
+                offer = DHCPPacket(server.sock.last_reply)
+                server.handle_dhcp_packet(_client_packet(DHCPREQUEST, 2 * i + 1, chaddr, bytes([50, 4]) + offer.yiaddr.to_bytes(4, 'big')), ('0.0.0.0', 68))
+                t2 = time.perf_counter()
+                discover_time += t1 - t0
+                request_time += t2 - t1
+                ack = DHCPPacket(server.sock.last_reply)
+                if ack.message_type != DHCPACK or (source != 'dynamic' and ack.yiaddr != ip):
+                    raise AssertionError(f"{source}: {format_mac(mac)} got {IPv4Address(ack.yiaddr)}, reserved {IPv4Address(ip)}")
+            server.journal.commit()
+            writes = server.journal.records_since_snapshot - records_before
+            if source != 'dynamic' and (writes or len(server.leases) != leases_before):
+                raise AssertionError(f"{source}: serving reservations wrote {writes} journal records")
+
+            if source != 'dynamic':
+                for i in range(1000):
+                    server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, i, (0x04 << 40 | i).to_bytes(6, 'big')), ('0.0.0.0', 68))
+                    offered_ip = DHCPPacket(server.sock.last_reply).yiaddr
+                    if offered_ip in server.reservations.by_ip:
+                        raise AssertionError(f"{source}: dynamic client offered reserved IP {IPv4Address(offered_ip)}")
+            server.journal.close()
+            results.append({
+                'source': source,
+                'reservations': len(server.reservations),
+                'import_ms': import_ms,
+                'table_bytes_per_entry': round(memory / count, 1) if memory else None,
+                'startup_ms': round(startup * 1e3, 1),
+                'pool_free': pool.free_count,
+                'discover_us': round(discover_time * 1e6 / served, 1),
+                'request_us': round(request_time * 1e6 / served, 1),
+                'journal_records': writes,
+            })
+
+        # A reserved client bound through a relay renews by unicast (giaddr 0,
+        # ciaddr set) and must be acknowledged from its relay's scope, as must a
+        # static lease there, still without writing anything.
+        scopes_path = os.path.join(tmp, 'scopes.json')
+        with open(scopes_path, 'w') as f:
+            json.dump([{'name': 'local', 'subnet': '10.0.0.0/24', 'start_ip': '10.0.0.10', 'end_ip': '10.0.0.200', 'router': '10.0.0.1'},
+                       {'name': 'vlan20', 'subnet': '10.0.20.0/24', 'start_ip': '10.0.20.10', 'end_ip': '10.0.20.200', 'router': '10.0.20.1',
+                        'lease_time': 600}], f)
+        with open(csv_path, 'w') as f:
+            f.write('mac,ip\n02:00:00:00:00:01,10.0.20.50\n')
+        os.environ.update(DHCP_SCOPES_FILE=scopes_path, DHCP_RESERVATIONS_FILE=csv_path, DHCP_LEASES_FILE=os.path.join(tmp, 'relayed.json'))
+        with open(os.environ['DHCP_LEASES_FILE'], 'w') as f:
+            json.dump({'02:00:00:00:00:02': {'ip_address': '10.0.20.51', 'lease_time_end': time.time() + 3600, 'is_static': True}}, f)
+        server = DHCPServer()
+        server.sock = _CaptureSocket()
+        relay = int(IPv4Address('10.0.20.1'))
+        leases_before, records_before = len(server.leases), server.journal.records_since_snapshot
+        renew_time = 0.0
+        for mac, ip in ((0x020000000001, int(IPv4Address('10.0.20.50'))), (0x020000000002, int(IPv4Address('10.0.20.51')))):
+            chaddr = mac.to_bytes(6, 'big')
+            server.handle_dhcp_packet(_client_packet(DHCPDISCOVER, 1, chaddr, giaddr=relay, flags=0), ('10.0.20.1', 67))
+            server.handle_dhcp_packet(_client_packet(DHCPREQUEST, 2, chaddr, bytes([50, 4]) + ip.to_bytes(4, 'big'), giaddr=relay, flags=0), ('10.0.20.1', 67))
+            ack = DHCPPacket(server.sock.last_reply)
+            if ack.message_type != DHCPACK or ack.yiaddr != ip:
+                raise AssertionError(f"relayed: {format_mac(mac)} got {IPv4Address(ack.yiaddr)} through the relay, reserved {IPv4Address(ip)}")
+            t0 = time.perf_counter()
+            for i in range(served):
+                server.handle_dhcp_packet(_client_packet(DHCPREQUEST, i + 3, chaddr, ciaddr=ip, flags=0), (str(IPv4Address(ip)), 68))
+            renew_time += time.perf_counter() - t0
+            ack = DHCPPacket(server.sock.last_reply)
+            if ack.message_type != DHCPACK or ack.yiaddr != ip or ack.get(3) != IPv4Address('10.0.20.1').packed:
+                raise AssertionError(f"relayed: direct RENEW of {format_mac(mac)} got message type {ack.message_type} "
+                                     f"for {IPv4Address(ack.yiaddr)}, reserved {IPv4Address(ip)}")
+        server.journal.commit()
+        writes = server.journal.records_since_snapshot - records_before
+        if writes or len(server.leases) != leases_before:
+            raise AssertionError(f"relayed: renewing reservations wrote {writes} journal records")
+        server.journal.close()
+        results.append({
+            'source': 'relayed renewal',
+            'reservations': len(server.reservations),
+            'request_us': round(renew_time * 1e6 / (2 * served), 1),
+            'journal_records': writes,
+        })
+        for key in ('DHCP_SCOPES_FILE', 'DHCP_RESERVATIONS_FILE', 'DHCP_MAC_RATE_LIMIT', 'DHCP_REPLY_CACHE_SIZE'):
+            os.environ.pop(key, None)
+    return results
+
+BENCHMARKS = {
+    'reservations': bench_reservations,
+    'reload': bench_reload,
+    'logging': bench_logging,
+    'routing': bench_routing,
+    'leases': bench_leases,
+    'storm': bench_storm,
+    'metrics': bench_metrics,
+    'scopes': bench_scopes,
+    'serving': bench_serving,
+    'parse': bench_parse,
+    'replies': bench_replies,
+    'expiry': bench_expiry,
+    'journal': bench_journal,
+    'pool': bench_pool,
+    'startup': bench_startup,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="DHCP server micro-benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--iterations', type=int, default=10000, help="Operations per measurement where applicable")
+    parser.add_argument('--port', type=int, default=16767, help="Server port for loopback benchmarks (the client uses port + 1)")
+    parser.add_argument('--workers', type=int, default=max(2, os.cpu_count() or 1), help="Worker processes for the multiprocess serving mode")
+    parser.add_argument('--leases', type=int, default=1000000, help="Lease table size for the leases benchmark")
+    parser.add_argument('--json', action='store_true', help="Print machine-readable JSON instead of a table")
+    args = parser.parse_args()
+
+    results = BENCHMARKS[args.benchmark](args)
+    if args.json:
+        print(json.dumps({'benchmark': args.benchmark, 'results': results}, indent=2))
+        return
+
+    columns = list(dict.fromkeys(c for row in results for c in row))
+    print('  '.join(f'{c:>20}' for c in columns))
+    for row in results:
+        print('  '.join(f'{str(row.get(c, "")):>20}' for c in columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+import argparse
+import json
+import os
+import random
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from ipaddress import IPv4Address
+
+import dhcp_server
+from dhcp_server import DHCPACK, DHCPDECLINE, DHCPDISCOVER, DHCPNAK, DHCPOFFER, DHCPRELEASE, DHCPREQUEST, DHCPPacket, DHCPServer
+
+# DHCP client simulator for load and latency testing. Synthetic clients walk
+# through DISCOVER -> REQUEST -> RENEW ... -> RELEASE (or DECLINE or abandon the offer),
+# either against a DHCPServer in this process or a live server over UDP.
+# Usage: python3 src/dhcp_loadgen.py [--mode inprocess|live] [--clients N] [--json]
+
+ARCH_CODES = {'none': None, 'bios': 0, 'efi': 7} # Named option 93 client architectures
+LABELS = ('DISCOVER', 'REQUEST', 'RENEW', 'RELEASE', 'DECLINE')
+
+def build_client_packet(message_type, xid, chaddr, ciaddr=0, giaddr=0, options=b''):
+    # BOOTREQUEST as a client (or, with giaddr, a relay agent) sends it; options are pre-encoded TLVs
+    header = struct.pack('!BBBBIHHIIII', 1, 1, 6, 1 if giaddr else 0, xid, 0, 0x8000, ciaddr, 0, 0, giaddr)
+    return (header + chaddr.ljust(16, b'\x00') + b'\x00' * 192
+            + DHCPPacket.MAGIC_COOKIE + bytes([53, 1, message_type]) + options + b'\xff')
+
+def parse_arch_mix(spec):
+    # "bios=50,efi=30,none=20" -> ([arch code or None, ...], [weight, ...]); numeric codes are accepted too
+    archs, weights = [], []
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        archs.append(ARCH_CODES[name] if name in ARCH_CODES else int(name))
+        weights.append(float(weight or 1))
+    return archs, weights
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class SyntheticClient:
+    __slots__ = ('mac', 'arch_option', 'state', 'pending', 'xid', 'ip', 'server_id', 'renewals', 'discover_timeouts')
+
+    def __init__(self, mac, arch):
+        self.mac = mac
+        self.arch_option = b'' if arch is None else struct.pack('!BBH', 93, 2, arch)
+        self.state = 'init' # init -> offered -> bound -> (init | parked)
+        self.pending = None # Label of the message awaiting a reply
+        self.xid = 0
+        self.ip = 0
+        self.server_id = 0
+        self.renewals = 0
+        self.discover_timeouts = 0 # Unanswered DISCOVERs in a row
+
+class LoadGenerator:
+    # Produces the next message for each synthetic client, applies replies to
+    # the client state machines and keeps the statistics. Only `concurrency`
+    # clients are active at once; a client that finishes a cycle or fails goes
+    # to the back of the queue so that every MAC gets its turn. The pool counts
+    # as exhausted only on evidence from the server: a NAK for an offered
+    # address, a DISCOVER it handled without offering anything (in-process),
+    # or a client whose DISCOVERs went unanswered discover_retries times in a
+    # row. A single lost packet is just a timeout.
+
+    def __init__(self, client_count, concurrency, arch_mix, renewals, release_ratio, decline_ratio, giaddr=0, seed=0, request_ratio=1.0,
+                 discover_retries=3):
+        self.rng = random.Random(seed)
+        archs, weights = arch_mix
+        clients = [SyntheticClient(b'\x02' + i.to_bytes(5, 'big'), self.rng.choices(archs, weights)[0]) for i in range(client_count)]
+        self.active = deque(clients[:concurrency])
+        self.waiting = deque(clients[concurrency:])
+        self.renewals = renewals
+        self.release_ratio = release_ratio
+        self.decline_ratio = decline_ratio
+        self.request_ratio = request_ratio
+        self.discover_retries = discover_retries
+        self.giaddr = giaddr
+        self._xid = self.rng.getrandbits(32)
+
+        self.latencies = {label: [] for label in LABELS}
+        self.sent = {label: 0 for label in LABELS}
+        self.replies = {'OFFER': 0, 'ACK': 0, 'NAK': 0}
+        self.timeouts = {label: 0 for label in LABELS}
+        self.no_offers = 0 # DISCOVERs the server handled without an offer
+        self.shed = 0 # Packets the server dropped by its rate limits or offer hold limit (in-process)
+        self.abandoned = 0 # Offers neither requested nor declined
+        self.bound = 0 # Clients currently holding a lease
+        self.exhausted_at = None # Leases held when the pool first ran out
+        self.exhausted_by = None # What showed it: 'NAK', 'no offer' or 'retry limit'
+
+    def next_client(self):
+        return self.active.popleft() if self.active else None
+
+    def requeue(self, client):
+        if client.state == 'parked' or client.state == 'init':
+            if client.state == 'init':
+                self.waiting.append(client)
+            if self.waiting:
+                self.active.append(self.waiting.popleft())
+        else:
+            self.active.append(client)
+
+    def next_message(self, client):
+        # (label, packet, expects_reply) for the client's next step
+        self._xid = (self._xid + 1) & 0xffffffff
+        client.xid = self._xid
+        server_id = struct.pack('!BBI', 54, 4, client.server_id)
+        if client.state == 'init':
+            label, message_type, ciaddr, options = 'DISCOVER', DHCPDISCOVER, 0, client.arch_option
+        elif client.state == 'offered':
+            requested = struct.pack('!BBI', 50, 4, client.ip)
+            roll = self.rng.random()
+            if roll < self.decline_ratio:
+                label, message_type, ciaddr, options = 'DECLINE', DHCPDECLINE, 0, requested + server_id
+                client.state = 'init'
+            elif roll >= self.decline_ratio + (1 - self.decline_ratio) * self.request_ratio:
+                # Walks away from the offer, like a PXE ROM that never gets to REQUEST
+                self.abandoned += 1
+                client.state = 'init'
+                return None
+            else:
+                label, message_type, ciaddr, options = 'REQUEST', DHCPREQUEST, 0, requested + server_id + client.arch_option
+        elif client.renewals < self.renewals:
+            label, message_type, ciaddr, options = 'RENEW', DHCPREQUEST, client.ip, client.arch_option
+        elif self.rng.random() < self.release_ratio:
+            label, message_type, ciaddr, options = 'RELEASE', DHCPRELEASE, client.ip, server_id
+            self.bound -= 1
+            client.state = 'init'
+        else:
+            client.state = 'parked' # Keeps its lease for the rest of the run
+            return None
+        self.sent[label] += 1
+        client.pending = label if label not in ('DECLINE', 'RELEASE') else None
+        return label, build_client_packet(message_type, client.xid, client.mac, ciaddr, self.giaddr, options), client.pending is not None
+
+    def on_reply(self, client, reply, latency):
+        label = client.pending
+        client.pending = None
+        self.latencies[label].append(latency)
+        message_type = reply.message_type
+        if message_type == DHCPOFFER and label == 'DISCOVER':
+            self.replies['OFFER'] += 1
+            client.ip = reply.yiaddr
+            client.server_id = reply.server_identifier or 0
+            client.state = 'offered'
+            client.discover_timeouts = 0
+        elif message_type == DHCPACK:
+            self.replies['ACK'] += 1
+            if label == 'REQUEST':
+                self.bound += 1
+                client.state = 'bound'
+                client.renewals = 0
+            else:
+                client.renewals += 1
+        elif message_type == DHCPNAK:
+            self.replies['NAK'] += 1
+            if client.state == 'bound':
+                self.bound -= 1
+            elif label == 'REQUEST': # The offered address went to someone else
+                self._exhausted('NAK')
+            client.state = 'init'
+
+    def on_timeout(self, client):
+        label = client.pending
+        client.pending = None
+        self.timeouts[label] += 1
+        if label == 'DISCOVER':
+            client.discover_timeouts += 1
+            if client.discover_timeouts >= self.discover_retries:
+                client.discover_timeouts = 0
+                self._exhausted('retry limit')
+        if label != 'RENEW': # A bound client simply tries to renew again later
+            client.state = 'init'
+
+    def on_no_offer(self, client):
+        # In-process: the server handled the DISCOVER and had nothing to offer
+        client.pending = None
+        self.no_offers += 1
+        self._exhausted('no offer')
+
+    def on_shed(self, client):
+        # In-process: the server dropped the packet on purpose, which says nothing about the pool
+        label = client.pending
+        client.pending = None
+        self.shed += 1
+        if label != 'RENEW': # A bound client simply tries to renew again later
+            client.state = 'init'
+
+    def _exhausted(self, reason):
+        if self.exhausted_at is None:
+            self.exhausted_at = self.bound
+            self.exhausted_by = reason
+
+    def record_sent_only(self, label, latency):
+        # RELEASE and DECLINE get no reply; in-process their handling time is still known
+        if latency is not None:
+            self.latencies[label].append(latency)
+
+    def report(self, elapsed):
+        total_sent = sum(self.sent.values())
+        total_replies = sum(self.replies.values())
+        latency_us = {}
+        for label, values in self.latencies.items():
+            if not values:
+                continue
+            values.sort()
+            latency_us[label] = {
+                'count': len(values),
+                'p50': round(percentile(values, 0.50) * 1e6, 1),
+                'p99': round(percentile(values, 0.99) * 1e6, 1),
+                'p999': round(percentile(values, 0.999) * 1e6, 1),
+                'max': round(values[-1] * 1e6, 1),
+            }
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'packets_sent': total_sent,
+            'replies': total_replies,
+            'packets_per_sec': int(total_sent / elapsed) if elapsed else 0,
+            'replies_per_sec': int(total_replies / elapsed) if elapsed else 0,
+            'sent_by_type': self.sent,
+            'replies_by_type': self.replies,
+            'timeouts_by_type': {label: count for label, count in self.timeouts.items() if count},
+            'discovers_without_offer': self.no_offers,
+            'shed_by_server': self.shed,
+            'latency_us': latency_us,
+            'offers_abandoned': self.abandoned,
+            'leases_held': self.bound,
+            'pool_exhausted_at_leases': self.exhausted_at,
+            'pool_exhausted_by': self.exhausted_by,
+        }
+
+class _StubSocket:
+    # Stands in for the server socket in-process: keeps the replies instead of sending them
+    def __init__(self):
+        self.replies = []
+
+    def sendto(self, data, addr):
+        self.replies.append(data)
+
+def _server_env(args):
+    # Lease range 10.0.0.1 onwards in the smallest subnet that holds it. Synthetic
+    # clients send far more often than real ones, so the per-client and
+    # per-relay rate limits are off unless asked for.
+    prefix = 32 - (args.pool_size + 1).bit_length()
+    env = {
+        'DHCP_LEASE_START_IP': '10.0.0.1',
+        'DHCP_LEASE_END_IP': str(IPv4Address('10.0.0.1') + args.pool_size - 1),
+        'DHCP_SUBNET_MASK': str(IPv4Address((0xffffffff << (32 - prefix)) & 0xffffffff)),
+    }
+    if not args.server_rate_limits:
+        env['DHCP_MAC_RATE_LIMIT'] = env['DHCP_RELAY_RATE_LIMIT'] = '0'
+    return env
+
+def _shed(server):
+    # Packets the server dropped so far without them saying anything about the
+    # pool: rate limited, or DISCOVERs refused while too many offers are held
+    return (sum(limiter.dropped for limiter in (server.mac_limiter, server.relay_limiter) if limiter is not None)
+            + sum(scope.offer_holds.refused for scope in server.scope_index))
+
+def run_inprocess(args, generator):
+    # Drive DHCPServer.handle_dhcp_packet directly; latency is the handling time of each packet
+    dhcp_server.logger.setLevel(args.server_log_level)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(_server_env(args))
+        os.environ['DHCP_LEASES_FILE'] = os.path.join(tmp, 'leases.json')
+        server = DHCPServer()
+        server.sock = sock = _StubSocket()
+        server.journal.start_writer() # As in the serving loop, journal commits happen off the reply path
+        addr = ('0.0.0.0', 68)
+        sent = 0
+        t0 = time.perf_counter()
+        try:
+            while sent < args.transactions:
+                client = generator.next_client()
+                if client is None:
+                    break # Every client is parked
+                message = generator.next_message(client)
+                if message is not None:
+                    label, packet, expects_reply = message
+                    dropped = _shed(server)
+                    started = time.perf_counter()
+                    server.handle_dhcp_packet(packet, addr)
+                    latency = time.perf_counter() - started
+                    sent += 1
+                    if not expects_reply:
+                        generator.record_sent_only(label, latency)
+                    elif sock.replies:
+                        generator.on_reply(client, DHCPPacket(sock.replies[-1]), latency)
+                    elif _shed(server) != dropped:
+                        generator.on_shed(client)
+                    elif label == 'DISCOVER':
+                        generator.on_no_offer(client)
+                    else:
+                        generator.on_timeout(client)
+                    sock.replies.clear()
+                    server._run_periodic_tasks()
+                generator.requeue(client)
+            results = generator.report(time.perf_counter() - t0)
+            scopes = list(server.scope_index)
+            results['server'] = { # Pool utilisation as the server sees it at the end of the run
+                'pool_size': sum(scope.ip_pool.size for scope in scopes),
+                'leases': len(server.leases),
+                'offer_holds': sum(len(scope.offer_holds) for scope in scopes),
+                'free_addresses': sum(scope.ip_pool.free_count for scope in scopes),
+                'replies_by_destination': dict(zip(dhcp_server.DESTINATIONS, server.replies_sent)),
+            }
+            return results
+        finally:
+            server.journal.close()
+
+def _spawn_server(args):
+    env = dict(os.environ, DHCP_SERVER_IP=args.target, DHCP_SERVER_PORT=str(args.server_port), DHCP_CLIENT_PORT=str(args.client_port),
+               DHCP_RELAY_PORT=str(args.client_port), # Relayed replies come back to the load generator's socket
+               DHCP_LEASES_FILE=os.path.join(args.spawn_dir, 'leases.json'), **_server_env(args))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dhcp_server.py')
+    return subprocess.Popen([sys.executable, script], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def _wait_for_server(sock, target, giaddr, timeout):
+    # Probe with a DISCOVER from a reserved MAC until the server answers, then release the offer
+    probe_mac = b'\x02\xff\xff\xff\xff\xff'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sock.sendto(build_client_packet(DHCPDISCOVER, 0, probe_mac, giaddr=giaddr), target)
+        if select.select([sock], [], [], 0.1)[0]:
+            sock.recv(2048)
+            sock.sendto(build_client_packet(DHCPRELEASE, 0, probe_mac, giaddr=giaddr), target)
+            return
+    raise RuntimeError(f"No DHCP server answering on {target[0]}:{target[1]}")
+
+def run_live(args, generator):
+    # Talk to a server over UDP as a relay agent: the server unicasts replies
+    # to giaddr, which would otherwise go to client addresses (renewals) that
+    # do not exist on this host. Replies arrive on the client port and are
+    # matched to their transaction by xid. Up to `concurrency` transactions
+    # are in flight; one not answered within the timeout counts as a timeout.
+    target = (args.target, args.server_port)
+    if not generator.giaddr:
+        route = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        route.connect(target) # No packet is sent; this only picks the local address facing the server
+        generator.giaddr = int(IPv4Address(route.getsockname()[0]))
+        route.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.bind(('', args.client_port))
+    sock.setblocking(False)
+    server = _spawn_server(args) if args.spawn else None
+    try:
+        _wait_for_server(sock, target, generator.giaddr, 10)
+        inflight = {} # xid -> (client, sent_at)
+        sent = 0
+        t0 = time.perf_counter()
+        while (sent < args.transactions and (generator.active or inflight)) or inflight:
+            while sent < args.transactions and len(inflight) < args.concurrency:
+                client = generator.next_client()
+                if client is None:
+                    break
+                message = generator.next_message(client)
+                if message is None:
+                    generator.requeue(client)
+                    continue
+                label, packet, expects_reply = message
+                sock.sendto(packet, target)
+                sent += 1
+                if expects_reply:
+                    inflight[client.xid] = (client, time.perf_counter())
+                else:
+                    generator.record_sent_only(label, None)
+                    generator.requeue(client)
+
+            if select.select([sock], [], [], args.timeout / 4)[0]:
+                while True:
+                    try:
+                        data = sock.recv(2048)
+                    except BlockingIOError:
+                        break
+                    try:
+                        reply = DHCPPacket(data)
+                    except ValueError:
+                        continue
+                    entry = inflight.pop(reply.xid, None)
+                    if entry is None or reply.chaddr != entry[0].mac:
+                        continue # Not ours, or a late reply to a transaction already timed out
+                    client, sent_at = entry
+                    generator.on_reply(client, reply, time.perf_counter() - sent_at)
+                    generator.requeue(client)
+
+            now = time.perf_counter()
+            for xid, (client, sent_at) in list(inflight.items()):
+                if now - sent_at > args.timeout:
+                    del inflight[xid]
+                    generator.on_timeout(client)
+                    generator.requeue(client)
+        return generator.report(time.perf_counter() - t0)
+    finally:
+        sock.close()
+        if server is not None:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=10)
+
+def main():
+    parser = argparse.ArgumentParser(description="DHCP load generator")
+    parser.add_argument('--mode', choices=('inprocess', 'live'), default='inprocess')
+    parser.add_argument('--clients', type=int, default=1000, help="Number of synthetic client MACs")
+    parser.add_argument('--concurrency', type=int, default=64, help="Clients with a transaction in progress at any time")
+    parser.add_argument('--transactions', type=int, default=20000, help="Client packets to send in total")
+    parser.add_argument('--renewals', type=int, default=2, help="RENEWs per lease before it is released")
+    parser.add_argument('--release-ratio', type=float, default=1.0, help="Fraction of bound clients that RELEASE after renewing; the rest keep their lease")
+    parser.add_argument('--request-ratio', type=float, default=1.0, help="Fraction of the offers not declined that are REQUESTed; the rest are abandoned")
+    parser.add_argument('--decline-ratio', type=float, default=0.0, help="Fraction of offers answered with a DECLINE")
+    parser.add_argument('--arch-mix', default='none=1', help="Option 93 mix, e.g. bios=50,efi=30,none=20 (numeric arch codes allowed)")
+    parser.add_argument('--giaddr', default='', help="Send every packet as if relayed by this agent address (live mode: an address of this host, which it uses by default)")
+    parser.add_argument('--pool-size', type=int, default=1000, help="Lease range size of the in-process or spawned server")
+    parser.add_argument('--target', default='127.0.0.1', help="Live mode: server address")
+    parser.add_argument('--server-port', type=int, default=16767, help="Live mode: server port")
+    parser.add_argument('--client-port', type=int, default=16768, help="Live mode: port the server sends replies to")
+    parser.add_argument('--timeout', type=float, default=0.5, help="Live mode: seconds to wait for a reply")
+    parser.add_argument('--discover-retries', type=int, default=3, help="Live mode: unanswered DISCOVERs in a row from one client that count as an exhausted pool")
+    parser.add_argument('--spawn', action='store_true', help="Live mode: start a server on the given ports for the run")
+    parser.add_argument('--server-rate-limits', action='store_true', help="Keep the server's per-client/per-relay rate limits (in-process or spawned server)")
+    parser.add_argument('--server-log-level', default='ERROR', help="In-process mode: log level of the server")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print machine-readable JSON instead of a summary")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.clients, args.concurrency, parse_arch_mix(args.arch_mix), args.renewals,
+                              args.release_ratio, args.decline_ratio,
+                              int(IPv4Address(args.giaddr)) if args.giaddr else 0, args.seed, args.request_ratio, args.discover_retries)
+    if args.mode == 'inprocess':
+        results = run_inprocess(args, generator)
+    else:
+        with tempfile.TemporaryDirectory() as spawn_dir:
+            args.spawn_dir = spawn_dir
+            results = run_live(args, generator)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('json', 'spawn_dir')}
+    if args.json:
+        print(json.dumps({'config': config, 'results': results}, indent=2))
+        return
+
+    print(f"{args.mode}: {results['packets_sent']} packets in {results['elapsed_s']}s "
+          f"({results['packets_per_sec']} packets/s, {results['replies_per_sec']} replies/s)")
+    print(f"sent {results['sent_by_type']}, replies {results['replies_by_type']}, timeouts {results['timeouts_by_type']}, "
+          f"DISCOVERs without offer: {results['discovers_without_offer']}, shed by the server: {results['shed_by_server']}")
+    exhausted = results['pool_exhausted_at_leases']
+    if exhausted is not None:
+        exhausted = f"{exhausted} ({results['pool_exhausted_by']})"
+    print(f"leases held at the end: {results['leases_held']}, offers abandoned: {results['offers_abandoned']}, "
+          f"pool exhausted at: {exhausted}")
+    if 'server' in results:
+        print(f"server pool: {results['server']}")
+    print(f"{'latency_us':>10}  {'count':>8}  {'p50':>10}  {'p99':>10}  {'p999':>10}  {'max':>10}")
+    for label, row in results['latency_us'].items():
+        print(f"{label:>10}  {row['count']:>8}  {row['p50']:>10}  {row['p99']:>10}  {row['p999']:>10}  {row['max']:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,1685 @@ import time
 import os
 import logging
 import json
+import queue
+import re
+import bisect
+import csv
+import heapq
+import itertools
+import select
+import signal
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from ipaddress import IPv4Address, IPv4Network
+from logging.handlers import QueueHandler, QueueListener
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.getenv('DHCP_LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8) # Linux value, not exported by older Pythons
+
+# DHCP message types (RFC 2132, Option 53)
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+
+# Outcomes of a received packet, as counted by Metrics
+OUTCOME_OFFER = 0
+OUTCOME_ACK = 1
+OUTCOME_NAK = 2
+OUTCOME_RELEASED = 3
+OUTCOME_IGNORED = 4
+OUTCOME_MALFORMED = 5
+OUTCOME_ERROR = 6
+OUTCOME_RATE_LIMITED = 7
+
+# Where a reply is sent (RFC 2131, Section 4.1), as counted in DHCPServer.replies_sent
+DESTINATION_RELAY = 0
+DESTINATION_UNICAST = 1
+DESTINATION_BROADCAST = 2
+DESTINATIONS = ('relay', 'unicast', 'broadcast') # Index = DESTINATION_* constant
+
+BROADCAST_FLAG = 0x8000 # Bit 15 of the BOOTP flags field
+
+def format_mac(mac):
+    # 48-bit integer MAC as aa:bb:cc:dd:ee:ff, the form used in leases.json and the journal
+    return ':'.join(f'{b:02x}' for b in mac.to_bytes(6, 'big'))
+
+def parse_mac(mac_str):
+    return int(mac_str.replace(':', '').replace('-', ''), 16)
+
+def format_ip(ip):
+    return socket.inet_ntoa(ip.to_bytes(4, 'big'))
+
+def read_config_file(path):
+    # KEY=VALUE settings in the format of the `config` file, which a shell can
+    # source and Docker Compose reads as an env file: blank lines and # comments
+    # are skipped and a value may be quoted.
+    settings = {}
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('export '):
+                line = line[len('export '):].lstrip()
+            key, separator, value = line.partition('=')
+            key = key.strip()
+            if not separator or not key.isidentifier():
+                raise ValueError(f"{path}, line {number}: expected KEY=VALUE")
+            value = value.strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+                value = value[1:-1]
+            settings[key] = value
+    return settings
+
+_environ_before_config = {} # Variables the config file overrides -> their value before (None = unset)
+
+def apply_config_file(path):
+    # Settings from the config file override the environment. Applying the file
+    # again after an edit restores the variables it no longer sets.
+    settings = read_config_file(path)
+    for key in [key for key in _environ_before_config if key not in settings]:
+        original = _environ_before_config.pop(key)
+        if original is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = original
+    for key, value in settings.items():
+        if key not in _environ_before_config:
+            _environ_before_config[key] = os.environ.get(key)
+        os.environ[key] = value
+    return settings
+
+def snapshot_environ():
+    # What restore_environ needs to undo apply_config_file: the environment and
+    # the record of what the config file overrode
+    return dict(os.environ), dict(_environ_before_config)
+
+def restore_environ(snapshot):
+    environ, before_config = snapshot
+    for key in [key for key in os.environ if key not in environ]:
+        del os.environ[key]
+    for key, value in environ.items():
+        if os.environ.get(key) != value:
+            os.environ[key] = value
+    _environ_before_config.clear()
+    _environ_before_config.update(before_config)
+
+class LazyLogArg:
+    # %-style log argument that is formatted only when its line is written:
+    # on the log listener thread, and never for suppressed or disabled lines.
+    # Equal values compare equal so that LogSuppressor recognises repeats.
+    __slots__ = ('_format', '_value')
+
+    def __init__(self, format, value):
+        self._format = format
+        self._value = value
+
+    def __str__(self):
+        return self._format(self._value)
+
+    def __eq__(self, other):
+        return isinstance(other, LazyLogArg) and self._format is other._format and self._value == other._value
+
+    def __hash__(self):
+        return hash(self._value)
+
+def log_mac(mac):
+    return LazyLogArg(format_mac, mac)
+
+def log_ip(ip):
+    return LazyLogArg(format_ip, ip) if ip is not None else None
+
+class ReplyTemplate:
+    # A fully encoded reply (fixed BOOTP header, magic cookie and every static
+    # option TLV) built once by DHCPServer.build_dhcp_packet. Sending a reply
+    # only patches the per-client fields into the same buffer with pack_into.
+    HEADER = struct.Struct('!IHHIIII16s') # xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr (from offset 4)
+    LEASE_TIME = struct.Struct('!I')
+
+    def __init__(self, packet, lease_time_offset=None):
+        self._buf = bytearray(packet)
+        self._siaddr, = struct.unpack_from('!I', packet, 20)
+        self._lease_time_offset = lease_time_offset
+
+    def render(self, xid, flags, ciaddr, yiaddr, giaddr, chaddr, lease_time):
+        buf = self._buf
+        self.HEADER.pack_into(buf, 4, xid, 0, flags, ciaddr, yiaddr, self._siaddr, giaddr, chaddr)
+        if self._lease_time_offset is not None:
+            self.LEASE_TIME.pack_into(buf, self._lease_time_offset, lease_time)
+        return bytes(buf)
+
+class DHCPPacket:
+    # Read-only view of a received DHCP message (RFC 2131, Section 2).
+    # The fixed header is unpacked once; the options are indexed in a single
+    # pass that only records where each option's value lives in the datagram.
+    # Values are sliced out (through a memoryview, without copying) and decoded
+    # only when a handler actually asks for them. Option overload (option 52)
+    # and repeated options (RFC 3396, values are concatenated) are honoured, and
+    # an option that runs past the end of its field marks the packet as
+    # truncated instead of raising.
+    __slots__ = ('_data', '_view', '_spans', 'truncated', 'has_magic_cookie',
+                 'op', 'htype', 'hlen', 'hops', 'xid', 'secs', 'flags', 'ciaddr', 'yiaddr', 'siaddr', 'giaddr')
+    HEADER = struct.Struct('!BBBBIHHIIII') # op .. giaddr, 28 bytes
+    MAGIC_COOKIE = b'\x63\x82\x53\x63' # 99.130.83.99
+    MIN_LENGTH = 240 # Fixed header + magic cookie
+
+    def __init__(self, data):
+        if len(data) < self.MIN_LENGTH:
+            raise ValueError(f"packet is {len(data)} bytes, shorter than the {self.MIN_LENGTH} byte DHCP header")
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._data = data
+        self._view = None
+        (self.op, self.htype, self.hlen, self.hops, self.xid, self.secs, self.flags,
+         self.ciaddr, self.yiaddr, self.siaddr, self.giaddr) = self.HEADER.unpack_from(data)
+        self.has_magic_cookie = data.startswith(self.MAGIC_COOKIE, 236)
+        self.truncated = False
+        self._spans = {} # option code -> (start, end), or a list of them for repeated options
+        if self.has_magic_cookie:
+            self._index(240, len(data))
+            overload = self._spans.get(52)
+            if overload is not None and not isinstance(overload, list) and overload[1] - overload[0] == 1:
+                # Options continue in 'file' first, then 'sname' (RFC 2131, Section 4.1)
+                if data[overload[0]] & 1:
+                    self._index(108, 236)
+                if data[overload[0]] & 2:
+                    self._index(44, 108)
+
+    def _index(self, idx, end):
+        data = self._data
+        spans = self._spans
+        while idx < end:
+            code = data[idx]
+            if code == 0: # Pad option
+                idx += 1
+                continue
+            if code == 255: # End option
+                return
+            if idx + 1 >= end:
+                self.truncated = True
+                return
+            start = idx + 2
+            idx = start + data[idx + 1]
+            if idx > end:
+                self.truncated = True
+                return
+            if code in spans: # Repeated option, its values are concatenated
+                previous = spans[code]
+                if isinstance(previous, list):
+                    previous.append((start, idx))
+                else:
+                    spans[code] = [previous, (start, idx)]
+            else:
+                spans[code] = (start, idx)
+
+    def __contains__(self, code):
+        return code in self._spans
+
+    def raw(self, code):
+        # Option value as a memoryview into the datagram (no copy), or None
+        span = self._spans.get(code)
+        if span is None:
+            return None
+        if self._view is None:
+            self._view = memoryview(self._data)
+        if isinstance(span, list):
+            return memoryview(b''.join(self._view[start:end] for start, end in span))
+        return self._view[span[0]:span[1]]
+
+    def get(self, code):
+        # Option value as bytes, or None
+        value = self.raw(code)
+        return None if value is None else value.tobytes()
+
+    def _ip_option(self, code):
+        span = self._spans.get(code)
+        if span is None or isinstance(span, list) or span[1] - span[0] != 4:
+            return None
+        return int.from_bytes(self._data[span[0]:span[1]], 'big')
+
+    @property
+    def chaddr(self):
+        return self._data[28:34] # Client hardware address (Ethernet MAC)
+
+    @property
+    def mac(self):
+        return int.from_bytes(self._data[28:34], 'big') # chaddr as the 48-bit integer leases are keyed by
+
+    @property
+    def message_type(self):
+        span = self._spans.get(53) # DHCP Message Type
+        if span is None or isinstance(span, list) or span[1] - span[0] != 1:
+            return None
+        return self._data[span[0]]
+
+    @property
+    def requested_ip(self):
+        return self._ip_option(50) # Requested IP Address, as an integer
+
+    @property
+    def server_identifier(self):
+        return self._ip_option(54) # Server Identifier, as an integer
+
+    @property
+    def client_arch(self):
+        # Option 93: Client System Architecture, a list of 16-bit types (RFC 4578)
+        span = self._spans.get(93)
+        if span is None:
+            return ()
+        if isinstance(span, list):
+            data = self.get(93)
+            start, end = 0, len(data)
+        else:
+            data = self._data
+            start, end = span
+        if end - start == 2: # The usual case: a single architecture type
+            return (data[start] << 8 | data[start + 1],)
+        return struct.unpack_from(f'!{(end - start) // 2}H', data, start)
+
+class IPPool:
+    # Free-address allocator for one contiguous range of IPv4 addresses.
+    # Addresses are kept as integer offsets from the start of the range: a
+    # bytearray bitmap records which offsets are free and a min-heap hands out
+    # the lowest free offset first. Assignment stays deterministic (lowest free
+    # address wins, as the old sorted scan did) while allocate, release and
+    # reserve are O(log n) regardless of how large the range is. Addresses in
+    # `excluded` (the reserved ones) are never released into the pool.
+
+    def __init__(self, start_ip, end_ip, excluded=()):
+        self.start = int(start_ip)
+        self.end = int(end_ip)
+        if self.end < self.start - 1: # An empty range is allowed (a worker's share of a tiny scope)
+            raise ValueError(f"Invalid pool range {IPv4Address(self.start)} - {IPv4Address(self.end)}")
+        self.size = self.end - self.start + 1
+        self._free = bytearray(b'\x01') * self.size # 1 = free, 0 = leased/reserved
+        self._queued = bytearray(b'\x01') * self.size # 1 = offset currently sits in the heap
+        self._heap = list(range(self.size)) # Ascending list is already a valid heap
+        self.free_count = self.size
+        self.excluded = excluded # Container of integer addresses, shared with the reservation table
+
+    def __contains__(self, ip):
+        return self.start <= int(ip) <= self.end
+
+    def is_free(self, ip):
+        ip = int(ip)
+        return self.start <= ip <= self.end and self._free[ip - self.start] == 1
+
+    def allocate(self):
+        # Reserved offsets are left in the heap and skipped lazily here
+        heap = self._heap
+        while heap:
+            offset = heapq.heappop(heap)
+            self._queued[offset] = 0
+            if self._free[offset]:
+                self._free[offset] = 0
+                self.free_count -= 1
+                return self.start + offset
+        return None
+
+    def reserve(self, ip):
+        # Take a specific address out of the pool. Returns False if it is outside
+        # the range or already taken.
+        ip = int(ip)
+        if not self.start <= ip <= self.end:
+            return False
+        offset = ip - self.start
+        if not self._free[offset]:
+            return False
+        self._free[offset] = 0
+        self.free_count -= 1
+        return True
+
+    def release(self, ip):
+        ip = int(ip)
+        if not self.start <= ip <= self.end or ip in self.excluded:
+            return False
+        offset = ip - self.start
+        if self._free[offset]:
+            return False
+        self._free[offset] = 1
+        self.free_count += 1
+        if not self._queued[offset]: # Never keep more than one heap entry per offset
+            self._queued[offset] = 1
+            heapq.heappush(self._heap, offset)
+        return True
+
+    def resize(self, start_ip, end_ip, is_bound):
+        # Move the pool to a new range without touching the addresses both ranges
+        # share: they keep their free/taken state. Addresses new to the pool are
+        # free unless they are excluded or is_bound(ip) says a lease holds them.
+        # Returns the number of addresses added.
+        start, end = int(start_ip), int(end_ip)
+        if start == self.start and end == self.end:
+            return 0
+        if end < start - 1:
+            raise ValueError(f"Invalid pool range {IPv4Address(start)} - {IPv4Address(end)}")
+        size = end - start + 1
+        free = bytearray(size) # 0 = taken until shown otherwise
+        overlap_start, overlap_end = max(start, self.start), min(end, self.end)
+        if overlap_start <= overlap_end:
+            free[overlap_start - start:overlap_end - start + 1] = self._free[overlap_start - self.start:overlap_end - self.start + 1]
+        added = 0
+        for ip in itertools.chain(range(start, min(end, self.start - 1) + 1), range(max(start, self.end + 1), end + 1)):
+            added += 1
+            if ip not in self.excluded and not is_bound(ip):
+                free[ip - start] = 1
+        self.start, self.end, self.size = start, end, size
+        self._free = free
+        self._queued = bytearray(free)
+        self._heap = list(itertools.compress(range(size), free)) # Ascending, so already a valid heap
+        self.free_count = len(self._heap)
+        return added
+
+class OfferHolds:
+    # Addresses offered to clients that have not REQUESTed them yet, one per
+    # MAC, for a single scope. A hold keeps its address out of the free pool
+    # until its own expiry time and becomes a lease only on a matching REQUEST;
+    # nothing about it is written to the lease store or the journal. Holds
+    # expire through a min-heap of (expires_at, mac): a renewed hold pushes a
+    # new entry and the outdated one is skipped when it reaches the top, as in
+    # LeaseExpiryQueue, so a hold_time changed by a reload only applies to the
+    # holds made after it. At most `limit` holds exist at once, which bounds
+    # what a DISCOVER flood can take from the pool: beyond it new clients are
+    # refused an offer, and existing holds keep theirs.
+
+    def __init__(self, ip_pool, hold_time, limit):
+        self.ip_pool = ip_pool
+        self.hold_time = hold_time
+        self.limit = limit
+        self._holds = {} # mac -> [ip, expires_at]
+        self._expiry = [] # (expires_at, mac), including outdated entries
+        self.converted = 0
+        self.expired = 0
+        self.refused = 0
+
+    def __len__(self):
+        return len(self._holds)
+
+    @property
+    def full(self):
+        return len(self._holds) >= self.limit
+
+    def get(self, mac, now):
+        # Held address of mac, or None
+        hold = self._holds.get(mac)
+        if hold is None or hold[1] <= now:
+            return None
+        return hold[0]
+
+    def offer(self, mac, now):
+        # Address to offer mac: its current hold (renewed) or a newly held one.
+        # None if the pool is empty or `limit` holds are outstanding already.
+        self.expire(now)
+        hold = self._holds.get(mac)
+        if hold is not None:
+            hold[1] = now + self.hold_time
+            self._schedule(mac, hold[1])
+            return hold[0]
+        if self.full:
+            self.refused += 1
+            return None
+        ip = self.ip_pool.allocate()
+        if ip is None:
+            return None
+        self._holds[mac] = [ip, now + self.hold_time]
+        self._schedule(mac, now + self.hold_time)
+        return ip
+
+    def _schedule(self, mac, expires_at):
+        heapq.heappush(self._expiry, (expires_at, mac))
+        if len(self._expiry) > 2 * len(self._holds) + 64: # Renewals leave outdated entries behind
+            self._expiry = [(hold[1], mac) for mac, hold in self._holds.items()]
+            heapq.heapify(self._expiry)
+
+    def claim(self, mac, ip):
+        # mac REQUESTed ip: drop its hold. The held address stays allocated if it
+        # is the one being leased and goes back to the pool otherwise.
+        hold = self._holds.pop(mac, None)
+        if hold is None:
+            return
+        if hold[0] == ip:
+            self.converted += 1
+        else:
+            self.ip_pool.release(hold[0])
+
+    def release(self, mac):
+        hold = self._holds.pop(mac, None)
+        if hold is not None:
+            self.ip_pool.release(hold[0])
+
+    def held_ips(self):
+        return {hold[0] for hold in self._holds.values()}
+
+    def drop_outside(self, start, end):
+        # The pool is moving to start..end: holds on addresses it gives up end
+        # here, without going back to a pool that no longer covers them
+        for mac in [mac for mac, hold in self._holds.items() if not start <= hold[0] <= end]:
+            del self._holds[mac]
+
+    def expire(self, now):
+        holds = self._holds
+        heap = self._expiry
+        expired = 0
+        while heap and heap[0][0] <= now:
+            expires_at, mac = heapq.heappop(heap)
+            hold = holds.get(mac)
+            if hold is None or hold[1] != expires_at:
+                continue # Claimed, released or renewed since this entry was pushed
+            del holds[mac]
+            self.ip_pool.release(hold[0])
+            expired += 1
+        self.expired += expired
+        return expired
+
+class Scope:
+    # One subnet served by this server: its network, the dynamic range handed out
+    # from it and the options its clients receive. The scope a packet is served
+    # from is chosen by the relay agent address (giaddr) or, for clients on a
+    # directly attached network, by the interface the packet arrived on.
+
+    def __init__(self, name, network, start_ip, end_ip, router_ip, dns_servers, lease_time, nis_domain_name='', nis_server_ips=()):
+        self.name = name
+        self.network = network
+        self.first = int(network.network_address)
+        self.last = int(network.broadcast_address)
+        self.start_ip = start_ip
+        self.end_ip = end_ip
+        if not self.first <= int(start_ip) <= int(end_ip) <= self.last:
+            raise ValueError(f"Scope {name}: range {start_ip} - {end_ip} does not lie within {network}")
+        self.subnet_mask = network.netmask
+        self.router_ip = router_ip
+        self.dns_servers = dns_servers
+        self.lease_time = lease_time
+        self.nis_domain_name = nis_domain_name
+        self.nis_server_ips = list(nis_server_ips)
+        self.ip_pool = None # Created by the server once it knows which slice of the range it serves
+        self.offer_holds = None # OfferHolds on ip_pool, created with it
+        self.reply_templates = {} # (message type, boot file) -> ReplyTemplate
+
+    @classmethod
+    def from_config(cls, entry, defaults):
+        # One entry of the scopes file; anything not given is taken from the default scope
+        network = IPv4Network(entry['subnet'])
+        router_ip = entry.get('router')
+        dns_servers = entry.get('dns_servers')
+        nis_server_ips = entry.get('nis_servers')
+        return cls(
+            entry.get('name', str(network)),
+            network,
+            IPv4Address(entry['start_ip']),
+            IPv4Address(entry['end_ip']),
+            IPv4Address(router_ip) if router_ip else None,
+            [IPv4Address(ip) for ip in dns_servers] if dns_servers is not None else defaults.dns_servers,
+            int(entry.get('lease_time', defaults.lease_time)),
+            entry.get('nis_domain', defaults.nis_domain_name),
+            [IPv4Address(ip) for ip in nis_server_ips] if nis_server_ips is not None else defaults.nis_server_ips,
+        )
+
+    def __contains__(self, ip):
+        return self.first <= int(ip) <= self.last
+
+    def pool_range(self, shard=None):
+        # A multiprocess worker allocates only from its own contiguous slice of the range
+        start, end = int(self.start_ip), int(self.end_ip)
+        if shard is None:
+            return start, end
+        index, count = shard
+        slice_size = -(-(end - start + 1) // count)
+        return start + index * slice_size, min(end, start + (index + 1) * slice_size - 1)
+
+class ScopeIndex:
+    # Interval index over the scope networks: start addresses kept sorted in a
+    # list and searched with bisect, so finding the scope for an address is
+    # O(log scopes) however many subnets sit behind the relays.
+
+    def __init__(self, scopes):
+        self._scopes = sorted(scopes, key=lambda scope: scope.first)
+        self._starts = [scope.first for scope in self._scopes]
+        self._ends = [scope.last for scope in self._scopes]
+        for previous, scope in zip(self._scopes, self._scopes[1:]):
+            if scope.first <= previous.last:
+                raise ValueError(f"Scope {scope.name} ({scope.network}) overlaps scope {previous.name} ({previous.network})")
+
+    def __len__(self):
+        return len(self._scopes)
+
+    def __iter__(self):
+        return iter(self._scopes)
+
+    def lookup(self, ip):
+        # Scope whose network contains the integer address ip, or None
+        i = bisect.bisect_right(self._starts, ip) - 1
+        if i >= 0 and ip <= self._ends[i]:
+            return self._scopes[i]
+        return None
+
+class Lease:
+    # One bound address. MAC (48 bits) and IPv4 address are plain integers and
+    # the record is slotted, so a lease costs a fixed handful of words instead
+    # of a dict with string values.
+    __slots__ = ('mac', 'ip', 'lease_time_end', 'is_static')
+
+    def __init__(self, mac, ip, lease_time_end, is_static=False):
+        self.mac = mac
+        self.ip = ip
+        self.lease_time_end = lease_time_end
+        self.is_static = is_static
+
+class LeaseStore:
+    # The lease table, indexed by MAC and by IP. Leases are only changed through
+    # put, renew and remove, which keep the two indexes in step: an IP is
+    # indexed exactly when the lease holding it is.
+
+    def __init__(self):
+        self._by_mac = {} # mac -> Lease
+        self._by_ip = {} # ip -> Lease
+
+    def __len__(self):
+        return len(self._by_mac)
+
+    def __contains__(self, mac):
+        return mac in self._by_mac
+
+    def __iter__(self):
+        return iter(self._by_mac.values())
+
+    def get(self, mac):
+        return self._by_mac.get(mac)
+
+    def holder(self, ip):
+        # Lease bound to the integer address ip, or None
+        return self._by_ip.get(ip)
+
+    def put(self, lease):
+        # Store lease in place of the MAC's previous one. An address leased to
+        # another MAC is never taken over: that lease has to be removed first.
+        holder = self._by_ip.get(lease.ip)
+        if holder is not None and holder.mac != lease.mac:
+            raise ValueError(f"{format_ip(lease.ip)} is leased to {format_mac(holder.mac)}")
+        previous = self._by_mac.get(lease.mac)
+        if previous is not None:
+            del self._by_ip[previous.ip]
+        self._by_mac[lease.mac] = lease
+        self._by_ip[lease.ip] = lease
+
+    def renew(self, mac, lease_time_end):
+        self._by_mac[mac].lease_time_end = lease_time_end
+
+    def remove(self, mac):
+        lease = self._by_mac.pop(mac, None)
+        if lease is not None:
+            del self._by_ip[lease.ip]
+        return lease
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteLeaseStore:
+    # LeaseStore with the table in an SQLite database, for lease tables too
+    # large to keep in memory. The database is a working copy only: it is
+    # recreated at startup from the snapshot and journal, which remain the
+    # durable record, so SQLite's own journal and fsyncs are switched off.
+    # Changes are committed on the housekeeping tick. Leases returned by get
+    # and holder are copies, so they must not be modified in place. Expiry is
+    # driven by an index on lease_time_end (see SqliteExpiryIndex), so the
+    # table is never mirrored in a heap in Python memory.
+
+    def __init__(self, path, cache_kib=65536):
+        for stale in (path, path + '-journal'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute(f'PRAGMA cache_size = -{cache_kib}')
+        self._db.execute('CREATE TABLE leases (mac INTEGER PRIMARY KEY, ip INTEGER NOT NULL UNIQUE, lease_time_end REAL NOT NULL, is_static INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX leases_expiry ON leases (lease_time_end) WHERE is_static = 0')
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, mac):
+        return self._db.execute('SELECT 1 FROM leases WHERE mac = ?', (mac,)).fetchone() is not None
+
+    def __iter__(self):
+        for mac, ip, lease_time_end, is_static in self._db.execute('SELECT mac, ip, lease_time_end, is_static FROM leases'):
+            yield Lease(mac, ip, lease_time_end, bool(is_static))
+
+    def get(self, mac):
+        row = self._db.execute('SELECT ip, lease_time_end, is_static FROM leases WHERE mac = ?', (mac,)).fetchone()
+        return Lease(mac, row[0], row[1], bool(row[2])) if row is not None else None
+
+    def holder(self, ip):
+        row = self._db.execute('SELECT mac, lease_time_end, is_static FROM leases WHERE ip = ?', (ip,)).fetchone()
+        return Lease(row[0], ip, row[1], bool(row[2])) if row is not None else None
+
+    def put(self, lease):
+        # Fresh MAC and free address, the usual case: a single INSERT
+        try:
+            self._db.execute('INSERT INTO leases VALUES (?, ?, ?, ?)', (lease.mac, lease.ip, lease.lease_time_end, lease.is_static))
+            self._count += 1
+            return
+        except sqlite3.IntegrityError:
+            pass
+        holder = self.holder(lease.ip)
+        if holder is not None and holder.mac != lease.mac:
+            raise ValueError(f"{format_ip(lease.ip)} is leased to {format_mac(holder.mac)}")
+        self._db.execute('UPDATE leases SET ip = ?, lease_time_end = ?, is_static = ? WHERE mac = ?',
+                         (lease.ip, lease.lease_time_end, lease.is_static, lease.mac))
+
+    def renew(self, mac, lease_time_end):
+        self._db.execute('UPDATE leases SET lease_time_end = ? WHERE mac = ?', (lease_time_end, mac))
+
+    def remove(self, mac):
+        lease = self.get(mac)
+        if lease is not None:
+            self._db.execute('DELETE FROM leases WHERE mac = ?', (mac,))
+            self._count -= 1
+        return lease
+
+    def due(self, now, after, limit):
+        # Up to `limit` dynamic leases ended by `now`, as (lease_time_end, mac) in
+        # expiry order, starting past the `after` (lease_time_end, mac) position
+        return self._db.execute('SELECT lease_time_end, mac FROM leases WHERE is_static = 0 AND lease_time_end <= ? '
+                                'AND (lease_time_end, mac) > (?, ?) ORDER BY lease_time_end, mac LIMIT ?',
+                                (now, after[0], after[1], limit)).fetchall()
+
+    def sync(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+class ReservationTable:
+    # Fixed MAC -> address assignments. A reserved client is answered from this
+    # table alone, so its DISCOVERs and REQUESTs write nothing to the lease store
+    # or the journal. Hash indexes by MAC and by IP (both kept as integers) make
+    # either lookup O(1); the IP index doubles as the set of addresses the
+    # dynamic pools must never hand out.
+
+    def __init__(self):
+        self.by_mac = {} # mac -> ip
+        self.by_ip = {} # ip -> mac
+
+    def __len__(self):
+        return len(self.by_mac)
+
+    def __contains__(self, mac):
+        return mac in self.by_mac
+
+    def ip_for(self, mac):
+        return self.by_mac.get(mac)
+
+    def mac_for(self, ip):
+        return self.by_ip.get(ip)
+
+    def add(self, mac, ip):
+        # A MAC has one reserved address and an address one MAC
+        if self.by_mac.get(mac, ip) != ip:
+            raise ValueError(f"{format_mac(mac)} is already reserved {format_ip(self.by_mac[mac])}")
+        if self.by_ip.get(ip, mac) != mac:
+            raise ValueError(f"{format_ip(ip)} is already reserved for {format_mac(self.by_ip[ip])}")
+        self.by_mac[mac] = ip
+        self.by_ip[ip] = mac
+
+    @classmethod
+    def load(cls, path):
+        # Bulk import. JSON: a list of {"mac": ..., "ip": ...} objects, or an
+        # object with such a list under "reservations". Anything else is read as
+        # CSV: mac,ip per row, further columns (e.g. a host name) ignored, and a
+        # header row, blank lines and # comments skipped.
+        table = cls()
+        with open(path, 'r', newline='') as f:
+            if path.endswith('.json'):
+                entries = json.load(f)
+                if isinstance(entries, dict):
+                    entries = entries.get('reservations', [])
+                rows = ((number, entry.get('mac', ''), entry.get('ip', '')) for number, entry in enumerate(entries, 1))
+            else:
+                rows = ((number, row[0], row[1] if len(row) > 1 else '') for number, row in enumerate(csv.reader(f), 1)
+                        if row and row[0].strip() and not row[0].lstrip().startswith('#') and row[0].strip().lower() != 'mac')
+            for number, mac_str, ip_str in rows:
+                try:
+                    mac_hex = mac_str.strip().replace(':', '').replace('-', '')
+                    if len(mac_hex) != 12:
+                        raise ValueError(f"'{mac_str}' is not a MAC address")
+                    try:
+                        packed_ip = socket.inet_pton(socket.AF_INET, ip_str.strip()) # Strict dotted quad, and much faster than IPv4Address
+                    except OSError:
+                        raise ValueError(f"'{ip_str}' is not an IPv4 address") from None
+                    table.add(int(mac_hex, 16), int.from_bytes(packed_ip, 'big'))
+                except (ValueError, AttributeError) as e:
+                    raise ValueError(f"{path}, entry {number}: {e}") from None
+        return table
+
+class LeaseExpiryQueue:
+    # Min-heap of (lease_time_end, mac) for dynamic leases. Renewals push a new
+    # entry rather than updating the old one; outdated entries are recognised
+    # and skipped when they reach the top, so a tick only touches leases that
+    # are actually due (plus the stale entries of leases renewed in between).
+
+    def __init__(self, entries=()):
+        self._heap = list(entries)
+        heapq.heapify(self._heap)
+        self.reclaimed_total = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, mac, lease_time_end):
+        heapq.heappush(self._heap, (lease_time_end, mac))
+
+    def pop_due(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            yield heapq.heappop(heap)
+
+    def rebuild(self, entries):
+        # Drop the stale entries left behind by renewals
+        self._heap = list(entries)
+        heapq.heapify(self._heap)
+
+class SqliteExpiryIndex:
+    # LeaseExpiryQueue for a SqliteLeaseStore: due leases come straight from the
+    # table's lease_time_end index, which renewals keep current, so nothing is
+    # scheduled, nothing goes stale and there is nothing to rebuild.
+    BATCH = 1024 # Rows fetched per query
+
+    def __init__(self, store):
+        self._store = store
+        self.reclaimed_total = 0
+
+    def __len__(self):
+        return 0
+
+    def schedule(self, mac, lease_time_end):
+        pass
+
+    def pop_due(self, now):
+        # Pages through the due rows by position, as the caller removes them
+        after = (float('-inf'), -1)
+        while True:
+            rows = self._store.due(now, after, self.BATCH)
+            yield from rows
+            if len(rows) < self.BATCH:
+                return
+            after = rows[-1]
+
+    def rebuild(self, entries):
+        pass
+
+class LeaseJournal:
+    # Append-only write-ahead log of lease changes, sitting next to the
+    # leases.json snapshot. Each change is one compact line:
+    #   <crc32 hex> ["mac","ip",lease_time_end,is_static]   (lease bound/renewed)
+    #   <crc32 hex> ["mac"]                                  (lease removed)
+    # Records are buffered and written as a group commit, either when the batch
+    # fills up or when the oldest pending record is commit_interval seconds old.
+    # Once the journal holds as many records as there are live leases it is
+    # compacted: the journal is rotated aside and a background thread replays
+    # it onto the previous snapshot read back from disk, writing the result as
+    # the fresh leases.json. The live lease store is never copied for this, so
+    # a compaction costs the reply path one file rotation however many leases
+    # there are. Startup replays snapshot + rotated journal + journal; replay is
+    # idempotent, so a crash at any point loses at most the batch that had not
+    # been committed yet.
+    # With start_writer() the group commits (write + fsync) run on a background
+    # thread, so the reply path only ever appends to an in-memory list. The
+    # 'always' policy keeps committing inline: it trades latency for durability.
+    FSYNC_POLICIES = ('always', 'commit', 'never')
+
+    def __init__(self, snapshot_path, journal_path, fsync_policy='commit', batch_size=64, commit_interval=0.05, compact_min_records=1000,
+                 seed_path=None):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown journal fsync policy '{fsync_policy}' (expected one of {', '.join(self.FSYNC_POLICIES)})")
+        self.snapshot_path = snapshot_path
+        self.seed_path = seed_path or snapshot_path # Leases the journal starts from while there is no snapshot yet
+        self.journal_path = journal_path
+        self.rotated_path = journal_path + '.compacting'
+        self.fsync_policy = fsync_policy
+        self.batch_size = 1 if fsync_policy == 'always' else batch_size
+        self.commit_interval = commit_interval
+        self.compact_min_records = compact_min_records
+
+        self._pending = []
+        self._pending_since = 0.0
+        self._lock = threading.Lock() # Guards _pending
+        self._io_lock = threading.Lock() # Serialises writes, fsyncs and rotation of the journal file
+        self._file = None
+        self._compactor = None
+        self._writer = None
+        self._writer_wakeup = threading.Event()
+        self._stopping = False
+        self.records_since_snapshot = 0
+        self.commits = 0
+        self.compactions = 0
+
+    @staticmethod
+    def _encode(mac, lease):
+        if lease is None:
+            record = [format_mac(mac)]
+        else:
+            record = [format_mac(mac), format_ip(lease.ip), lease.lease_time_end, lease.is_static]
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+    def _replay_file(self, path, leases, truncate_torn_tail):
+        # Apply every intact record in order. The first incomplete or corrupt
+        # line ends the replay: it can only be a write torn by a crash.
+        with open(path, 'rb') as f:
+            data = f.read()
+        applied = 0
+        good_end = 0
+        while good_end < len(data):
+            line_end = data.find(b'\n', good_end)
+            if line_end == -1:
+                break
+            line = data[good_end:line_end]
+            try:
+                crc, payload = line.split(b' ', 1)
+                if int(crc, 16) != zlib.crc32(payload):
+                    break
+                record = json.loads(payload)
+                if len(record) == 1:
+                    leases.pop(record[0], None)
+                else:
+                    mac, ip, lease_time_end, is_static = record
+                    leases[mac] = {'ip_address': ip, 'lease_time_end': lease_time_end, 'is_static': is_static}
+            except (ValueError, TypeError):
+                break
+            applied += 1
+            good_end = line_end + 1
+
+        if good_end < len(data):
+            logger.warning("Lease journal %s has a torn or corrupt tail at byte %s; discarding %s bytes.", path, good_end, len(data) - good_end)
+            if truncate_torn_tail:
+                with open(path, 'r+b') as f:
+                    f.truncate(good_end)
+                    os.fsync(f.fileno())
+        return applied
+
+    def read(self, leases):
+        # Apply rotated journal + journal to leases without opening either for writing
+        applied = 0
+        for path in (self.rotated_path, self.journal_path):
+            if os.path.exists(path):
+                applied += self._replay_file(path, leases, truncate_torn_tail=False)
+        return applied
+
+    def replay(self, leases):
+        # Bring a freshly loaded snapshot (MAC string -> lease dict) up to date and open the journal for appending
+        applied = 0
+        if os.path.exists(self.rotated_path): # A compaction did not finish before the last shutdown
+            applied += self._replay_file(self.rotated_path, leases, truncate_torn_tail=False)
+        if os.path.exists(self.journal_path):
+            applied += self._replay_file(self.journal_path, leases, truncate_torn_tail=True)
+        self.records_since_snapshot = applied
+        self._file = open(self.journal_path, 'ab')
+        return applied
+
+    def record(self, mac, lease):
+        # Queue the current state of one lease (None = removed)
+        encoded = self._encode(mac, lease)
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append(encoded)
+            batch_full = len(self._pending) >= self.batch_size
+        if batch_full:
+            if self._writer is None or self.fsync_policy == 'always':
+                self.commit()
+            else:
+                self._writer_wakeup.set()
+
+    def maybe_commit(self, now):
+        # Inline group commit for servers without a writer thread
+        if self._writer is None and self._pending and now - self._pending_since >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        with self._io_lock:
+            self._commit_locked()
+
+    def _commit_locked(self):
+        # Taking the batch under _io_lock keeps batches on disk in record order
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+        if not batch:
+            return
+        self._file.write(b''.join(batch))
+        self._file.flush()
+        if self.fsync_policy != 'never':
+            os.fsync(self._file.fileno())
+        self.records_since_snapshot += len(batch)
+        self.commits += 1
+
+    def start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._writer_loop, name="lease-journal-writer", daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self):
+        while True:
+            self._writer_wakeup.wait(self.commit_interval)
+            self._writer_wakeup.clear()
+            try:
+                self.commit()
+            except Exception as e:
+                logger.error("Lease journal commit failed: %s", e)
+            if self._stopping:
+                return
+
+    def needs_compaction(self, live_leases):
+        # Compact once the journal is at least as long as the snapshot would be,
+        # which keeps the snapshot cost amortised O(1) per lease change.
+        if self._compactor is not None and self._compactor.is_alive():
+            return False
+        return self.records_since_snapshot >= max(self.compact_min_records, live_leases)
+
+    def compact(self):
+        # Rotate the journal aside; the snapshot is built from it in the background
+        with self._io_lock:
+            self._commit_locked()
+            # If an earlier compaction never finished, its rotated journal must not
+            # be overwritten: this snapshot covers it, and the live journal is
+            # simply replayed on top of the snapshot until the next rotation.
+            if not os.path.exists(self.rotated_path):
+                self._file.close()
+                os.replace(self.journal_path, self.rotated_path)
+                self._file = open(self.journal_path, 'ab')
+            self.records_since_snapshot = 0
+        self._compactor = threading.Thread(target=self._write_snapshot, name="lease-compactor", daemon=True)
+        self._compactor.start()
+
+    def _read_base_snapshot(self):
+        # The snapshot the rotated journal applies to, as MAC string -> lease dict
+        path = self.snapshot_path if os.path.exists(self.snapshot_path) else self.seed_path
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError: # The server started from an empty pool too
+                logger.warning("Leases file %s is empty or malformed, compacting the journal alone.", path)
+                return {}
+
+    def _write_snapshot(self):
+        try:
+            started = time.perf_counter()
+            snapshot = self._read_base_snapshot()
+            self._replay_file(self.rotated_path, snapshot, truncate_torn_tail=False)
+            now = time.time()
+            snapshot = {mac: lease_info for mac, lease_info in snapshot.items()
+                        if lease_info.get('is_static') or lease_info['lease_time_end'] > now} # Expired leases are dropped at load anyway
+            write_lease_snapshot(self.snapshot_path, snapshot)
+            os.remove(self.rotated_path) # Only once the snapshot covering it is durable
+            self.compactions += 1
+            logger.info("Compacted lease journal into %s (%s leases) in %.3fs", self.snapshot_path, len(snapshot), time.perf_counter() - started)
+        except Exception as e:
+            logger.error("Lease journal compaction failed, keeping %s for replay: %s", self.rotated_path, e)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._writer is not None:
+            self._stopping = True
+            self._writer_wakeup.set()
+            self._writer.join()
+            self._writer = None
+        self.commit()
+        if self._compactor is not None:
+            self._compactor.join()
+        self._file.close()
+        self._file = None
+
+def load_lease_snapshot(path):
+    # A leases.json-style snapshot as MAC string -> lease dict; leases stay in
+    # their file form (MAC and IP strings) until DHCPServer._index_leases moves
+    # them into the lease store
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        try:
+            leases = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning("Leases file %s is empty or malformed. Starting with empty lease pool.", path)
+            return {}
+    for lease_info in leases.values():
+        lease_info.setdefault('is_static', False)
+    return leases
+
+def write_lease_snapshot(path, leases):
+    # Durably replace a snapshot: write a temporary file, fsync it, rename it over
+    # the old one and fsync the directory
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(leases, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_directory(path)
+
+def sync_directory(path):
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def shard_path(path, index):
+    # File of multiprocess worker `index`: leases.json -> leases.shard<index>.json
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{index}{ext}"
+
+def mac_shard(mac_bytes, workers):
+    # Index of the multiprocess worker that owns a client
+    return zlib.crc32(mac_bytes) % workers
+
+def lease_file_pairs(leases_file, journal_file, workers):
+    # (snapshot, journal) pairs holding the dynamic leases of a topology: the
+    # main pair with a single process (workers=0), one pair per worker otherwise
+    if not workers:
+        return [(leases_file, journal_file)]
+    return [(shard_path(leases_file, index), shard_path(journal_file, index)) for index in range(workers)]
+
+def read_lease_files(pairs):
+    # Snapshot + journals of every pair, merged without writing anything. A
+    # client found in several files keeps its static lease, else its newest one.
+    merged = {}
+    for snapshot_path, journal_path in pairs:
+        leases = load_lease_snapshot(snapshot_path)
+        LeaseJournal(snapshot_path, journal_path).read(leases)
+        for mac, lease_info in leases.items():
+            current = merged.get(mac)
+            if current is None or (lease_info['is_static'], lease_info['lease_time_end']) > (current['is_static'], current['lease_time_end']):
+                merged[mac] = lease_info
+    return merged
+
+def _shard_indexes(path):
+    # Worker indexes that have a shard file of `path` (or its rotated journal) on disk
+    base, ext = os.path.splitext(path)
+    directory, prefix = os.path.split(base)
+    pattern = re.compile(re.escape(prefix) + r'\.shard(\d+)' + re.escape(ext) + r'(\.compacting|\.reshard)?$')
+    try:
+        names = os.listdir(directory or '.')
+    except FileNotFoundError:
+        return set()
+    return {int(match.group(1)) for match in map(pattern.match, names) if match}
+
+class LeaseTopology:
+    # Which files hold the leases: the main leases.json + journal when a single
+    # process serves, or one snapshot + journal per worker in multiprocess mode
+    # (static leases stay in leases.json either way). The worker count the files
+    # were written for is recorded in <leases>.topology ({"workers": N}, absent
+    # for a single process). Before serving with another topology, reshard()
+    # reads every lease from the old files and writes them into the new ones,
+    # so changing DHCP_WORKERS or the serving mode never loses a lease.
+    # Resharding is crash safe: the new snapshots are staged as *.reshard files,
+    # the topology file is rewritten with "resharding": true as the commit
+    # point, and only then are the old files removed and the staged ones moved
+    # into place. A start that finds a committed reshard completes it; staged
+    # files without a commit are discarded and the reshard is redone.
+    def __init__(self, leases_file, journal_file):
+        self.leases_file = leases_file
+        self.journal_file = journal_file
+        self.path = os.path.splitext(leases_file)[0] + '.topology'
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        # (workers, resharding); workers is None when nothing was recorded
+        if not os.path.exists(self.path):
+            return None, False
+        with open(self.path, 'r') as f:
+            record = json.load(f)
+        return int(record['workers']), bool(record.get('resharding'))
+
+    def _write(self, workers, resharding):
+        record = {'workers': workers}
+        if resharding:
+            record['resharding'] = True
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        sync_directory(self.path)
+
+    def _files_on_disk(self):
+        # Every lease file either topology may have left behind, as (snapshot, journal) pairs
+        indexes = _shard_indexes(self.leases_file) | _shard_indexes(self.journal_file)
+        return [(self.leases_file, self.journal_file)] + [(shard_path(self.leases_file, index), shard_path(self.journal_file, index))
+                                                          for index in sorted(indexes)]
+
+    def _snapshots(self, workers):
+        # Snapshot paths of a topology; the main leases.json is always one of them
+        return [self.leases_file] + [snapshot for snapshot, _ in lease_file_pairs(self.leases_file, self.journal_file, workers)
+                                     if snapshot != self.leases_file]
+
+    def reshard(self, workers):
+        # Make the files match `workers` (0 = single process). Returns the number
+        # of leases moved, or None when the files already matched.
+        recorded, resharding = self.read()
+        if resharding:
+            self._finish(recorded)
+        else:
+            for snapshot, _ in self._files_on_disk():
+                if os.path.exists(snapshot + '.reshard'): # Staged by a reshard that never committed
+                    os.remove(snapshot + '.reshard')
+        if recorded is None and len(self._files_on_disk()) == 1:
+            recorded = 0 # Only the main files: a single process wrote them
+        if recorded == workers:
+            return None
+
+        if recorded is None:
+            # Written before topologies were recorded: take every file there is
+            sources = self._files_on_disk()
+            leases = read_lease_files(sources)
+        else:
+            leases = read_lease_files(lease_file_pairs(self.leases_file, self.journal_file, recorded))
+            if recorded:
+                leases.update((mac, lease_info) for mac, lease_info in load_lease_snapshot(self.leases_file).items() if lease_info['is_static'])
+        now = time.time()
+        leases = {mac: lease_info for mac, lease_info in leases.items() if lease_info['is_static'] or lease_info['lease_time_end'] > now}
+
+        staged = {self.leases_file: leases}
+        if workers:
+            staged = {snapshot: {} for snapshot in self._snapshots(workers)}
+            for mac, lease_info in leases.items():
+                if lease_info['is_static']:
+                    staged[self.leases_file][mac] = lease_info
+                    continue
+                try:
+                    owner = mac_shard(parse_mac(mac).to_bytes(6, 'big'), workers)
+                except ValueError:
+                    logger.warning("Dropping unreadable lease for %s while resharding", mac)
+                    continue
+                staged[shard_path(self.leases_file, owner)][mac] = lease_info
+        for snapshot, snapshot_leases in staged.items():
+            write_lease_snapshot(snapshot + '.reshard', snapshot_leases)
+        self._write(workers, resharding=True)
+        self._finish(workers)
+        logger.log(logging.WARNING if leases else logging.INFO, "Resharded %s leases from %s to %s.",
+                   len(leases), self._describe(recorded), self._describe(workers))
+        return len(leases)
+
+    def _finish(self, workers):
+        # Second half of a committed reshard: drop every journal and every
+        # snapshot outside the new topology, then move the staged snapshots in
+        keep = set(self._snapshots(workers))
+        for snapshot, journal in self._files_on_disk():
+            for path in (journal, journal + '.compacting'):
+                if os.path.exists(path):
+                    os.remove(path)
+            if snapshot not in keep and os.path.exists(snapshot):
+                os.remove(snapshot)
+        for snapshot in keep:
+            if os.path.exists(snapshot + '.reshard'):
+                os.replace(snapshot + '.reshard', snapshot)
+        if workers:
+            self._write(workers, resharding=False)
+        else:
+            os.remove(self.path)
+        sync_directory(self.path)
+
+    @staticmethod
+    def _describe(workers):
+        if workers is None:
+            return "unrecorded lease files"
+        return f"{workers} worker processes" if workers else "a single process"
+
+class ReplyCache:
+    # Recent replies keyed by (xid, giaddr, chaddr, message type). Clients
+    # retransmit DISCOVER and REQUEST with the same xid; a copy is answered
+    # with the stored reply without running the handler again. Bounded LRU,
+    # and an entry expires `ttl` seconds after it was last used.
+
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> [expires_at, reply, outcome]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        entry[0] = now + self.ttl # Retransmissions back off, so keep the entry alive while they keep coming
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+    def put(self, key, reply, outcome, now):
+        self._entries[key] = [now + self.ttl, reply, outcome]
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+class RateLimiter:
+    # Token bucket per key (client MAC or relay address): `rate` packets per
+    # second with bursts of up to `burst`. Buckets that have refilled
+    # completely carry no state worth keeping and are pruned when the table
+    # grows past max_keys.
+
+    def __init__(self, rate, burst, max_keys=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {} # key -> [tokens, last refill time]
+        self.dropped = 0
+
+    def allow(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            self._buckets[key] = [self.burst - 1, now]
+            return True
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.dropped += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < full_after}
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear() # Every key is active: forgetting them only lets each one burst once more
+
+class Histogram:
+    # Latency histogram with fixed buckets. observe() is a bisect and two
+    # in-place updates: nothing is allocated per observation.
+    BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 1e-1) # seconds
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1) # Last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+class Metrics:
+    # Counters and stage latency histograms for the packet path, rendered in
+    # the Prometheus text format. Counters are plain lists indexed by message
+    # type and outcome so that counting a packet allocates nothing. Every
+    # packet is counted; stages are timed on one packet in `sample`.
+    MESSAGE_TYPES = ('other', 'discover', 'offer', 'request', 'decline', 'ack', 'nak', 'release', 'inform') # Index = option 53 value
+    OUTCOMES = ('offer', 'ack', 'nak', 'released', 'ignored', 'malformed', 'error', 'rate_limited') # Index = OUTCOME_* constant
+    STAGES = ('parse', 'lease', 'persist', 'send', 'total')
+
+    def __init__(self, sample=1):
+        self.sample = sample
+        self.packets = [[0] * len(self.OUTCOMES) for _ in self.MESSAGE_TYPES]
+        self.parse_seconds = Histogram() # DHCPPacket construction and validation
+        self.lease_seconds = Histogram() # Scope selection, allocation and lease bookkeeping (the handler minus persist and send)
+        self.persist_seconds = Histogram() # Handing lease changes to the journal
+        self.send_seconds = Histogram() # sock.sendto of the reply
+        self.total_seconds = Histogram() # Whole of handle_dhcp_packet
+
+    def count(self, message_type, outcome):
+        self.packets[message_type if 0 < message_type < len(self.MESSAGE_TYPES) else 0][outcome] += 1
+
+    def render(self, gauges=()):
+        # gauges: (name, help, type, [(label string, value), ...]) sampled by the caller at scrape time
+        lines = [
+            '# HELP dhcp_packets_total DHCP packets received, by message type and outcome',
+            '# TYPE dhcp_packets_total counter',
+        ]
+        for type_index, outcomes in enumerate(self.packets):
+            for outcome_index, value in enumerate(outcomes):
+                if value:
+                    lines.append(f'dhcp_packets_total{{type="{self.MESSAGE_TYPES[type_index]}",outcome="{self.OUTCOMES[outcome_index]}"}} {value}')
+
+        lines.append('# HELP dhcp_stage_seconds Time spent in each stage of handling one packet (sampled packets only)')
+        lines.append('# TYPE dhcp_stage_seconds histogram')
+        for stage in self.STAGES:
+            histogram = getattr(self, f'{stage}_seconds')
+            cumulative = 0
+            for bound, value in zip(Histogram.BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += value
+                lines.append(f'dhcp_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'dhcp_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'dhcp_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        for name, help_text, kind, samples in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock QueueHandler formats every message before queueing it, which
+    # is the very work the queue is meant to take off the packet path. The
+    # arguments logged here are immutable, so the listener can format them.
+
+    def prepare(self, record):
+        return record
+
+class LogQueue:
+    # Moves the root logger's handlers behind a queue: a logging call only
+    # enqueues its record, and a listener thread formats and writes it, so a
+    # slow log file or terminal never holds up a reply.
+
+    def __init__(self):
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+
+    def start(self):
+        for handler in self.handlers:
+            self.root.removeHandler(handler)
+        self.root.addHandler(self.queue_handler)
+        self.listener.start()
+
+    def stop(self):
+        # Log synchronously again, then write out whatever is still queued
+        self.root.removeHandler(self.queue_handler)
+        for handler in self.handlers:
+            self.root.addHandler(handler)
+        self.listener.stop()
+
+class LogSuppressor(logging.Filter):
+    # Collapses repetitive log lines into periodic summaries. Within each
+    # interval at most repeat_limit identical lines (same message and
+    # arguments: the same event for the same client) and at most event_limit
+    # lines of one message template get through; the rest are only counted.
+    # When the interval ends, a summary is logged for each of the most
+    # repeated lines and one per template for whatever they do not cover.
+    # The packet loop, the journal writer and compactor and the metrics
+    # listener all log, so the counters are only touched under _lock; the
+    # summaries are logged after it is released.
+    SUMMARY_LINES = 20 # Repeated lines summarised one by one per interval
+
+    def __init__(self, interval=10.0, repeat_limit=5, event_limit=100, max_lines=65536):
+        super().__init__()
+        self.interval = interval
+        self.repeat_limit = repeat_limit
+        self.event_limit = event_limit
+        self.max_lines = max_lines
+        self._window_end = time.monotonic() + interval
+        self._lines = {} # (msg, args) -> [seen, suppressed, last suppressed record]
+        self._events = {} # msg -> [seen, suppressed, level]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if getattr(record, 'log_summary', False):
+            return True
+        now = time.monotonic()
+        if now >= self._window_end:
+            self.flush(now)
+        with self._lock:
+            event = self._events.get(record.msg)
+            if event is None:
+                event = self._events[record.msg] = [0, 0, record.levelno]
+            event[0] += 1
+            try:
+                key = (record.msg, record.args)
+                line = self._lines.get(key)
+                if line is None and len(self._lines) < self.max_lines:
+                    line = self._lines[key] = [0, 0, None]
+            except TypeError: # Unhashable arguments: limited per template only
+                line = None
+            if line is not None:
+                line[0] += 1
+            if event[0] <= self.event_limit and (line is None or line[0] <= self.repeat_limit):
+                return True
+            event[1] += 1
+            if line is not None and line[0] > self.repeat_limit: # Over the template limit alone: counted per template
+                line[1] += 1
+                line[2] = record
+            self.suppressed += 1
+        return False
+
+    def maybe_flush(self, now):
+        if now >= self._window_end and self._events:
+            self.flush(now)
+
+    def flush(self, now):
+        # Log the summaries of the interval that just ended and start the next one
+        with self._lock:
+            lines, events = self._lines, self._events
+            self._lines, self._events = {}, {}
+            self._window_end = now + self.interval
+        covered = {} # msg -> suppressed lines already summarised one by one
+        repeated = sorted((line for line in lines.values() if line[1]), key=lambda line: -line[1])
+        for _, suppressed, record in repeated[:self.SUMMARY_LINES]:
+            logger.log(record.levelno, "Suppressed %s repeats of \"%s\" in the last %gs", suppressed, record.getMessage(), self.interval,
+                       extra={'log_summary': True})
+            covered[record.msg] = covered.get(record.msg, 0) + suppressed
+        for msg, (_, suppressed, level) in events.items():
+            rest = suppressed - covered.get(msg, 0)
+            if rest:
+                logger.log(level, "Suppressed %s more \"%s\" lines in the last %gs", rest, msg, self.interval, extra={'log_summary': True})
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    # Serves GET /metrics from the render_metrics callable attached to the HTTPServer
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would otherwise flood the DHCP log
+
 class DHCPServer:
     LEASES_FILE = "/home/mkaas/Development/magicDNS_Python3/magicDHCP/dhcp-server/leases.json"
+    LEASE_STORES = ('memory', 'sqlite')
+    TICK_INTERVAL = 0.5 # seconds between housekeeping runs (lease expiry, compaction) when idle
+    SERVE_MODES = ('single', 'batch', 'multiprocess')
+    # Settings a reload cannot apply to a running server: sockets, lease storage,
+    # serving engine, metrics listener and log pipeline are set up once
+    RESTART_SETTINGS = ('DHCP_SERVER_IP', 'DHCP_SERVER_PORT', 'DHCP_CLIENT_PORT', 'DHCP_RELAY_PORT',
+                        'DHCP_LEASES_FILE', 'DHCP_LEGACY_LEASES_FILE', 'DHCP_LEASES_JOURNAL', 'DHCP_JOURNAL_FSYNC', 'DHCP_JOURNAL_BATCH_SIZE',
+                        'DHCP_JOURNAL_COMMIT_INTERVAL', 'DHCP_LEASE_STORE', 'DHCP_LEASE_DB', 'DHCP_SERVE_MODE',
+                        'DHCP_RECV_BATCH', 'DHCP_WORKERS', 'DHCP_METRICS_PORT', 'DHCP_METRICS_ADDR', 'DHCP_METRICS_SAMPLE',
+                        'DHCP_LOG_QUEUE', 'DHCP_LOG_SUMMARY_INTERVAL', 'DHCP_LOG_REPEAT_LIMIT', 'DHCP_LOG_EVENT_LIMIT')
 
-    def __init__(self):
+    def __init__(self, shard=None):
+        # Optional KEY=VALUE file layered over the environment, re-read on SIGHUP
+        self.config_file = os.getenv('DHCP_CONFIG_FILE', '')
+        if self.config_file:
+            apply_config_file(self.config_file)
+        self._restart_settings = {name: os.getenv(name) for name in self.RESTART_SETTINGS}
         self.server_ip = os.getenv('DHCP_SERVER_IP', '0.0.0.0')
+        self.server_port = int(os.getenv('DHCP_SERVER_PORT', '67'))
+        self.client_port = int(os.getenv('DHCP_CLIENT_PORT', '68'))
+        self.relay_port = int(os.getenv('DHCP_RELAY_PORT', '67')) # Port relay agents receive replies on
+        self._read_settings() # Scope, option, offer hold and rate limit settings: the ones a reload can change
+        self.sock = None
+
+        # Lease persistence: leases.json snapshot plus an append-only journal
+        self.leases_file, self.journal_file, self.legacy_leases_file = self.lease_file_settings()
+        self.journal_fsync = os.getenv('DHCP_JOURNAL_FSYNC', 'commit') # always | commit | never
+        self.journal_batch_size = int(os.getenv('DHCP_JOURNAL_BATCH_SIZE', '64'))
+        self.journal_commit_interval = float(os.getenv('DHCP_JOURNAL_COMMIT_INTERVAL', '0.05')) # seconds
+        self.lease_store = os.getenv('DHCP_LEASE_STORE', 'memory') # memory | sqlite (working copy on disk, for huge tables)
+        self.lease_db_file = os.getenv('DHCP_LEASE_DB', os.path.splitext(self.leases_file)[0] + '.db')
+
+        # Serving engine: one blocking loop, a batched loop, or several worker
+        # processes that each own the clients whose MAC hashes to their shard
+        self.serve_mode = os.getenv('DHCP_SERVE_MODE', 'single') # single | batch | multiprocess
+        self.recv_batch = int(os.getenv('DHCP_RECV_BATCH', '64')) # datagrams drained per wakeup
+        self.shard = shard # (index, count) when running as a multiprocess worker
+        self.handoff_socks = None # Per-worker socketpairs for forwarding unicast packets to their owner
+        self.snapshot_file = self.leases_file
+        self._other_shard_files = [] # (snapshot, journal) of the other workers, read at startup
+        if shard is not None:
+            self._other_shard_files = [pair for index, pair in enumerate(lease_file_pairs(self.leases_file, self.journal_file, shard[1]))
+                                       if index != shard[0]]
+            self.snapshot_file = shard_path(self.leases_file, shard[0])
+            self.journal_file = shard_path(self.journal_file, shard[0])
+            self.lease_db_file = shard_path(self.lease_db_file, shard[0])
+
+        # Metrics: instrumentation and the /metrics listener are on only when a port is set
+        self.metrics_port = int(os.getenv('DHCP_METRICS_PORT', '0')) # multiprocess workers use port + worker index
+        self.metrics_addr = os.getenv('DHCP_METRICS_ADDR', '127.0.0.1')
+        self.metrics_sample = int(os.getenv('DHCP_METRICS_SAMPLE', '16')) # time the stages of one packet in this many
+        self.metrics = Metrics(self.metrics_sample) if self.metrics_port else None
+        self._outcome = OUTCOME_IGNORED # Outcome of the packet being handled
+        self._timing = False # Whether the stages of the packet being handled are timed
+        self._sample_countdown = 1
+        self._io_seconds = 0.0 # Persist + send time of the packet being handled
+        self._parsed_at = 0.0
+
+        # Retransmission cache and per-client / per-relay rate limiting in front of the handlers
+        self.reply_cache = ReplyCache(self.reply_cache_size, self.reply_cache_ttl) if self.reply_cache_size > 0 else None
+        self.mac_limiter = RateLimiter(self.mac_rate_limit, self.mac_rate_burst) if self.mac_rate_limit > 0 else None
+        self.relay_limiter = RateLimiter(self.relay_rate_limit, self.relay_rate_burst) if self.relay_rate_limit > 0 else None
+        self._cache_key = None # Reply cache key of the packet being handled
+        self.replies_sent = [0] * len(DESTINATIONS) # Index = DESTINATION_* constant
+
+        # Logging: handlers run on a listener thread and repetitive lines are collapsed into summaries
+        self.log_queue = os.getenv('DHCP_LOG_QUEUE', '0') == '1' # 1 writes lines from a listener thread
+        self.log_summary_interval = float(os.getenv('DHCP_LOG_SUMMARY_INTERVAL', '10')) # seconds, 0 = no suppression
+        self.log_repeat_limit = int(os.getenv('DHCP_LOG_REPEAT_LIMIT', '5')) # identical lines per interval
+        self.log_event_limit = int(os.getenv('DHCP_LOG_EVENT_LIMIT', '100')) # lines per message template per interval
+        self.log_suppressor = None
+        if self.log_summary_interval > 0:
+            self.log_suppressor = LogSuppressor(self.log_summary_interval, self.log_repeat_limit, self.log_event_limit)
+        self._log_queue = None
+
+        # Reloads: requested by SIGHUP and applied by the housekeeping tick, between two packets
+        self._reload_requested = False
+        self.reloads = 0
+        self.reload_failures = 0
+        self.last_reload_seconds = 0.0
+
+        self.server_id = int(IPv4Address(self.server_ip)) # Server Identifier (option 54) that REQUESTs for us carry
+
+        try:
+            self.scope_index = self._build_scopes()
+            self._static_reservations = [] # (mac, ip) of the static leases in leases.json, served as reservations
+            self.reservations = self._load_reservations()
+            for scope in self.scope_index:
+                scope.ip_pool = IPPool(*scope.pool_range(self.shard), excluded=self.reservations.by_ip)
+                scope.offer_holds = OfferHolds(scope.ip_pool, self.offer_hold_time, max(1, int(scope.ip_pool.size * self.offer_hold_max)))
+            self._scopes_with_holds = set() # Scopes the housekeeping tick has to expire offer holds in
+            # Reserved clients are not written to the lease store, so the end of the
+            # lease each one was last acknowledged is kept here (MAC -> time). One
+            # not acknowledged since startup was at the latest just before it.
+            self._reserved_lease_ends = {}
+            self._started_at = time.time()
+            # The receiving interface only matters when there is more than one scope to choose from
+            self.want_pktinfo = self.shard is not None or len(self.scope_index) > 1
+
+            load_started = time.perf_counter()
+            if shard is None: # Workers get their files from run_workers, before they are forked
+                self.prepare_lease_files(0)
+            loaded = load_lease_snapshot(self.leases_file)
+            if shard is not None:
+                # The worker's own snapshot holds its dynamic leases; static leases
+                # are still maintained by hand in the main leases file
+                static_leases = {mac: lease_info for mac, lease_info in loaded.items() if lease_info['is_static']}
+                loaded = load_lease_snapshot(self.snapshot_file)
+                loaded.update(static_leases)
+            self.journal = LeaseJournal(self.snapshot_file, self.journal_file, self.journal_fsync,
+                                        self.journal_batch_size, self.journal_commit_interval, seed_path=self.leases_file)
+            replayed = self.journal.replay(loaded)
+            for mac, lease_info in read_lease_files(self._other_shard_files).items():
+                # Other workers' clients: _index_leases only keeps their addresses out of this worker's pools
+                loaded.setdefault(mac, lease_info)
+            if self.lease_store == 'memory':
+                self.leases = LeaseStore()
+            elif self.lease_store == 'sqlite':
+                self.leases = SqliteLeaseStore(self.lease_db_file)
+            else:
+                raise ValueError(f"Unknown lease store '{self.lease_store}' (expected one of {', '.join(self.LEASE_STORES)})")
+            self._index_leases(loaded, time.time())
+            logger.info("Loaded %s leases (%s journal records replayed) in %.3fs (%s of %s pool addresses free)",
+                        len(self.leases), replayed, time.perf_counter() - load_started,
+                        sum(scope.ip_pool.free_count for scope in self.scope_index), sum(scope.ip_pool.size for scope in self.scope_index))
+
+            if self.reservations_file:
+                logger.info("Reservations: %s (%s from %s)", len(self.reservations),
+                            len(self.reservations) - len(self._static_reservations), self.reservations_file)
+            logger.info("DHCP Server initialized.")
+            logger.info("Listening on: %s", self.server_ip)
+            if self.scopes_file:
+                logger.info("Scopes: %s loaded from %s (default scope %s: %s - %s)", len(self.scope_index), self.scopes_file,
+                            self.default_scope.name, self.default_scope.start_ip, self.default_scope.end_ip)
+            else:
+                logger.info("Lease Pool: %s - %s", self.lease_start_ip, self.lease_end_ip)
+                logger.info("Subnet Mask: %s", self.subnet_mask)
+                logger.info("Router: %s", self.router_ip)
+            logger.info("DNS Servers: %s", ', '.join(map(str, self.dns_servers)))
+            logger.info("Lease Time: %s seconds", self.lease_time)
+
+        except Exception as e:
+            logger.error("Error initializing DHCP server with provided environment variables: %s", e)
+            raise
+
+    def _read_settings(self):
+        # Everything reload() may change, as raw settings; _build_scopes parses them
         self.lease_start_ip_str = os.getenv('DHCP_LEASE_START_IP', '192.168.1.100')
         self.lease_end_ip_str = os.getenv('DHCP_LEASE_END_IP', '192.168.1.200')
         self.subnet_mask_str = os.getenv('DHCP_SUBNET_MASK', '255.255.255.0')
         self.router_ip_str = os.getenv('DHCP_ROUTER_IP', '192.168.1.1')
         self.dns_servers_str = os.getenv('DHCP_DNS_SERVERS', '8.8.8.8')
         self.lease_time = int(os.getenv('DHCP_LEASE_TIME', '3600')) # seconds
+        self.scopes_file = os.getenv('DHCP_SCOPES_FILE', '') # JSON list of scopes for relayed subnets
+        self.reservations_file = os.getenv('DHCP_RESERVATIONS_FILE', '') # CSV or JSON of MAC -> IP reservations
+        self.log_level = os.getenv('DHCP_LOG_LEVEL', 'INFO').upper()
+
+        # Offered addresses are held briefly instead of being leased on DISCOVER
+        self.offer_hold_time = float(os.getenv('DHCP_OFFER_HOLD_TIME', '30')) # seconds an offered address is held for its client
+        self.offer_hold_max = float(os.getenv('DHCP_OFFER_HOLD_MAX', '0.25')) # share of each scope's pool that offers may hold
+
+        # Retransmission cache and per-client / per-relay rate limiting in front of the handlers
+        self.reply_cache_size = int(os.getenv('DHCP_REPLY_CACHE_SIZE', '4096')) # 0 disables the cache
+        self.reply_cache_ttl = float(os.getenv('DHCP_REPLY_CACHE_TTL', '10')) # seconds since last use
+        self.mac_rate_limit = float(os.getenv('DHCP_MAC_RATE_LIMIT', '10')) # packets per second per client MAC, 0 = off
+        self.mac_rate_burst = int(os.getenv('DHCP_MAC_RATE_BURST', '20'))
+        self.relay_rate_limit = float(os.getenv('DHCP_RELAY_RATE_LIMIT', '0')) # packets per second per relay agent, 0 = off
+        self.relay_rate_burst = int(os.getenv('DHCP_RELAY_RATE_BURST', '500'))
 
         # NIS Configuration (RFC 2132, Options 64 and 65)
         self.nis_domain_name = os.getenv('DHCP_NIS_DOMAIN', '')
@@ -31,380 +1693,932 @@ class DHCPServer:
         self.boot_file_bios = os.getenv('BOOT_FILE_BIOS', '')
         self.boot_file_efi = os.getenv('BOOT_FILE_EFI', '')
 
+    def _load_reservations(self):
+        # The reservations file plus the static leases of leases.json. On a
+        # conflict the file wins and the static lease is only kept as a lease.
+        reservations = ReservationTable.load(self.reservations_file) if self.reservations_file else ReservationTable()
+        for mac, ip in self._static_reservations:
+            try:
+                reservations.add(mac, ip)
+            except ValueError as e:
+                logger.warning("Static lease of %s is not served as a reservation: %s", log_mac(mac), e)
+        return reservations
+
+    def _build_scopes(self):
+        # Parse the settings into addresses and scopes (without pools yet)
         self.pxe_server_ip = None
         if self.pxe_server_ip_str:
             self.pxe_server_ip = IPv4Address(self.pxe_server_ip_str)
+        self.lease_start_ip = IPv4Address(self.lease_start_ip_str)
+        self.lease_end_ip = IPv4Address(self.lease_end_ip_str)
+        self.subnet_mask = IPv4Address(self.subnet_mask_str)
+        self.router_ip = IPv4Address(self.router_ip_str)
+        self.dns_servers = [IPv4Address(ip.strip()) for ip in self.dns_servers_str.split(',')]
+
+        self.nis_server_ips = []
+        if self.nis_server_ips_str:
+            self.nis_server_ips = [IPv4Address(ip.strip()) for ip in self.nis_server_ips_str.split(',')]
+
+        # The environment describes the default scope. A scopes file replaces it
+        # with any number of subnets, the first of which becomes the default.
+        self.default_scope = Scope('default', IPv4Network(f"{self.lease_start_ip}/{self.subnet_mask}", strict=False),
+                                   self.lease_start_ip, self.lease_end_ip, self.router_ip, self.dns_servers,
+                                   self.lease_time, self.nis_domain_name, self.nis_server_ips)
+        scopes = [self.default_scope]
+        if self.scopes_file:
+            scopes = self._load_scopes(self.scopes_file)
+            self.default_scope = scopes[0]
+        return ScopeIndex(scopes)
+
+    def _owns_mac(self, mac_bytes):
+        return self.shard is None or mac_shard(mac_bytes, self.shard[1]) == self.shard[0]
 
+    def _load_scopes(self, path):
+        with open(path, 'r') as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get('scopes', [])
+        if not entries:
+            raise ValueError(f"No scopes defined in {path}")
+        return [Scope.from_config(entry, self.default_scope) for entry in entries]
+
+    def _pool_for(self, ip):
+        # Free pool of the scope an integer address belongs to, if any
+        scope = self.scope_index.lookup(ip)
+        return scope.ip_pool if scope is not None else None
+
+    def _select_scope(self, giaddr, ciaddr, local_ip):
+        # Relayed packets are served from the scope holding the relay's address.
+        # A direct packet from a client that already has an address (RENEWING or
+        # REBINDING, possibly behind a relay it now bypasses) is served from the
+        # scope holding ciaddr, any other from the scope of the interface it
+        # arrived on. With a single scope everything is served from it, as
+        # before scopes existed.
+        scope = None
+        if not giaddr and ciaddr:
+            scope = self.scope_index.lookup(ciaddr)
+        if scope is None:
+            scope = self.scope_index.lookup(giaddr or local_ip or 0)
+        if scope is None and (not giaddr or len(self.scope_index) == 1):
+            scope = self.default_scope
+        return scope
+
+    @classmethod
+    def lease_file_settings(cls):
+        # (leases file, journal file, legacy leases file) from the environment
+        leases_file = os.getenv('DHCP_LEASES_FILE', cls.LEASES_FILE)
+        journal_file = os.getenv('DHCP_LEASES_JOURNAL', os.path.splitext(leases_file)[0] + '.journal')
+        legacy_leases_file = os.getenv('DHCP_LEGACY_LEASES_FILE', '') # Imported once if there are no leases yet
+        return leases_file, journal_file, legacy_leases_file
+
+    @classmethod
+    def prepare_lease_files(cls, workers):
+        # Runs once before serving, in the process that owns all lease files: import
+        # the legacy leases file, then bring the files to the topology about to
+        # serve (0 = single process, else the number of workers)
+        leases_file, journal_file, legacy = cls.lease_file_settings()
+        topology = LeaseTopology(leases_file, journal_file)
+        cls._import_legacy_leases(legacy, leases_file, journal_file, topology)
+        topology.reshard(workers)
+
+    @staticmethod
+    def _import_legacy_leases(legacy, leases_file, journal_file, topology):
+        # One-time migration for deployments whose leases live at an older path
+        # (docker-compose used to mount ./leases.json at /app/leases.json): with
+        # no lease files at DHCP_LEASES_FILE yet, start from a copy of it.
+        if not legacy or not os.path.isfile(legacy) or os.path.abspath(legacy) == os.path.abspath(leases_file):
+            return
+        if os.path.exists(leases_file) or os.path.exists(journal_file) or topology.exists():
+            return
+        tmp_path = leases_file + '.tmp'
+        with open(legacy, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, leases_file)
+        logger.warning("Imported leases from legacy file %s into %s; %s is no longer read and can be removed.",
+                       legacy, leases_file, legacy)
+
+    def _index_leases(self, loaded, now):
+        # Single pass over the leases read from disk (MAC string -> lease dict):
+        # move them into the lease store and take every bound address out of the
+        # free pool. Expired dynamic leases are dropped; static leases always keep
+        # their address and are served as reservations. Reserved addresses are
+        # taken out of the pools last. A dynamic lease dropped for holding an
+        # address reserved for, or leased to, another client is journalled as
+        # removed, or compaction would carry it into the next snapshot.
+        expiry_entries = [] if self.lease_store == 'memory' else None # The SQLite store keeps its own expiry index
+        reservations = self.reservations
+        for mac_str, lease_info in loaded.items():
+            is_static = lease_info.get('is_static', False)
+            if not is_static and lease_info['lease_time_end'] <= now:
+                continue
+            try:
+                mac = parse_mac(mac_str)
+                ip = int(IPv4Address(lease_info['ip_address']))
+            except ValueError as e:
+                logger.warning("Skipping unreadable lease for %s: %s", mac_str, e)
+                continue
+            if is_static:
+                try:
+                    reservations.add(mac, ip)
+                    self._static_reservations.append((mac, ip))
+                except ValueError as e: # The reservations file wins
+                    logger.warning("Dropping static lease for %s: %s", mac_str, e)
+                    continue
+            elif reservations.by_ip.get(ip, mac) != mac:
+                logger.warning("Dropping lease for %s: IP %s is reserved for %s", mac_str, lease_info['ip_address'], format_mac(reservations.by_ip[ip]))
+                if self._owns_mac(mac.to_bytes(6, 'big')):
+                    self.journal.record(mac, None)
+                continue
+
+            ip_pool = self._pool_for(ip)
+            if not self._owns_mac(mac.to_bytes(6, 'big')):
+                # Another worker's client. After a reshard its address can lie in
+                # this worker's slice: keep it out of the pool until the next start.
+                # Static leases of other workers' clients are in the reservation
+                # table, which already keeps their addresses out of the pools.
+                if ip_pool is not None:
+                    ip_pool.reserve(ip)
+                continue
+
+            holder = self.leases.holder(ip)
+            if holder is not None:
+                # Two leases claim the same address. Keep the static one, else the newest.
+                if holder.is_static or (not is_static and holder.lease_time_end >= lease_info['lease_time_end']):
+                    logger.warning("Lease for %s duplicates IP %s held by %s. Dropping it.", mac_str, lease_info['ip_address'], format_mac(holder.mac))
+                    if not is_static:
+                        self.journal.record(mac, None)
+                    continue
+                logger.warning("Lease for %s duplicates IP %s held by %s. Dropping it.", format_mac(holder.mac), lease_info['ip_address'], mac_str)
+                self.leases.remove(holder.mac)
+                self.journal.record(holder.mac, None)
+
+            self.leases.put(Lease(mac, ip, lease_info['lease_time_end'], is_static))
+            if ip_pool is not None:
+                ip_pool.reserve(ip)
+            if not is_static and expiry_entries is not None:
+                expiry_entries.append((lease_info['lease_time_end'], mac))
+        self.expiry_queue = LeaseExpiryQueue(expiry_entries) if expiry_entries is not None else SqliteExpiryIndex(self.leases)
+        for ip in reservations.by_ip:
+            ip_pool = self._pool_for(ip)
+            if ip_pool is not None:
+                ip_pool.reserve(ip)
+
+    def _bind_lease(self, mac, ip, lease_time_end, is_static=False):
+        # Record a lease and keep the free pool in step with it. Returns False,
+        # binding nothing, if the address is leased to another client.
+        ip = int(ip)
         try:
-            self.lease_start_ip = IPv4Address(self.lease_start_ip_str)
-            self.lease_end_ip = IPv4Address(self.lease_end_ip_str)
-            self.subnet_mask = IPv4Address(self.subnet_mask_str)
-            self.router_ip = IPv4Address(self.router_ip_str)
-            self.dns_servers = [IPv4Address(ip.strip()) for ip in self.dns_servers_str.split(',')]
-            
-            self.nis_server_ips = []
-            if self.nis_server_ips_str:
-                self.nis_server_ips = [IPv4Address(ip.strip()) for ip in self.nis_server_ips_str.split(',')]
-
-            self.lease_pool = self._load_leases()
-            self.available_ips = set()
-            current_ip = self.lease_start_ip
-            while current_ip <= self.lease_end_ip:
-                ip_str = str(current_ip)
-                # Check if the IP is currently leased and if the lease is still active
-                is_leased_and_active = False
-                for mac, lease_info in self.lease_pool.items():
-                    if lease_info['ip_address'] == ip_str and lease_info['lease_time_end'] > time.time():
-                        is_leased_and_active = True
-                        break
-                
-                if not is_leased_and_active:
-                    self.available_ips.add(ip_str)
-                current_ip += 1
-
-            logger.info(f"DHCP Server initialized.")
-            logger.info(f"Listening on: {self.server_ip}")
-            logger.info(f"Lease Pool: {self.lease_start_ip} - {self.lease_end_ip}")
-            logger.info(f"Subnet Mask: {self.subnet_mask}")
-            logger.info(f"Router: {self.router_ip}")
-            logger.info(f"DNS Servers: {', '.join(map(str, self.dns_servers))}")
-            logger.info(f"Lease Time: {self.lease_time} seconds")
+            self.leases.put(Lease(mac, ip, lease_time_end, is_static))
+        except ValueError as e:
+            logger.error("Not leasing IP %s to %s: %s", log_ip(ip), log_mac(mac), e)
+            return False
+        ip_pool = self._pool_for(ip)
+        if ip_pool is not None:
+            ip_pool.reserve(ip)
+        if not is_static:
+            self.expiry_queue.schedule(mac, lease_time_end)
+        return True
+
+    def _renew_lease(self, mac, lease_time_end):
+        self.leases.renew(mac, lease_time_end)
+        self.expiry_queue.schedule(mac, lease_time_end)
+
+    def _reclaim_expired_leases(self, now):
+        # Return expired dynamic leases to the free pool
+        reclaimed = 0
+        for lease_time_end, mac in self.expiry_queue.pop_due(now):
+            lease = self.leases.get(mac)
+            if lease is None or lease.is_static or lease.lease_time_end > now:
+                continue # Released, made static or renewed since this entry was queued
+            self._drop_lease(mac)
+            self._save_lease(mac)
+            reclaimed += 1
+        if reclaimed:
+            self.expiry_queue.reclaimed_total += reclaimed
+            logger.info("Reclaimed %s expired leases (%s since startup)", reclaimed, self.expiry_queue.reclaimed_total)
+
+        # Renewals leave stale entries behind; rebuild before they dominate the heap
+        if len(self.expiry_queue) > 2 * len(self.leases) + 1024:
+            self.expiry_queue.rebuild(
+                (lease.lease_time_end, lease.mac)
+                for lease in self.leases
+                if not lease.is_static
+            )
+        return reclaimed
+
+    def _drop_lease(self, mac):
+        # Remove mac's lease and return its address to the free pool
+        lease = self.leases.remove(mac)
+        ip_pool = self._pool_for(lease.ip)
+        if ip_pool is not None:
+            ip_pool.release(lease.ip)
+        return lease
+
+    def _save_lease(self, mac):
+        # Journal the current state of one lease; it reaches disk with the next group commit
+        if not self._timing:
+            self.journal.record(mac, self.leases.get(mac))
+            return
+        started = time.perf_counter()
+        self.journal.record(mac, self.leases.get(mac))
+        elapsed = time.perf_counter() - started
+        self.metrics.persist_seconds.observe(elapsed)
+        self._io_seconds += elapsed
 
+    def _reply_destination(self, request, outcome):
+        # RFC 2131, Section 4.1: a relayed request is answered through its relay
+        # agent, a client that already has an address (ciaddr) by unicast to it
+        # and anything else by broadcast. A DHCPNAK to a directly attached client
+        # is always broadcast. Unicasting an offer to yiaddr would need an ARP
+        # entry for an address the client does not have yet, so those replies
+        # are broadcast too, as the RFC allows when unicast is not possible.
+        if request.giaddr:
+            return DESTINATION_RELAY, (format_ip(request.giaddr), self.relay_port)
+        if request.ciaddr and outcome != OUTCOME_NAK:
+            return DESTINATION_UNICAST, (format_ip(request.ciaddr), self.client_port)
+        return DESTINATION_BROADCAST, ('<broadcast>', self.client_port)
+
+    def _send_reply(self, reply, outcome, request):
+        self._outcome = outcome
+        if self._cache_key is not None:
+            self.reply_cache.put(self._cache_key, reply, outcome, time.monotonic())
+            self._cache_key = None
+        destination, addr = self._reply_destination(request, outcome)
+        self.replies_sent[destination] += 1
+        if not self._timing:
+            self.sock.sendto(reply, addr)
+            return
+        started = time.perf_counter()
+        self.sock.sendto(reply, addr)
+        elapsed = time.perf_counter() - started
+        self.metrics.send_seconds.observe(elapsed)
+        self._io_seconds += elapsed
+
+    def _run_periodic_tasks(self):
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload()
+        self._reclaim_expired_leases(time.time())
+        if self._scopes_with_holds:
+            now = time.monotonic()
+            for scope in list(self._scopes_with_holds):
+                scope.offer_holds.expire(now)
+                if not scope.offer_holds:
+                    self._scopes_with_holds.discard(scope)
+        self.journal.maybe_commit(time.monotonic())
+        self.leases.sync()
+        if self.log_suppressor is not None:
+            self.log_suppressor.maybe_flush(time.monotonic())
+        if self.journal.needs_compaction(len(self.leases)):
+            self.journal.compact()
+
+    def _request_reload(self, signum, frame):
+        # SIGHUP handler: only flags the reload, which the next housekeeping tick applies
+        self._reload_requested = True
+
+    def reload(self):
+        # Re-read the config file, the environment and the scopes file, and swap
+        # the result in, together with a fresh import of the reservations file.
+        # Scopes are matched by subnet: a scope that stays keeps its pool and
+        # offer holds, and a changed range resizes its pool in place, so leases
+        # are neither touched nor handed out twice. Every scope starts with
+        # empty reply templates, which re-encodes the option blocks on first use.
+        # A configuration that fails to load leaves the running one in force,
+        # and the environment as it was.
+        started = time.perf_counter()
+        previous = self.__dict__.copy()
+        environ = snapshot_environ()
+        try:
+            if self.config_file:
+                apply_config_file(self.config_file)
+            self._read_settings()
+            scope_index = self._build_scopes()
+            reservations = self._load_reservations()
+            logging.getLogger().setLevel(self.log_level)
         except Exception as e:
-            logger.error(f"Error initializing DHCP server with provided environment variables: {e}")
-            raise
+            self.__dict__.update(previous)
+            restore_environ(environ)
+            self.reload_failures += 1
+            logger.error("Configuration reload failed, keeping the running configuration: %s", e)
+            return False
 
-    def _load_leases(self):
-        if os.path.exists(self.LEASES_FILE):
-            with open(self.LEASES_FILE, 'r') as f:
-                try:
-                    leases = json.load(f)
-                    # Convert IP addresses back to IPv4Address objects if needed, or keep as strings
-                    # For simplicity, we'll keep them as strings in the lease_pool for now
-                    # Ensure 'is_static' flag is loaded correctly
-                    for mac, lease_info in leases.items():
-                        if 'is_static' not in lease_info:
-                            lease_info['is_static'] = False
-                    return leases
-                except json.JSONDecodeError:
-                    logger.warning(f"Leases file {self.LEASES_FILE} is empty or malformed. Starting with empty lease pool.")
-                    return {}
-        return {}
+        old_scopes = {scope.network: scope for scope in self.scope_index}
+        new_scopes = {}
+        added = resized = 0
+        for scope in scope_index:
+            start, end = scope.pool_range(self.shard)
+            old = old_scopes.pop(scope.network, None)
+            if old is None:
+                scope.ip_pool = IPPool(start, start - 1, reservations.by_ip) # Empty, then grown to the range below
+                scope.offer_holds = OfferHolds(scope.ip_pool, self.offer_hold_time, 1)
+                added += 1
+            else:
+                scope.ip_pool = old.ip_pool
+                scope.ip_pool.excluded = reservations.by_ip
+                scope.offer_holds = old.offer_holds
+                new_scopes[old] = scope
+                resized += (start, end) != (scope.ip_pool.start, scope.ip_pool.end)
+            if (start, end) != (scope.ip_pool.start, scope.ip_pool.end):
+                scope.offer_holds.drop_outside(start, end) # Or a regrown pool would hand them out again
+            scope.ip_pool.resize(start, end, self._is_bound)
+            scope.offer_holds.hold_time = self.offer_hold_time
+            scope.offer_holds.limit = max(1, int(scope.ip_pool.size * self.offer_hold_max))
+        for scope in old_scopes.values():
+            logger.warning("Scope %s (%s) was removed: its leases are kept until they expire or are released", scope.name, scope.network)
 
-    def _save_leases(self):
-        with open(self.LEASES_FILE, 'w') as f:
-            # Convert IPv4Address objects to strings for JSON serialization
-            serializable_lease_pool = {
-                mac: {
-                    'ip_address': str(lease_info['ip_address']),
-                    'lease_time_end': lease_info['lease_time_end'],
-                    'is_static': lease_info.get('is_static', False) # Add is_static flag
-                }
-                for mac, lease_info in self.lease_pool.items()
-            }
-            json.dump(serializable_lease_pool, f, indent=4)
+        self.scope_index = scope_index
+        self._apply_reservations(reservations)
+        self._scopes_with_holds = {new_scopes[scope] for scope in self._scopes_with_holds if scope in new_scopes}
+        if len(scope_index) > 1 and not self.want_pktinfo:
+            self.want_pktinfo = True
+            if self.sock is not None:
+                self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        if self.reply_cache_size <= 0:
+            self.reply_cache = None
+        elif self.reply_cache is None:
+            self.reply_cache = ReplyCache(self.reply_cache_size, self.reply_cache_ttl)
+        else:
+            self.reply_cache.capacity = self.reply_cache_size
+            self.reply_cache.ttl = self.reply_cache_ttl
+            self.reply_cache.clear() # Cached replies carry the old options
+        self.mac_limiter = self._updated_limiter(self.mac_limiter, self.mac_rate_limit, self.mac_rate_burst)
+        self.relay_limiter = self._updated_limiter(self.relay_limiter, self.relay_rate_limit, self.relay_rate_burst)
 
-    def start(self):
+        changed = [name for name, value in self._restart_settings.items() if os.getenv(name) != value]
+        if changed:
+            logger.warning("Not applied until the server is restarted: %s", ', '.join(changed))
+        self.reloads += 1
+        self.last_reload_seconds = time.perf_counter() - started
+        logger.info("Configuration reloaded in %.1f ms: %s scopes (%s added, %s removed, %s resized), %s reservations, %s leases kept",
+                    self.last_reload_seconds * 1e3, len(scope_index), added, len(old_scopes), resized, len(reservations), len(self.leases))
+        return True
+
+    def _apply_reservations(self, reservations):
+        # Swap in a re-imported reservation table. Newly reserved addresses leave
+        # the pools (one that is leased or held stays with its client until it is
+        # given up, and is not handed out again). An address that is no longer
+        # reserved for its client may still be in use by it: it becomes a dynamic
+        # lease of that client, ending when the last lease acknowledged to it
+        # does, and returns to the pool when that lease ends or is released.
+        previous = self.reservations
+        self.reservations = reservations
+        released = [(ip, mac) for ip, mac in previous.by_ip.items() if reservations.by_ip.get(ip) != mac]
+        held = set()
+        if released:
+            for scope in self.scope_index:
+                held |= scope.offer_holds.held_ips()
+        now = time.time()
+        for ip, mac in released:
+            lease_time_end = self._reserved_lease_ends.pop(mac, None)
+            scope = self.scope_index.lookup(ip)
+            if lease_time_end is None and scope is not None:
+                lease_time_end = self._started_at + scope.lease_time
+            if lease_time_end is not None and lease_time_end > now and mac not in self.leases:
+                if not self._owns_mac(mac.to_bytes(6, 'big')):
+                    continue # The owning worker leases it; here it stays out of the pool until the next start
+                if self._bind_lease(mac, ip, lease_time_end):
+                    self._save_lease(mac)
+                    logger.info("IP %s is no longer reserved for %s: leased to it for the remaining %.0fs", log_ip(ip), log_mac(mac), lease_time_end - now)
+                    continue
+            ip_pool = self._pool_for(ip)
+            if ip_pool is not None and ip not in held and ip not in reservations.by_ip and self.leases.holder(ip) is None:
+                ip_pool.release(ip)
+        for ip in reservations.by_ip.keys() - previous.by_ip.keys():
+            ip_pool = self._pool_for(ip)
+            if ip_pool is not None:
+                ip_pool.reserve(ip)
+
+    def _is_bound(self, ip):
+        # Whether a lease holds the integer address ip
+        return self.leases.holder(ip) is not None
+
+    @staticmethod
+    def _updated_limiter(limiter, rate, burst):
+        # A limiter whose rate changes keeps its buckets and drop count
+        if rate <= 0:
+            return None
+        if limiter is None:
+            return RateLimiter(rate, burst)
+        limiter.rate = rate
+        limiter.burst = burst
+        return limiter
+
+    def _open_socket(self):
         # DHCP servers listen on port 67 (BOOTP server)
         # Clients send requests from port 68 (BOOTP client)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1) # Allow broadcasting
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1) # Allow broadcasting
+        if self.shard is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Every worker binds the same port
+        if self.want_pktinfo:
+            sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1) # Receiving interface address, and broadcast vs unicast
         try:
-            self.sock.bind((self.server_ip, 67))
-            logger.info(f"DHCP server listening on {self.server_ip}:67")
+            sock.bind((self.server_ip, self.server_port))
+            logger.info("DHCP server listening on %s:%s", self.server_ip, self.server_port)
         except PermissionError:
-            logger.error("Permission denied. DHCP server requires root privileges to bind to port 67.")
+            logger.error("Permission denied. DHCP server requires root privileges to bind to port %s.", self.server_port)
             logger.error("Please run the script with sudo or as root (e.g., sudo python3 src/dhcp_server.py).")
             exit(1)
         except Exception as e:
-            logger.error(f"Failed to bind socket: {e}")
+            logger.error("Failed to bind socket: %s", e)
             exit(1)
+        return sock
+
+    def start(self):
+        if self.serve_mode not in self.SERVE_MODES:
+            logger.error("Unknown DHCP_SERVE_MODE '%s' (expected one of %s)", self.serve_mode, ', '.join(self.SERVE_MODES))
+            exit(1)
+        self.sock = self._open_socket()
+        self.journal.start_writer() # Group commits happen off the reply path from here on
+        if self.metrics is not None:
+            self._start_metrics_listener()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGHUP, self._request_reload)
+        self.start_logging() # Startup errors above are still written synchronously
+        try:
+            if self.serve_mode == 'single' and self.shard is None:
+                self._serve_single()
+            else:
+                self._serve_batched()
+        finally:
+            self.journal.close()
+            self.leases.close()
+            self.stop_logging()
+
+    def start_logging(self):
+        # Per serving process: every multiprocess worker runs its own listener thread
+        if self.log_suppressor is not None:
+            logger.addFilter(self.log_suppressor)
+        if self.log_queue:
+            self._log_queue = LogQueue()
+            self._log_queue.start()
+
+    def stop_logging(self):
+        if self.log_suppressor is not None:
+            self.log_suppressor.flush(time.monotonic())
+            logger.removeFilter(self.log_suppressor)
+        if self._log_queue is not None:
+            self._log_queue.stop()
+            self._log_queue = None
 
+    def _start_metrics_listener(self):
+        port = self.metrics_port + (self.shard[0] if self.shard is not None else 0)
+        try:
+            httpd = HTTPServer((self.metrics_addr, port), MetricsRequestHandler)
+        except OSError as e:
+            logger.error("Failed to start metrics listener on %s:%s: %s", self.metrics_addr, port, e)
+            return
+        httpd.render_metrics = self.render_metrics
+        threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.metrics_addr, port)
+
+    def render_metrics(self):
+        # Gauges are sampled here, at scrape time, rather than kept up to date per packet
+        scopes = list(self.scope_index)
+        return self.metrics.render([
+            ('dhcp_pool_free_addresses', 'Addresses available for allocation', 'gauge',
+             [(f'scope="{scope.name}"', scope.ip_pool.free_count) for scope in scopes]),
+            ('dhcp_pool_size_addresses', 'Addresses in the dynamic range', 'gauge',
+             [(f'scope="{scope.name}"', scope.ip_pool.size) for scope in scopes]),
+            ('dhcp_leases', 'Leases currently held, including static ones', 'gauge', [('', len(self.leases))]),
+            ('dhcp_reservations', 'Reserved MAC -> IP assignments, including static leases', 'gauge', [('', len(self.reservations))]),
+            ('dhcp_offer_holds', 'Offered addresses held for clients that have not REQUESTed them yet', 'gauge',
+             [(f'scope="{scope.name}"', len(scope.offer_holds)) for scope in scopes]),
+            ('dhcp_offer_holds_total', 'Offer holds that became leases or expired, and offers refused while too many were held', 'counter',
+             [('result="converted"', sum(scope.offer_holds.converted for scope in scopes)),
+              ('result="expired"', sum(scope.offer_holds.expired for scope in scopes)),
+              ('result="refused"', sum(scope.offer_holds.refused for scope in scopes))]),
+            ('dhcp_leases_reclaimed_total', 'Expired dynamic leases returned to the pool', 'counter', [('', self.expiry_queue.reclaimed_total)]),
+            ('dhcp_journal_commits_total', 'Group commits of the lease journal', 'counter', [('', self.journal.commits)]),
+            ('dhcp_journal_compactions_total', 'Lease journal compactions', 'counter', [('', self.journal.compactions)]),
+            ('dhcp_reply_cache_total', 'Retransmission cache lookups and evictions', 'counter',
+             [('result="hit"', self.reply_cache.hits), ('result="miss"', self.reply_cache.misses),
+              ('result="eviction"', self.reply_cache.evictions)] if self.reply_cache is not None else []),
+            ('dhcp_replies_total', 'Replies sent, by destination: relay agent, unicast to the client or broadcast', 'counter',
+             [(f'destination="{name}"', count) for name, count in zip(DESTINATIONS, self.replies_sent)]),
+            ('dhcp_config_reloads_total', 'Configuration reloads (SIGHUP), applied or rejected', 'counter',
+             [('result="applied"', self.reloads), ('result="rejected"', self.reload_failures)]),
+            ('dhcp_config_reload_seconds', 'Time the last applied configuration reload took', 'gauge', [('', self.last_reload_seconds)]),
+            ('dhcp_rate_limited_total', 'Packets dropped by the rate limiters before parsing', 'counter',
+             [('key="mac"', self.mac_limiter.dropped if self.mac_limiter is not None else 0),
+              ('key="relay"', self.relay_limiter.dropped if self.relay_limiter is not None else 0)]),
+        ])
+
+    def _serve_single(self):
+        # Wake up regularly even when idle so housekeeping still runs, but run it
+        # only once TICK_INTERVAL has passed, not after every packet
+        self.sock.settimeout(self.TICK_INTERVAL)
+        next_tick = time.monotonic() + self.TICK_INTERVAL
+        while True:
+            try:
+                data, addr, local_ip, _ = self._receive()
+                self.handle_dhcp_packet(data, addr, local_ip)
+            except socket.timeout:
+                pass
+            except Exception as e:
+                logger.error("Error receiving/handling packet: %s", e)
+            now = time.monotonic()
+            if now >= next_tick:
+                self._run_periodic_tasks()
+                next_tick = now + self.TICK_INTERVAL
+
+    def _serve_batched(self):
+        # Drain up to recv_batch datagrams per wakeup and run housekeeping once
+        # per batch instead of once per packet
+        self.sock.setblocking(False)
+        readers = [self.sock]
+        if self.shard is not None:
+            readers.append(self.handoff_socks[self.shard[0]][0])
         while True:
             try:
-                data, addr = self.sock.recvfrom(2048) # DHCP messages are typically small
-                self.handle_dhcp_packet(data, addr)
+                ready, _, _ = select.select(readers, [], [], self.TICK_INTERVAL)
+                for sock in ready:
+                    if sock is self.sock:
+                        self._drain_socket()
+                    else:
+                        self._drain_handoff(sock)
+            except Exception as e:
+                logger.error("Error receiving/handling packet: %s", e)
+            self._run_periodic_tasks()
+
+    def _receive(self):
+        # One datagram as (data, addr, local_ip, broadcast). Packet info is only
+        # asked for when something needs it; recvfrom is the cheaper call.
+        if not self.want_pktinfo:
+            data, addr = self.sock.recvfrom(2048) # DHCP messages are typically small
+            return data, addr, None, True
+        data, ancdata, _, addr = self.sock.recvmsg(2048, socket.CMSG_SPACE(12))
+        local_ip, broadcast = self._packet_info(ancdata)
+        return data, addr, local_ip, broadcast
+
+    def _drain_socket(self):
+        for _ in range(self.recv_batch):
+            try:
+                data, addr, local_ip, broadcast = self._receive()
+                if self.shard is None:
+                    self.handle_dhcp_packet(data, addr, local_ip)
+                else:
+                    self._dispatch_sharded(data, addr, local_ip, broadcast)
+            except BlockingIOError:
+                return
             except Exception as e:
-                logger.error(f"Error receiving/handling packet: {e}")
+                logger.error("Error receiving/handling packet: %s", e)
+
+    def _dispatch_sharded(self, data, addr, local_ip, broadcast):
+        # Broadcasts reach every worker, so only the owner of the client's MAC
+        # answers them. Unicasts (relays, renewals) reach one worker chosen by
+        # the kernel, which hands them over to the owner if needed.
+        index, count = self.shard
+        owner = mac_shard(data[28:34], count)
+        if owner == index:
+            self.handle_dhcp_packet(data, addr, local_ip)
+        elif not broadcast:
+            try:
+                self.handoff_socks[owner][1].send(socket.inet_aton(addr[0]) + struct.pack('!HI', addr[1], local_ip or 0) + data)
+            except BlockingIOError:
+                logger.warning("Handoff queue to worker %s is full, dropping packet from %s:%s", owner, addr[0], addr[1])
+
+    @staticmethod
+    def _packet_info(ancdata):
+        # (address of the receiving interface, whether the datagram was broadcast)
+        for level, ctype, cdata in ancdata:
+            if level == socket.IPPROTO_IP and ctype == IP_PKTINFO:
+                _, local_addr, dest_addr = struct.unpack('=i4s4s', cdata[:12])
+                return int.from_bytes(local_addr, 'big'), dest_addr != local_addr
+        return None, True # Without packet info, leave the packet to the worker that owns it
 
-    def handle_dhcp_packet(self, data, addr):
-        # Unpack DHCP header - Simplified, assumes standard BOOTP/DHCP structure
+    def _drain_handoff(self, sock):
+        for _ in range(self.recv_batch):
+            try:
+                message = sock.recv(2048 + 10)
+            except BlockingIOError:
+                return
+            port, local_ip = struct.unpack_from('!HI', message, 4)
+            self.handle_dhcp_packet(message[10:], (socket.inet_ntoa(message[:4]), port), local_ip or None)
+
+    def handle_dhcp_packet(self, data, addr, local_ip=None):
+        metrics = self.metrics
+        if metrics is None:
+            self._handle_dhcp_packet(data, addr, local_ip)
+            return
+        self._outcome = OUTCOME_IGNORED
+        self._sample_countdown -= 1
+        if self._sample_countdown:
+            message_type = self._handle_dhcp_packet(data, addr, local_ip)
+            metrics.count(message_type or 0, self._outcome)
+            return
+
+        self._sample_countdown = metrics.sample
+        self._timing = True
+        self._parsed_at = 0.0
+        self._io_seconds = 0.0
+        started = time.perf_counter()
+        message_type = self._handle_dhcp_packet(data, addr, local_ip)
+        finished = time.perf_counter()
+        self._timing = False
+        metrics.count(message_type or 0, self._outcome)
+        metrics.total_seconds.observe(finished - started)
+        if self._parsed_at:
+            metrics.parse_seconds.observe(self._parsed_at - started)
+            metrics.lease_seconds.observe(finished - self._parsed_at - self._io_seconds)
+
+    def _handle_dhcp_packet(self, data, addr, local_ip):
         # See RFC 2131 for full DHCP packet format
         # https://www.rfc-editor.org/rfc/rfc2131.html Section 2
-        # op, htype, hlen, hops, xid, secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr (6 bytes)
-        try:
-            # We'll parse only the crucial parts for this example
-            op, htype, hlen, hops, xid, secs, flags = struct.unpack('!BBBBHHI', data[0:8])
-            # ciaddr (client IP address), yiaddr (your IP address), siaddr (server IP address), giaddr (gateway IP address)
-            ciaddr, yiaddr, siaddr, giaddr = struct.unpack('!IIII', data[8:24])
-            chaddr = data[28:34] # Client hardware address (MAC)
-            
-            # DHCP magic cookie: 99.130.83.99 (RFC 2131, Section 2)
-            magic_cookie = data[236:240] 
-
-            if magic_cookie != b'\x63\x82\x53\x63':
-                logger.warning(f"Received non-DHCP packet from {addr[0]}:{addr[1]}. Magic cookie mismatch.")
-                return
+        # Returns the message type, or None for packets dropped as malformed or rate limited
+        self._cache_key = None
+        now = time.monotonic()
+        if len(data) >= 34:
+            # Shed floods before spending anything on parsing: giaddr is at 24, chaddr at 28
+            if self.relay_limiter is not None and data[24:28] != b'\x00\x00\x00\x00' and not self.relay_limiter.allow(data[24:28], now):
+                self._outcome = OUTCOME_RATE_LIMITED
+                return None
+            if self.mac_limiter is not None and not self.mac_limiter.allow(data[28:34], now):
+                self._outcome = OUTCOME_RATE_LIMITED
+                return None
 
-            options_offset = 240
-            options = self.parse_dhcp_options(data[options_offset:])
+        try:
+            packet = DHCPPacket(data)
+        except ValueError as e:
+            logger.warning("Malformed DHCP packet from %s:%s: %s", addr[0], addr[1], e)
+            self._outcome = OUTCOME_MALFORMED
+            return None
 
-            message_type = options.get(53) # DHCP Message Type option
+        if not packet.has_magic_cookie:
+            logger.warning("Received non-DHCP packet from %s:%s. Magic cookie mismatch.", addr[0], addr[1])
+            self._outcome = OUTCOME_MALFORMED
+            return None
+        if packet.truncated:
+            logger.warning("Malformed DHCP packet from %s:%s: options run past the end of the packet", addr[0], addr[1])
+            self._outcome = OUTCOME_MALFORMED
+            return None
+        if self._timing:
+            self._parsed_at = time.perf_counter()
 
-            if message_type == 1: # DHCPDISCOVER
-                self.handle_discover(xid, chaddr, giaddr, addr[0], options)
-            elif message_type == 3: # DHCPREQUEST
-                self.handle_request(xid, chaddr, ciaddr, giaddr, addr[0], options)
-            elif message_type == 7: # DHCPRELEASE
-                self.handle_release(chaddr)
+        message_type = None
+        try:
+            message_type = packet.message_type # DHCP Message Type option
+            if message_type == DHCPDISCOVER or message_type == DHCPREQUEST:
+                if self.reply_cache is not None:
+                    cache_key = (packet.xid, packet.giaddr, packet.chaddr, message_type)
+                    cached = self.reply_cache.get(cache_key, now)
+                    if cached is not None: # Retransmission: answer again without touching lease state
+                        self._send_reply(cached[1], cached[2], packet)
+                        return message_type
+                    self._cache_key = cache_key
+                scope = self._select_scope(packet.giaddr, packet.ciaddr, local_ip)
+                if scope is None:
+                    logger.warning("No scope configured for relay %s, ignoring packet from %s", log_ip(packet.giaddr), log_mac(packet.mac))
+                    return message_type
+                if message_type == DHCPDISCOVER:
+                    self.handle_discover(packet, addr[0], scope)
+                else:
+                    self.handle_request(packet, addr[0], scope)
+            elif message_type == DHCPRELEASE:
+                self.handle_release(packet)
             # Add more handlers as needed (e.g., DHCPDECLINE, DHCPINFORM)
             else:
-                logger.info(f"Received unknown DHCP message type {message_type} from {self.mac_to_str(chaddr)}")
-
-        except struct.error as e:
-            logger.warning(f"Malformed DHCP packet from {addr[0]}:{addr[1]}: {e}")
+                logger.info("Received unknown DHCP message type %s from %s", message_type, log_mac(packet.mac))
         except Exception as e:
-            logger.error(f"Error handling DHCP packet from {addr[0]}:{addr[1]}: {e}")
-
-    def parse_dhcp_options(self, options_data):
-        options = {}
-        idx = 0
-        while idx < len(options_data):
-            option_code = options_data[idx]
-            if option_code == 255: # End option
-                break
-            elif option_code == 0: # Pad option
-                idx += 1
-                continue
-            
-            length = options_data[idx + 1]
-            value = options_data[idx + 2 : idx + 2 + length]
-            options[option_code] = self.parse_option_value(option_code, value)
-            idx += 2 + length
-        return options
+            logger.error("Error handling DHCP packet from %s:%s: %s", addr[0], addr[1], e)
+            self._outcome = OUTCOME_ERROR
+        return message_type
+
+    def _reserved_ip(self, mac, scope):
+        # mac's reserved address if it can be served in scope: inside the scope's
+        # subnet and not still leased to another client (a reservation added by a
+        # reload waits until such a lease ends)
+        ip = self.reservations.by_mac.get(mac)
+        if ip is None or ip not in scope:
+            return None
+        holder = self.leases.holder(ip)
+        if holder is not None and holder.mac != mac:
+            logger.warning("Reserved IP %s of %s is still leased to %s", log_ip(ip), log_mac(mac), log_mac(holder.mac))
+            return None
+        return ip
+
+    def handle_discover(self, packet, client_ip, scope):
+        chaddr = packet.chaddr
+        mac = packet.mac
+        client = log_mac(mac) # Formatted only if a line about it is written
+        logger.info("Received DHCPDISCOVER from %s", client)
+
+        reserved_ip = self._reserved_ip(mac, scope)
+        lease = self.leases.get(mac)
+        if reserved_ip is None and lease is not None and not lease.is_static and lease.ip not in scope:
+            # The client moved to another subnet; its old address is no use there
+            logger.info("Client %s moved to scope %s, releasing %s", client, scope.name, log_ip(lease.ip))
+            self._drop_lease(mac)
+            self._save_lease(mac)
+            lease = None
 
-    def parse_option_value(self, code, value):
-        if code == 53: # DHCP Message Type
-            return int.from_bytes(value, 'big')
-        elif code == 50: # Requested IP Address
-            return IPv4Address(value)
-        elif code == 54: # Server Identifier
-            return IPv4Address(value)
-        elif code == 61: # Client Identifier (often MAC address)
-            return value # Return as bytes
-        elif code == 93: # Client System Architecture
-            # See RFC 4578 for details on Option 93
-            # https://www.rfc-editor.org/rfc/rfc4578.html
-            # Value is a list of 16-bit unsigned integers
-            architectures = []
-            for i in range(0, len(value), 2):
-                architectures.append(struct.unpack('!H', value[i:i+2])[0])
-            return architectures
-        return value # Return raw bytes for other options
-
-    def mac_to_str(self, mac_bytes):
-        return ':'.join(f'{b:02x}' for b in mac_bytes)
-
-    def str_to_mac(self, mac_str):
-        return bytes.fromhex(mac_str.replace(':', ''))
-
-    def handle_discover(self, xid, chaddr, giaddr, client_ip, options):
-        mac_str = self.mac_to_str(chaddr)
-        logger.info(f"Received DHCPDISCOVER from {mac_str}")
-
-        assigned_ip = None
+        if reserved_ip is not None: # Answered from the reservation table, nothing to hold or write
+            assigned_ip = reserved_ip
+            logger.info("Offering reserved IP %s to %s", log_ip(assigned_ip), client)
         # Check if MAC already has a lease
-        if mac_str in self.lease_pool:
-            assigned_ip = self.lease_pool[mac_str]['ip_address']
-            logger.info(f"Re-offering existing IP {assigned_ip} to {mac_str}")
+        elif lease is not None:
+            assigned_ip = lease.ip
+            logger.info("Re-offering existing IP %s to %s", log_ip(assigned_ip), client)
         else:
-            # Find an available IP
-            for ip_str in sorted(list(self.available_ips)): # Sort for consistent assignment
-                if ip_str not in [self.lease_pool[mac]['ip_address'] for mac in self.lease_pool]:
-                    assigned_ip = IPv4Address(ip_str)
-                    break
-            
-            if not assigned_ip:
-                logger.warning(f"No available IP addresses in pool for {mac_str}.")
+            # Hold the lowest free IP of the scope's pool until the client REQUESTs it
+            assigned_ip = scope.offer_holds.offer(mac, time.monotonic())
+            if assigned_ip is None:
+                if scope.offer_holds.full:
+                    logger.warning("Too many outstanding offers in scope %s, not answering DISCOVER from %s.", scope.name, client)
+                else:
+                    logger.warning("No available IP addresses in scope %s for %s.", scope.name, client)
                 return # Cannot offer an IP
 
-            self.lease_pool[mac_str] = {
-                'ip_address': assigned_ip,
-                'lease_time_end': time.time() + self.lease_time
-            }
-            self.available_ips.discard(str(assigned_ip)) # Remove from available pool
-            logger.info(f"Offering new IP {assigned_ip} to {mac_str}")
+            self._scopes_with_holds.add(scope)
+            logger.info("Offering new IP %s to %s", log_ip(assigned_ip), client)
         
+        boot_file = self._select_boot_file(packet.client_arch)
+        if boot_file:
+            logger.info("Client %s is PXE booting, offering bootfile: %s", client, boot_file.decode())
+
         # Build DHCPOFFER packet
-        offer_options = {
-            1: self.subnet_mask.packed, # Subnet Mask
-            3: self.router_ip.packed, # Router (Gateway)
-            6: b''.join([dns.packed for dns in self.dns_servers]), # DNS Servers
-            51: struct.pack('!I', self.lease_time), # IP Address Lease Time
-            54: IPv4Address(self.server_ip).packed # Server Identifier
-        }
-
-        if self.nis_domain_name:
-            offer_options[64] = self.nis_domain_name.encode() # Option 64: NIS Domain Name
-        if self.nis_server_ips:
-            offer_options[65] = b''.join([ip.packed for ip in self.nis_server_ips]) # Option 65: NIS Server Addresses
-
-        boot_file = b''
-        if self.pxe_server_ip and (self.boot_file_bios or self.boot_file_efi):
-            # Option 93: Client System Architecture
-            client_arch = options.get(93)
-            if client_arch and (4 in client_arch or 6 in client_arch or 7 in client_arch or 9 in client_arch): # EFI architectures
-                if self.boot_file_efi:
-                    boot_file = self.boot_file_efi.encode()
-                    logger.info(f"Client {mac_str} is EFI, offering bootfile: {self.boot_file_efi}")
-            elif self.boot_file_bios: # Assume BIOS if no EFI arch or no EFI bootfile
-                boot_file = self.boot_file_bios.encode()
-                logger.info(f"Client {mac_str} is BIOS or unknown, offering bootfile: {self.boot_file_bios}")
-            
-            if boot_file:
-                offer_options[67] = boot_file # Option 67: Bootfile Name
-
-        offer_packet = self.build_dhcp_packet(
-            op=2, # BOOTREPLY
-            xid=xid,
+        offer_packet = self._reply_template(scope, DHCPOFFER, boot_file).render(
+            xid=packet.xid,
+            flags=packet.flags, # Echoed, so a relay knows whether to broadcast
             ciaddr=0, # Client IP is 0.0.0.0 in discover
-            yiaddr=int(assigned_ip), # Your IP address
-            siaddr=int(self.pxe_server_ip) if self.pxe_server_ip else int(IPv4Address(self.server_ip)), # Next server IP address (TFTP server)
-            giaddr=giaddr, # Gateway IP address (from client)
+            yiaddr=assigned_ip, # Your IP address
+            giaddr=packet.giaddr, # Gateway IP address (from client)
             chaddr=chaddr,
-            message_type=2, # DHCPOFFER
-            file=boot_file, # Boot file name in fixed field
-            options=offer_options
+            lease_time=scope.lease_time
         )
-        self.sock.sendto(offer_packet, ('<broadcast>', 68)) # Send to broadcast, client listens on 68
+        self._send_reply(offer_packet, OUTCOME_OFFER, packet)
 
-    def handle_request(self, xid, chaddr, ciaddr, giaddr, client_ip_from_packet, options):
-        mac_str = self.mac_to_str(chaddr)
-        requested_ip = options.get(50) # Requested IP Address option
-        server_identifier = options.get(54) # Server Identifier option
+    def handle_request(self, packet, client_ip_from_packet, scope):
+        chaddr = packet.chaddr
+        mac = packet.mac
+        client = log_mac(mac) # Formatted only if a line about it is written
+        requested_ip = packet.requested_ip # Requested IP Address option, as an integer
+        server_identifier = packet.server_identifier # Server Identifier option, as an integer
 
-        logger.info(f"Received DHCPREQUEST from {mac_str}. Requested IP: {requested_ip}, Server ID: {server_identifier}")
+        logger.info("Received DHCPREQUEST from %s. Requested IP: %s, Server ID: %s", client, log_ip(requested_ip), log_ip(server_identifier))
 
-        assigned_ip = None
-        ack_nack_type = 6 # DHCPACK by default
-        
+        # Ensure the request is for *this* server if Server Identifier is present
+        if server_identifier is not None and server_identifier != self.server_id:
+            scope.offer_holds.release(mac) # The client took another server's offer
+            logger.warning("Client %s requested IP %s from another server %s. Ignoring.", client, log_ip(requested_ip), log_ip(server_identifier))
+            return # Ignore request meant for another server
+
+        lease = self.leases.get(mac)
+        assigned_ip = 0 # For NAK, yiaddr is 0
+        ack_nack_type = DHCPACK # DHCPACK by default
+        reserved_ip = self._reserved_ip(mac, scope)
+
+        # Scenario 0: Reserved client. Answered from the reservation table without writing anything.
+        if reserved_ip is not None:
+            wanted_ip = requested_ip if requested_ip is not None else packet.ciaddr
+            if wanted_ip and wanted_ip != reserved_ip:
+                logger.warning("Client %s requested IP %s but has reserved IP %s. Sending DHCPNAK.", client, log_ip(wanted_ip), log_ip(reserved_ip))
+                ack_nack_type = DHCPNAK
+            else:
+                assigned_ip = reserved_ip
+                scope.offer_holds.release(mac) # Offered before the reservation existed
+                if lease is not None and lease.ip != reserved_ip: # Dynamic lease from before the reservation
+                    self._drop_lease(mac)
+                    self._save_lease(mac)
+                self._reserved_lease_ends[mac] = time.time() + scope.lease_time
+                logger.info("Acknowledging reserved IP %s for %s", log_ip(assigned_ip), client)
         # Scenario 1: Client requesting a specific IP (from DHCPDISCOVER)
-        if requested_ip:
-            # Check if the requested IP is a static lease for this MAC
-            if mac_str in self.lease_pool and self.lease_pool[mac_str].get('is_static', False) and self.lease_pool[mac_str]['ip_address'] == str(requested_ip):
+        elif requested_ip is not None:
+            held_ip = scope.offer_holds.get(mac, time.monotonic())
+            if requested_ip in scope and (scope.ip_pool.is_free(requested_ip) or (lease is not None and lease.ip == requested_ip)
+                                            or (held_ip == requested_ip and requested_ip not in self.reservations.by_ip # A hold lapses if a reload reserves its address
+                                                and self.leases.holder(requested_ip) is None)):
                 assigned_ip = requested_ip
-                self.lease_pool[mac_str]['lease_time_end'] = time.time() + (365 * 24 * 3600) # 1 year for static
-                self._save_leases()
-                logger.info(f"Acknowledging static lease for {mac_str} with IP {assigned_ip}")
-            elif str(requested_ip) in self.available_ips or (mac_str in self.lease_pool and self.lease_pool[mac_str]['ip_address'] == str(requested_ip)):
-                # Ensure the request is for *this* server if Server Identifier is present
-                if server_identifier and server_identifier != IPv4Address(self.server_ip):
-                    logger.warning(f"Client {mac_str} requested IP {requested_ip} from another server {server_identifier}. Ignoring.")
-                    return # Ignore request meant for another server
-                
-                assigned_ip = requested_ip
-                if mac_str not in self.lease_pool: # New dynamic lease
-                    self.lease_pool[mac_str] = {
-                        'ip_address': str(assigned_ip),
-                        'lease_time_end': time.time() + self.lease_time,
-                        'is_static': False
-                    }
-                    self.available_ips.discard(str(assigned_ip))
-                    self._save_leases() # Save leases after modification
-                    logger.info(f"Acknowledging new dynamic lease for {mac_str} with IP {assigned_ip}")
+                if lease is None or lease.ip != assigned_ip: # New dynamic lease
+                    if lease is not None: # Client moved to a different free IP, give the old one back
+                        self._drop_lease(mac)
+                    scope.offer_holds.claim(mac, assigned_ip) # The offer, if any, becomes the lease
+                    if self._bind_lease(mac, assigned_ip, time.time() + scope.lease_time):
+                        logger.info("Acknowledging new dynamic lease for %s with IP %s", client, log_ip(assigned_ip))
+                    else:
+                        assigned_ip = 0
+                        ack_nack_type = DHCPNAK
+                    self._save_lease(mac) # Save leases after modification
                 else: # Renewing existing dynamic lease
-                    self.lease_pool[mac_str]['lease_time_end'] = time.time() + self.lease_time
-                    self._save_leases() # Save leases after modification
-                    logger.info(f"Renewing dynamic lease for {mac_str} with IP {assigned_ip}")
-            else:
-                logger.warning(f"Client {mac_str} requested unavailable or invalid IP {requested_ip}. Sending DHCPNAK.")
-                ack_nack_type = 4 # DHCPNAK
-                assigned_ip = IPv4Address('0.0.0.0') # For NAK, yiaddr is 0
-        # Scenario 2: Client re-booting after successful lease (no requested_ip)
-        elif mac_str in self.lease_pool:
-            lease_info = self.lease_pool[mac_str]
-            assigned_ip = IPv4Address(lease_info['ip_address'])
-            if lease_info.get('is_static', False):
-                lease_info['lease_time_end'] = time.time() + (365 * 24 * 3600) # 1 year for static
-                logger.info(f"Client {mac_str} re-booting, acknowledging static lease for IP {assigned_ip}")
+                    self._renew_lease(mac, time.time() + scope.lease_time)
+                    self._save_lease(mac) # Save leases after modification
+                    logger.info("Renewing dynamic lease for %s with IP %s", client, log_ip(assigned_ip))
             else:
-                lease_info['lease_time_end'] = time.time() + self.lease_time
-                logger.info(f"Client {mac_str} re-booting, acknowledging existing dynamic lease for IP {assigned_ip}")
-            self._save_leases() # Save leases after modification
+                logger.warning("Client %s requested unavailable or invalid IP %s in scope %s. Sending DHCPNAK.", client, log_ip(requested_ip), scope.name)
+                ack_nack_type = DHCPNAK
+        # Scenario 2: Client re-booting after successful lease (no requested_ip).
+        # Static leases are served as reservations (scenario 0) in their own scope only.
+        elif lease is not None and not lease.is_static:
+            assigned_ip = lease.ip
+            self._renew_lease(mac, time.time() + scope.lease_time)
+            logger.info("Client %s re-booting, acknowledging existing dynamic lease for IP %s", client, log_ip(assigned_ip))
+            self._save_lease(mac) # Save leases after modification
         else:
-            logger.warning(f"Client {mac_str} sent DHCPREQUEST without requested IP and no existing lease. Sending DHCPNAK.")
-            ack_nack_type = 4 # DHCPNAK
-            assigned_ip = IPv4Address('0.0.0.0')
+            logger.warning("Client %s sent DHCPREQUEST without requested IP and no existing lease. Sending DHCPNAK.", client)
+            ack_nack_type = DHCPNAK
 
         # Build DHCPACK or DHCPNAK packet
-        ack_options = {
-            1: self.subnet_mask.packed, # Subnet Mask
-            3: self.router_ip.packed, # Router (Gateway)
-            6: b''.join([dns.packed for dns in self.dns_servers]), # DNS Servers
-            51: struct.pack('!I', self.lease_time), # IP Address Lease Time
-            54: IPv4Address(self.server_ip).packed # Server Identifier
-        }
-
-        if self.nis_domain_name:
-            ack_options[64] = self.nis_domain_name.encode() # Option 64: NIS Domain Name
-        if self.nis_server_ips:
-            ack_options[65] = b''.join([ip.packed for ip in self.nis_server_ips]) # Option 65: NIS Server Addresses
-
-        boot_file = b''
-        if self.pxe_server_ip and (self.boot_file_bios or self.boot_file_efi):
-            client_arch = options.get(93)
-            if client_arch and (4 in client_arch or 6 in client_arch or 7 in client_arch or 9 in client_arch): # EFI architectures
-                if self.boot_file_efi:
-                    boot_file = self.boot_file_efi.encode()
-            elif self.boot_file_bios:
-                boot_file = self.boot_file_bios.encode()
-            
-            if boot_file:
-                ack_options[67] = boot_file # Option 67: Bootfile Name
-
-        ack_packet = self.build_dhcp_packet(
-            op=2, # BOOTREPLY
-            xid=xid,
-            ciaddr=int(ciaddr) if ciaddr != 0 else 0, # Client IP if known, else 0
-            yiaddr=int(assigned_ip),
-            siaddr=int(self.pxe_server_ip) if self.pxe_server_ip else int(IPv4Address(self.server_ip)),
-            giaddr=giaddr,
+        flags = packet.flags
+        if ack_nack_type == DHCPNAK and packet.giaddr:
+            flags |= BROADCAST_FLAG # The relay must broadcast a NAK: the client's address is no good
+        ack_packet = self._reply_template(scope, ack_nack_type, self._select_boot_file(packet.client_arch)).render(
+            xid=packet.xid,
+            flags=flags,
+            ciaddr=packet.ciaddr, # Client IP if known, else 0
+            yiaddr=assigned_ip,
+            giaddr=packet.giaddr,
             chaddr=chaddr,
-            message_type=ack_nack_type,
-            file=boot_file, # Boot file name in fixed field
-            options=ack_options
+            lease_time=scope.lease_time
         )
-        self.sock.sendto(ack_packet, ('<broadcast>', 68)) # Send to broadcast
-
-    def handle_release(self, chaddr):
-        mac_str = self.mac_to_str(chaddr)
-        logger.info(f"Received DHCPRELEASE from {mac_str}")
-        if mac_str in self.lease_pool:
-            released_ip = self.lease_pool[mac_str]['ip_address']
-            self.available_ips.add(str(released_ip)) # Return IP to available pool
-            del self.lease_pool[mac_str]
-            self._save_leases() # Save leases after modification
-            logger.info(f"Released IP {released_ip} for {mac_str}.")
+        self._send_reply(ack_packet, OUTCOME_ACK if ack_nack_type == DHCPACK else OUTCOME_NAK, packet)
+
+    def handle_release(self, packet):
+        mac = packet.mac
+        client = log_mac(mac) # Formatted only if a line about it is written
+        logger.info("Received DHCPRELEASE from %s", client)
+        lease = self.leases.get(mac)
+        if lease is not None and self.reservations.mac_for(lease.ip) != mac:
+            released_ip = self._drop_lease(mac).ip # Returns IP to available pool
+            self._save_lease(mac) # Save leases after modification
+            self._outcome = OUTCOME_RELEASED
+            logger.info("Released IP %s for %s.", log_ip(released_ip), client)
+        elif mac in self.reservations:
+            self._outcome = OUTCOME_RELEASED
+            logger.info("Client %s released reserved IP %s, which stays reserved for it.", client, log_ip(self.reservations.ip_for(mac)))
         else:
-            logger.warning(f"Received DHCPRELEASE from {mac_str} but no active lease found.")
+            logger.warning("Received DHCPRELEASE from %s but no active lease found.", client)
 
 
-    def build_dhcp_packet(self, op, xid, ciaddr, yiaddr, siaddr, giaddr, chaddr, message_type, options={}):
+    def _select_boot_file(self, client_arch):
+        # client_arch: Option 93 architecture types from the client's packet
+        if not (self.pxe_server_ip and (self.boot_file_bios or self.boot_file_efi)):
+            return b''
+        if client_arch and (4 in client_arch or 6 in client_arch or 7 in client_arch or 9 in client_arch): # EFI architectures
+            return self.boot_file_efi.encode()
+        return self.boot_file_bios.encode() # Assume BIOS if no EFI arch
+
+    def _reply_options(self, scope):
+        options = {1: scope.subnet_mask.packed} # Subnet Mask
+        if scope.router_ip:
+            options[3] = scope.router_ip.packed # Router (Gateway)
+        options[6] = b''.join([dns.packed for dns in scope.dns_servers]) # DNS Servers
+        options[51] = struct.pack('!I', scope.lease_time) # IP Address Lease Time
+        options[54] = IPv4Address(self.server_ip).packed # Server Identifier
+        if scope.nis_domain_name:
+            options[64] = scope.nis_domain_name.encode() # Option 64: NIS Domain Name
+        if scope.nis_server_ips:
+            options[65] = b''.join([ip.packed for ip in scope.nis_server_ips]) # Option 65: NIS Server Addresses
+        return options
+
+    def _reply_template(self, scope, message_type, boot_file):
+        # One template per scope, message type and boot file (i.e. PXE architecture class)
+        key = (message_type, boot_file)
+        template = scope.reply_templates.get(key)
+        if template is None:
+            packet = self.build_dhcp_packet(
+                op=2, # BOOTREPLY
+                xid=0, ciaddr=0, yiaddr=0, # Patched in per reply, as are the flags
+                siaddr=int(self.pxe_server_ip) if self.pxe_server_ip else int(IPv4Address(self.server_ip)), # Next server IP address (TFTP server)
+                giaddr=0,
+                chaddr=b'',
+                message_type=message_type,
+                file=boot_file,
+                options=self._reply_options(scope)
+            )
+            template = ReplyTemplate(packet, self._option_value_offset(packet, 51))
+            scope.reply_templates[key] = template
+        return template
+
+    @staticmethod
+    def _option_value_offset(packet, code):
+        idx = 240
+        while idx < len(packet) and packet[idx] != 255:
+            if packet[idx] == 0:
+                idx += 1
+                continue
+            if packet[idx] == code:
+                return idx + 2
+            idx += 2 + packet[idx + 1]
+        return None
+
+    def build_dhcp_packet(self, op, xid, ciaddr, yiaddr, siaddr, giaddr, chaddr, message_type, file=b'', options={}, flags=0):
         # DHCP fixed-format fields (236 bytes)
         # op (1), htype (1), hlen (1), hops (1), xid (4), secs (2), flags (2)
         # ciaddr (4), yiaddr (4), siaddr (4), giaddr (4)
         # chaddr (16), sname (64), file (128)
         
         # Fixed BOOTP/DHCP header
-        packet = struct.pack('!BBBBHHI', 
+        packet = struct.pack('!BBBBIHH', 
                             op,    # op: 1=BOOTREQUEST, 2=BOOTREPLY
                             1,     # htype: 1=Ethernet
                             6,     # hlen: hardware address length (Ethernet is 6 bytes)
                             0,     # hops: typically 0
-                            xid,   # xid: transaction ID
+                            xid,   # xid: transaction ID (32 bits)
                             0,     # secs: seconds elapsed
-                            0x8000 # flags: 0x8000 for broadcast, 0x0000 for unicast (we usually broadcast replies to DISCOVER/REQUEST)
+                            flags  # flags: echoed from the request; 0x8000 asks for a broadcast reply
                            )
         
         packet += struct.pack('!IIII', 
@@ -426,7 +2640,7 @@ class DHCPServer:
         packet += struct.pack('!BB', 53, 1) + struct.pack('!B', message_type) # Type: 1=DISCOVER, 2=OFFER, 3=REQUEST, 4=DECLINE, 5=ACK, 6=NAK, 7=RELEASE
 
         # Add PXE options if configured
-        if self.pxe_server_ip_str and (message_type == 2 or message_type == 5): # DHCPOFFER or DHCPACK
+        if self.pxe_server_ip_str and (message_type == DHCPOFFER or message_type == DHCPACK):
             # Option 66: TFTP Server Name
             packet += struct.pack('!BB', 66, len(self.pxe_server_ip_str)) + self.pxe_server_ip_str.encode()
             # Option 67: Bootfile Name (handled in handle_discover/request based on client arch)
@@ -441,7 +2655,55 @@ class DHCPServer:
 
         return packet
 
+def run_workers(count):
+    # Multiprocess mode: fork `count` workers that all bind the DHCP port with
+    # SO_REUSEPORT. Each owns the clients whose MAC hashes to its index, a slice
+    # of the address pool and its own lease snapshot + journal.
+    DHCPServer.prepare_lease_files(count)
+    handoff_socks = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+    for recv_sock, send_sock in handoff_socks:
+        recv_sock.setblocking(False)
+        send_sock.setblocking(False)
+
+    children = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                server = DHCPServer(shard=(index, count))
+                server.handoff_socks = handoff_socks
+                server.start()
+            except SystemExit as e:
+                exit_code = e.code or 0
+            except BaseException as e:
+                logger.error("Worker %s failed: %s", index, e)
+                exit_code = 1
+            os._exit(exit_code)
+        children.append(pid)
+    logger.info("Started %s DHCP worker processes: %s", count, ', '.join(map(str, children)))
+
+    def signal_workers(signum, frame):
+        # SIGHUP makes every worker reload its configuration; SIGTERM and SIGINT stop them
+        forwarded = signal.SIGHUP if signum == signal.SIGHUP else signal.SIGTERM
+        for pid in children:
+            try:
+                os.kill(pid, forwarded)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, signal_workers)
+    signal.signal(signal.SIGINT, signal_workers)
+    signal.signal(signal.SIGHUP, signal_workers)
+    for pid in children:
+        os.waitpid(pid, 0)
+
 if __name__ == "__main__":
-    server = DHCPServer()
-    server.start()
+    if os.getenv('DHCP_CONFIG_FILE'):
+        apply_config_file(os.environ['DHCP_CONFIG_FILE'])
+        logging.getLogger().setLevel(os.getenv('DHCP_LOG_LEVEL', 'INFO').upper())
+    if os.getenv('DHCP_SERVE_MODE', 'single') == 'multiprocess':
+        run_workers(int(os.getenv('DHCP_WORKERS', str(os.cpu_count() or 1))))
+    else:
+        server = DHCPServer()
+        server.start()
 
@@ -0,0 +1,26 @@
+import logging
+import os
+import sys
+
+import pytest
+
+# The server and the benches are plain modules in src/, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import dhcp_server
+
+@pytest.fixture(autouse=True)
+def dhcp_environ(tmp_path):
+    # Every test starts from the defaults with its lease files in tmp_path, and
+    # gets the environment back as it was, including what a reload applied
+    # from a config file
+    environ = dhcp_server.snapshot_environ()
+    level = logging.getLogger().level
+    for key in [key for key in os.environ if key.startswith('DHCP_') or key in ('PXE_SERVER_IP', 'BOOT_FILE_BIOS', 'BOOT_FILE_EFI')]:
+        del os.environ[key]
+    os.environ['DHCP_LEASES_FILE'] = str(tmp_path / 'leases.json')
+    os.environ['DHCP_JOURNAL_FSYNC'] = 'never'
+    logging.getLogger().setLevel(logging.ERROR)
+    yield tmp_path
+    dhcp_server.restore_environ(environ)
+    logging.getLogger().setLevel(level)
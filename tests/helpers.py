@@ -0,0 +1,18 @@
+from dhcp_bench import _CaptureSocket as CaptureSocket, _client_packet as client_packet
+from dhcp_server import DHCPDISCOVER, DHCPREQUEST, DHCPPacket
+
+# Packets and a capturing socket are shared with dhcp_bench.py, so the tests
+# drive the server exactly as the benchmarks time it
+
+def discover(server, mac, xid=1, **fields):
+    server.sock.last_reply = None
+    server.handle_dhcp_packet(client_packet(DHCPDISCOVER, xid, mac.to_bytes(6, 'big'), **fields), ('0.0.0.0', 68))
+    return DHCPPacket(server.sock.last_reply)
+
+def request(server, mac, ip, xid=1, **fields):
+    server.sock.last_reply = None
+    requested = bytes([50, 4]) + ip.to_bytes(4, 'big')
+    server.handle_dhcp_packet(client_packet(DHCPREQUEST, xid, mac.to_bytes(6, 'big'), requested, **fields), ('0.0.0.0', 68))
+    return DHCPPacket(server.sock.last_reply)
+
+__all__ = ['CaptureSocket', 'client_packet', 'discover', 'request']
@@ -0,0 +1,88 @@
+import json
+import os
+import time
+from ipaddress import IPv4Address
+
+import pytest
+
+from dhcp_server import DHCPServer, Lease, LeaseJournal, format_mac
+
+START_IP = int(IPv4Address('10.0.0.1'))
+
+def _records(count, lease_time_end):
+    return [(0x020000000000 + i, Lease(0x020000000000 + i, START_IP + i, lease_time_end)) for i in range(count)]
+
+def _replay(snapshot_path, journal_path):
+    leases = {}
+    journal = LeaseJournal(snapshot_path, journal_path, fsync_policy='never')
+    applied = journal.replay(leases)
+    return journal, applied, leases
+
+def test_compaction_snapshot_matches_journalled_changes(tmp_path):
+    snapshot_path, journal_path = str(tmp_path / 'leases.json'), str(tmp_path / 'leases.journal')
+    now = time.time()
+    expected = {format_mac(mac): {'ip_address': str(IPv4Address(lease.ip)), 'lease_time_end': lease.lease_time_end, 'is_static': False}
+                for mac, lease in _records(300, now + 3600)}
+    with open(snapshot_path, 'w') as f:
+        json.dump(expected, f)
+    journal, _, _ = _replay(snapshot_path, journal_path)
+    records = _records(300, now + 7200)
+    for mac, lease in records[:100]:
+        journal.record(mac, lease)
+        expected[format_mac(mac)]['lease_time_end'] = lease.lease_time_end
+    for mac, _ in records[100:200]:
+        journal.record(mac, None)
+        del expected[format_mac(mac)]
+    journal.compact()
+    journal.close() # Waits for the compactor
+
+    with open(snapshot_path) as f:
+        assert json.load(f) == expected
+    assert not os.path.exists(journal.rotated_path)
+
+@pytest.mark.parametrize('tail', ['torn', 'corrupt'])
+def test_recovery_from_a_bad_tail(tmp_path, tail):
+    # A crash mid-write leaves a torn record; a bad disk a corrupt one. Either
+    # way every good record replays, the tail is cut off and appends go on.
+    snapshot_path, journal_path = str(tmp_path / 'missing.json'), str(tmp_path / 'leases.journal')
+    records = _records(102, time.time() + 3600)
+    good = records[:100]
+    journal, _, _ = _replay(snapshot_path, journal_path)
+    for record in good:
+        journal.record(*record)
+    journal.close()
+    good_size = os.path.getsize(journal_path)
+    encoded = LeaseJournal._encode(*records[100])
+    with open(journal_path, 'ab') as f:
+        f.write(encoded[:-7] if tail == 'torn' else b'00000000' + encoded[8:])
+
+    journal, applied, leases = _replay(snapshot_path, journal_path)
+    assert applied == len(good)
+    assert set(leases) == {format_mac(mac) for mac, _ in good}
+    assert os.path.getsize(journal_path) == good_size
+    journal.record(*records[101])
+    journal.close()
+
+    journal, applied, leases = _replay(snapshot_path, journal_path)
+    journal.close()
+    assert applied == len(good) + 1
+    assert format_mac(records[101][0]) in leases
+
+def test_compaction_forgets_leases_dropped_at_load(tmp_path):
+    # Of two dynamic leases on one address the later one wins, and a dynamic
+    # lease on a reserved address gives way to the reservation: the losers must
+    # not come back from the snapshot after the next compaction
+    now = time.time()
+    os.environ.update(DHCP_LEASE_START_IP='10.0.0.10', DHCP_LEASE_END_IP='10.0.0.200',
+                      DHCP_RESERVATIONS_FILE=str(tmp_path / 'reservations.csv'))
+    (tmp_path / 'reservations.csv').write_text('mac,ip\n02:00:00:00:00:99,10.0.0.50\n')
+    with open(tmp_path / 'leases.json', 'w') as f:
+        json.dump({'02:00:00:00:00:01': {'ip_address': '10.0.0.20', 'lease_time_end': now + 100, 'is_static': False},
+                   '02:00:00:00:00:02': {'ip_address': '10.0.0.20', 'lease_time_end': now + 200, 'is_static': False},
+                   '02:00:00:00:00:03': {'ip_address': '10.0.0.50', 'lease_time_end': now + 200, 'is_static': False}}, f)
+    server = DHCPServer()
+    server.journal.compact()
+    server.journal.close()
+
+    with open(tmp_path / 'leases.json') as f:
+        assert sorted(json.load(f)) == ['02:00:00:00:00:02']
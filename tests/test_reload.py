@@ -0,0 +1,108 @@
+import json
+import os
+import time
+from ipaddress import IPv4Address
+
+import pytest
+
+from dhcp_server import DHCPACK, DHCPNAK, DHCPServer, format_mac
+from tests.helpers import CaptureSocket, discover, request
+
+START_IP = int(IPv4Address('10.1.0.10'))
+BASE_CONFIG = {
+    'DHCP_LEASE_START_IP': '10.1.0.10',
+    'DHCP_LEASE_END_IP': '10.1.199.255',
+    'DHCP_SUBNET_MASK': '255.255.0.0',
+    'DHCP_ROUTER_IP': '10.1.0.1',
+    'DHCP_DNS_SERVERS': '10.1.0.2',
+    'DHCP_MAC_RATE_LIMIT': '0',
+}
+RESERVED_MAC, RESERVED_IP = 0x02bb00000001, START_IP + 300
+STATIC_MAC, STATIC_IP = 0x02ffffffff01, int(IPv4Address('10.1.220.5')) # Outside the range until it grows
+
+class Reloader:
+    # A server with 200 leases and a static one, reloaded from a config file
+    # the test rewrites; every reload must keep each lease and its address
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        os.environ['DHCP_CONFIG_FILE'] = self.config_path = str(tmp_path / 'config')
+        self.write_config()
+        self.server = DHCPServer()
+        self.server.sock = CaptureSocket()
+        now = time.time()
+        for i in range(200):
+            self.server._bind_lease(0x020000000000 + i, START_IP + i, now + 3600)
+        self.server._bind_lease(STATIC_MAC, STATIC_IP, now + 365 * 24 * 3600, is_static=True)
+        self.expected = {lease.mac: lease.ip for lease in self.server.leases}
+
+    def write_config(self, **changes):
+        settings = dict(BASE_CONFIG, **changes)
+        with open(self.config_path, 'w') as f:
+            f.writelines(f'{key}="{value}"\n' for key, value in settings.items() if value is not None)
+
+    def write_file(self, name, content):
+        path = self.tmp_path / name
+        path.write_text(content if isinstance(content, str) else json.dumps(content))
+        return str(path)
+
+    def reload(self, **changes):
+        self.write_config(**changes)
+        self.server._reload_requested = True # As the SIGHUP handler does
+        self.server._run_periodic_tasks()
+        assert {lease.mac: lease.ip for lease in self.server.leases} == self.expected
+        for ip in self.expected.values():
+            scope = self.server.scope_index.lookup(ip)
+            assert scope is None or not scope.ip_pool.is_free(ip), f'{IPv4Address(ip)} is free in {scope.name}'
+
+@pytest.fixture
+def reloader(tmp_path):
+    reloader = Reloader(tmp_path)
+    yield reloader
+    reloader.server.journal.close()
+
+def test_changed_options(reloader):
+    reloader.reload(DHCP_DNS_SERVERS='10.1.0.3,10.1.0.4', DHCP_LEASE_TIME='7200')
+    assert discover(reloader.server, 0x02aa00000001).raw(6) == IPv4Address('10.1.0.3').packed + IPv4Address('10.1.0.4').packed
+
+def test_grown_and_shrunk_range(reloader):
+    pool = reloader.server.default_scope.ip_pool
+    reloader.reload(DHCP_LEASE_END_IP='10.1.239.255')
+    assert not pool.is_free(STATIC_IP) and pool.is_free(STATIC_IP + 1)
+    reloader.reload(DHCP_LEASE_END_IP='10.1.99.255')
+    assert reloader.server.default_scope.ip_pool.size == int(IPv4Address('10.1.99.255')) - START_IP + 1
+
+def test_offer_held_across_a_regrow_has_one_holder(reloader):
+    # An offer the shrink puts outside the pool, and the relayed scope grows
+    # back over, must not let a second client lease the same address
+    first, second = 0x02aa00000001, 0x02aa00000003
+    discover(reloader.server, first)
+    reloader.reload(DHCP_LEASE_END_IP='10.1.99.255')
+    scopes = reloader.write_file('scopes.json', [
+        {'subnet': '10.1.0.0/16', 'start_ip': '10.1.0.10', 'end_ip': '10.1.199.255'},
+        {'subnet': '10.2.0.0/24', 'start_ip': '10.2.0.10', 'end_ip': '10.2.0.250', 'router': '10.2.0.1'}])
+    reloader.reload(DHCP_LEASE_END_IP='10.1.99.255', DHCP_SCOPES_FILE=scopes)
+    assert discover(reloader.server, 0x02aa00000002, giaddr=int(IPv4Address('10.2.0.1'))).yiaddr == int(IPv4Address('10.2.0.10'))
+
+    ip = discover(reloader.server, second).yiaddr
+    assert request(reloader.server, second, ip).message_type == DHCPACK
+    assert request(reloader.server, first, ip).message_type == DHCPNAK
+    assert reloader.server.leases.holder(ip).mac == second
+
+def test_removed_reservation_stays_leased_to_its_client(reloader):
+    reservations = reloader.write_file('reservations.csv', f'mac,ip\n{format_mac(RESERVED_MAC)},{IPv4Address(RESERVED_IP)}\n')
+    reloader.reload(DHCP_RESERVATIONS_FILE=reservations)
+    assert request(reloader.server, RESERVED_MAC, RESERVED_IP).message_type == DHCPACK
+    assert RESERVED_MAC not in reloader.server.leases
+
+    # Un-reserved, the client keeps the address it was acknowledged as a lease
+    # until that ends, and no other client gets or is offered it
+    reloader.expected[RESERVED_MAC] = RESERVED_IP
+    reloader.reload(DHCP_RESERVATIONS_FILE=reloader.write_file('none.csv', 'mac,ip\n'))
+    assert request(reloader.server, 0x02bb00000002, RESERVED_IP).message_type == DHCPNAK
+    assert discover(reloader.server, 0x02bb00000002).yiaddr != RESERVED_IP
+
+def test_broken_config_keeps_the_running_configuration(reloader):
+    reloader.reload(DHCP_ROUTER_IP='not-an-address')
+    assert reloader.server.reload_failures == 1
+    assert str(reloader.server.router_ip) == '10.1.0.1'
+    assert os.environ['DHCP_ROUTER_IP'] == '10.1.0.1'
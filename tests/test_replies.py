@@ -0,0 +1,23 @@
+import os
+import random
+
+import pytest
+
+from dhcp_server import DHCPACK, DHCPOFFER, DHCPServer
+
+@pytest.mark.parametrize('message_type', [DHCPOFFER, DHCPACK])
+@pytest.mark.parametrize('arch', [[], [0], [7]], ids=['none', 'bios', 'efi'])
+def test_template_is_byte_identical_to_the_builder(message_type, arch):
+    os.environ.update(PXE_SERVER_IP='192.168.1.1', BOOT_FILE_BIOS='pxelinux.0', BOOT_FILE_EFI='bootx64.efi',
+                      DHCP_NIS_DOMAIN='example.com', DHCP_NIS_SERVERS='192.168.1.10,192.168.1.11')
+    server = DHCPServer()
+    scope = server.default_scope
+    boot_file = server._select_boot_file(arch)
+    template = server._reply_template(scope, message_type, boot_file)
+    rng = random.Random(0)
+    for _ in range(100):
+        xid, yiaddr, giaddr, chaddr = rng.getrandbits(32), rng.getrandbits(32), rng.getrandbits(32), rng.randbytes(6)
+        expected = server.build_dhcp_packet(2, xid, 0, yiaddr, int(server.pxe_server_ip), giaddr, chaddr, message_type,
+                                            file=boot_file, options=server._reply_options(scope), flags=0x8000)
+        assert template.render(xid, 0x8000, 0, yiaddr, giaddr, chaddr, scope.lease_time) == expected
+    server.journal.close()
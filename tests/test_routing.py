@@ -0,0 +1,52 @@
+import os
+from ipaddress import IPv4Address
+
+import pytest
+
+import dhcp_server
+from dhcp_server import DESTINATIONS, DHCPDISCOVER, DHCPREQUEST, DHCPPacket, DHCPServer
+from tests.helpers import CaptureSocket, client_packet
+
+# Reply routing, RFC 2131 Section 4.1
+RELAY = int(IPv4Address('10.0.0.254'))
+CLIENT_A, CLIENT_B = b'\x02\x00\x00\x00\x00\x0a', b'\x02\x00\x00\x00\x00\x0b'
+FIRST_IP = int(IPv4Address('10.0.0.10'))
+RENEW = client_packet(DHCPREQUEST, 5, CLIENT_A, ciaddr=FIRST_IP, flags=0)
+CASES = [
+    # (case, request, expected destination, expected address, expected reply flags)
+    ('DISCOVER, broadcast flag', client_packet(DHCPDISCOVER, 1, CLIENT_A), 'broadcast', ('<broadcast>', 68), 0x8000),
+    ('DISCOVER, no flag', client_packet(DHCPDISCOVER, 2, CLIENT_A, flags=0), 'broadcast', ('<broadcast>', 68), 0),
+    ('DISCOVER via relay', client_packet(DHCPDISCOVER, 3, CLIENT_B, giaddr=RELAY, flags=0), 'relay', ('10.0.0.254', 67), 0),
+    ('REQUEST, selecting', client_packet(DHCPREQUEST, 4, CLIENT_A, bytes([50, 4]) + FIRST_IP.to_bytes(4, 'big')), 'broadcast', ('<broadcast>', 68), 0x8000),
+    ('RENEW from ciaddr', RENEW, 'unicast', ('10.0.0.10', 68), 0),
+    ('RENEW retransmitted', RENEW, 'unicast', ('10.0.0.10', 68), 0),
+    ('NAK, direct, ciaddr set', client_packet(DHCPREQUEST, 6, CLIENT_B, ciaddr=FIRST_IP + 50, flags=0), 'broadcast', ('<broadcast>', 68), 0),
+    ('NAK via relay', client_packet(DHCPREQUEST, 7, CLIENT_B, bytes([50, 4, 10, 0, 1, 5]), giaddr=RELAY, flags=0), 'relay', ('10.0.0.254', 67), 0x8000),
+]
+
+@pytest.fixture
+def server():
+    os.environ.update(DHCP_LEASE_START_IP='10.0.0.10', DHCP_LEASE_END_IP='10.0.0.200', DHCP_SUBNET_MASK='255.255.255.0', DHCP_MAC_RATE_LIMIT='0')
+    server = DHCPServer()
+    server.sock = CaptureSocket()
+    yield server
+    server.journal.close()
+
+def test_reply_destinations(server):
+    # The cases run in order: the RENEWs need the lease the REQUEST bound
+    for case, data, destination, addr, flags in CASES:
+        sent_before = list(server.replies_sent)
+        server.sock.last_reply = server.sock.last_addr = None
+        server.handle_dhcp_packet(data, ('0.0.0.0', 68))
+        assert server.sock.last_reply is not None, case
+        reply = DHCPPacket(server.sock.last_reply)
+        counted = [DESTINATIONS[i] for i, (after, before) in enumerate(zip(server.replies_sent, sent_before)) if after != before]
+        assert (server.sock.last_addr, counted, reply.flags) == (addr, [destination], flags), case
+
+def test_renew_retransmission_is_answered_from_the_cache(server):
+    for _, data, _, _, _ in CASES[:5]:
+        server.handle_dhcp_packet(data, ('0.0.0.0', 68))
+    hits = server.reply_cache.hits
+    server.handle_dhcp_packet(RENEW, ('0.0.0.0', 68))
+    assert server.reply_cache.hits == hits + 1
+    assert DHCPPacket(server.sock.last_reply).message_type == dhcp_server.DHCPACK
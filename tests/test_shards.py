@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from dhcp_server import DHCPACK, DHCPServer, LeaseTopology
+from tests.helpers import CaptureSocket, discover, request
+
+MACS = [0x020000000000 + i for i in range(1, 21)]
+
+def _boot(workers):
+    # What run_workers does before forking, then one server per worker
+    if workers == 0:
+        return [DHCPServer()]
+    DHCPServer.prepare_lease_files(workers)
+    return [DHCPServer(shard=(index, workers)) for index in range(workers)]
+
+def _owner(servers, mac):
+    return next(server for server in servers if server._owns_mac(mac.to_bytes(6, 'big')))
+
+def _close(servers):
+    for server in servers:
+        server.journal.close()
+
+@pytest.fixture
+def bound():
+    # Twenty clients leased through two workers, each by the worker owning it
+    os.environ.update(DHCP_LEASE_START_IP='10.0.0.10', DHCP_LEASE_END_IP='10.0.0.200', DHCP_SERVER_IP='10.0.0.1')
+    servers = _boot(2)
+    bound = {}
+    for mac in MACS:
+        server = _owner(servers, mac)
+        server.sock = CaptureSocket()
+        ip = discover(server, mac).yiaddr
+        assert request(server, mac, ip).message_type == DHCPACK
+        bound[mac] = ip
+    _close(servers)
+    return bound
+
+def _assert_kept(servers, bound):
+    for mac, ip in bound.items():
+        lease = _owner(servers, mac).leases.get(mac)
+        assert lease is not None and lease.ip == ip
+        for server in servers:
+            assert not server._pool_for(ip).is_free(ip)
+
+def test_leases_survive_a_changed_worker_count(bound):
+    for workers in (0, 3, 1, 0, 2):
+        servers = _boot(workers)
+        _assert_kept(servers, bound)
+        _close(servers)
+
+def test_reshard_interrupted_after_the_commit_point_completes_on_the_next_start(bound, monkeypatch):
+    finish = LeaseTopology._finish
+    def crash_once(self, workers):
+        monkeypatch.setattr(LeaseTopology, '_finish', finish)
+        raise OSError('crash')
+    monkeypatch.setattr(LeaseTopology, '_finish', crash_once)
+    with pytest.raises(OSError):
+        _boot(3)
+    servers = _boot(3)
+    _assert_kept(servers, bound)
+    _close(servers)
+
+def test_reshard_interrupted_before_the_commit_point_keeps_the_old_files(bound, monkeypatch, tmp_path):
+    def crash(self, workers, resharding):
+        raise OSError('crash')
+    with monkeypatch.context() as patch:
+        patch.setattr(LeaseTopology, '_write', crash)
+        with pytest.raises(OSError):
+            _boot(0)
+    # The staged snapshots are left behind, and discarded by the next start
+    servers = _boot(0)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.reshard')]
+    _assert_kept(servers, bound)
+    _close(servers)
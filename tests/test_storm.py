@@ -0,0 +1,66 @@
+import os
+import struct
+import time
+from ipaddress import IPv4Address
+
+import pytest
+
+from dhcp_server import DHCPDISCOVER, DHCPREQUEST, DHCPServer
+from tests.helpers import CaptureSocket, client_packet
+
+CLIENTS = 50
+
+def _server(**settings):
+    os.environ.update(DHCP_LEASE_START_IP='10.0.0.1', DHCP_LEASE_END_IP='10.0.255.254', DHCP_SUBNET_MASK='255.255.0.0', **settings)
+    server = DHCPServer()
+    server.sock = CaptureSocket()
+    return server
+
+@pytest.mark.parametrize('cache_size', ['0', '4096'])
+def test_retransmissions_get_the_original_reply(cache_size):
+    # Every DISCOVER and REQUEST is sent five times with the same xid: each copy
+    # gets the same reply, and with the cache the handlers run once per
+    # transaction
+    copies = 5
+    server = _server(DHCP_REPLY_CACHE_SIZE=cache_size, DHCP_MAC_RATE_LIMIT='0')
+    records = []
+    record = server.journal.record
+    def counting_record(mac, lease):
+        records.append(mac)
+        record(mac, lease)
+    server.journal.record = counting_record
+    for i in range(CLIENTS):
+        chaddr = b'\x02' + i.to_bytes(5, 'big')
+        requested = struct.pack('!BBI', 50, 4, int(IPv4Address('10.0.0.1')) + i)
+        for message_type, options in ((DHCPDISCOVER, b''), (DHCPREQUEST, requested)):
+            replies = []
+            for _ in range(copies):
+                server.handle_dhcp_packet(client_packet(message_type, i, chaddr, options), ('0.0.0.0', 68))
+                replies.append(server.sock.last_reply)
+            assert replies[0] is not None
+            assert replies == [replies[0]] * copies
+    server.journal.close()
+    if cache_size != '0':
+        assert len(records) == CLIENTS
+        assert server.reply_cache.hits == 2 * CLIENTS * (copies - 1)
+
+@pytest.mark.parametrize('rate_limit', ['0', '10'])
+def test_looping_nic_does_not_starve_other_clients(rate_limit):
+    # One NIC sends a fresh DISCOVER twenty times between each well-behaved
+    # client: everyone else is still answered, and the limiter sheds the flood
+    server = _server(DHCP_MAC_RATE_LIMIT=rate_limit)
+    looping_mac = b'\x02\xee\xee\xee\xee\xee'
+    answered = flood = 0
+    started = time.monotonic()
+    for i in range(CLIENTS):
+        for j in range(20):
+            server.handle_dhcp_packet(client_packet(DHCPDISCOVER, 1000000 + i * 20 + j, looping_mac), ('0.0.0.0', 68))
+            flood += 1
+        server.sock.last_reply = None
+        server.handle_dhcp_packet(client_packet(DHCPDISCOVER, i, b'\x02' + i.to_bytes(5, 'big')), ('0.0.0.0', 68))
+        answered += server.sock.last_reply is not None
+    elapsed = time.monotonic() - started
+    server.journal.close()
+    assert answered == CLIENTS
+    if rate_limit != '0':
+        assert server.mac_limiter.dropped >= flood - server.mac_rate_burst - elapsed * server.mac_rate_limit - 1